@@ -0,0 +1,229 @@
+#!/opt/modem_config/bin/python3
+'''
+Run the firmware downloads (modem_firmware.downloadCarrierFirmware() and downloadFirmware()) against a local stand-in
+for the download site (see fake_firmware_server.py) and check what they end up with: a fresh download, a cache hit,
+an interrupted download resumed, a file that changed before the resume (If-Range), a segmented download, a dropped
+segment resumed, a download that does not match its known hash, the carriers downloaded at the same time over one
+connection pool, and one carrier failing while the others complete.  Reports the wall time and what the server saw for
+each run
+
+usage: bench_firmware_download.py [zip size in MiB]
+    zip size in MiB: at least 1 (default 4)
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import modem_firmware
+from modem_firmware import KNOWN_FIRMWARE_SHA512, DEFAULT_FIRMWARE_ORDER_LIST, FirmwareDownloadError, FirmwareVerificationError, getDownloadSession, getFileSha512, loadFirmwareManifest, downloadCarrierFirmware, downloadFirmware
+from fake_firmware_server import FAKE_MODEL_HEADER, FakeFirmwareServer, makeFakeFirmwareZip
+
+DEFAULT_ZIP_SIZE_MIB = 4
+# smaller zips would not be split into segments (see BENCH_SEGMENT_MIN_SIZE), and the drops would come before the
+# first download block is in
+MIN_ZIP_SIZE_MIB = 1
+
+# segments are only used for big files; make the fake zips count as big
+BENCH_SEGMENT_MIN_SIZE = 1048576
+
+BENCH_SEGMENT_COUNT = 4
+
+# seconds per 64 KiB the server waits in the concurrent runs, so the downloads overlap
+BENCH_CHUNK_DELAY = 0.002
+
+
+class ScenarioFailed(AssertionError):
+    ...
+
+
+def check(condition:bool, message:str) -> None:
+    if not condition:
+        raise ScenarioFailed(message)
+
+
+def runScenario(name:str, methodToCall, fakeServer:FakeFirmwareServer) -> bool:
+    '''
+    :return: True if the scenario passed
+    '''
+    fakeServer.resetStats()
+    startTime = time.monotonic()
+    error = None
+    try:
+        methodToCall()
+    except Exception as e:
+        error = e
+    wallTime = time.monotonic() - startTime
+
+    print(f'\n{name}: {wallTime:.2f} s {"ok" if error is None else f"FAILED ({type(error).__name__}: {error})"}')
+    serverStats = fakeServer.resetStats()
+    print('    server: ' + ', '.join(f'{curName} {curCount}' for curName, curCount in sorted(serverStats.items())))
+
+    return error is None
+
+
+def getPartFilePath(carrierName:str, zipFilename:str) -> str:
+    return os.path.join(modem_firmware.getFirmwareCacheDirPath(), f'{carrierName}@{zipFilename}.part')
+
+
+def checkDownloaded(carrierName:str, filePath:str, expectedSha512:str) -> None:
+    check(getFileSha512(filePath) == expectedSha512, f'{filePath} does not have the contents the server sent')
+    check(loadFirmwareManifest()[carrierName].sha512 == expectedSha512, f'manifest entry of {carrierName} has the wrong sha512')
+    check(not os.path.exists(f'{getPartFilePath(carrierName, os.path.basename(filePath).partition("@")[2])}'), f'.part file of {carrierName} was left behind')
+
+
+def expectFailure(methodToCall, exceptionTypes) -> Exception:
+    try:
+        methodToCall()
+    except exceptionTypes as e:
+        return e
+    raise ScenarioFailed(f'expected {exceptionTypes} but it worked')
+
+
+if __name__ == '__main__':
+    zipSizeMib = DEFAULT_ZIP_SIZE_MIB
+    if len(sys.argv) > 1:
+        zipSizeMib = float(sys.argv[1])
+    if zipSizeMib < MIN_ZIP_SIZE_MIB:
+        print(f'zip size has to be at least {MIN_ZIP_SIZE_MIB} MiB', file=sys.stderr)
+        sys.exit(2)
+    cweSize = int(zipSizeMib * 1048576)
+
+    modem_firmware.DOWNLOAD_SEGMENT_MIN_SIZE = BENCH_SEGMENT_MIN_SIZE
+
+    workDirPath = tempfile.mkdtemp(prefix='modem-firmware-dl-')
+    print(f'Downloading into {workDirPath} ({zipSizeMib} MiB zips)')
+    savedCwd = os.getcwd()
+    # MODEM_FIRMWARE_DIRNAME is relative to the working dir
+    os.chdir(workDirPath)
+    os.mkdir(modem_firmware.MODEM_FIRMWARE_DIRNAME)
+    modemFirmwareDirPath = os.path.realpath(modem_firmware.MODEM_FIRMWARE_DIRNAME)
+
+    resultList = []
+    try:
+        with FakeFirmwareServer() as fakeServer:
+            # pageCarrierName: the carrier row to link the zip from on the download page (None to leave it off)
+            def addCarrier(priCarrierName:str, pageCarrierName:str=None) -> tuple:
+                zipFilename, zipBytes = makeFakeFirmwareZip(priCarrierName, '02.33.03.00', '002.079_002', cweSize)
+                return (fakeServer.addFile(pageCarrierName, zipFilename, zipBytes), zipFilename)
+
+            def downloadOne(carrierName:str, filePath:str, segmentCount:int=None) -> str:
+                with getDownloadSession(segmentCount) as session:
+                    return downloadCarrierFirmware(session, carrierName, fakeServer.baseUrl + filePath, modemFirmwareDirPath, segmentCount)
+
+            # ---- downloadCarrierFirmware() ----
+
+            freshPath, freshFilename = addCarrier('Fresh')
+
+            def freshDownload():
+                checkDownloaded('Fresh', downloadOne('Fresh', freshPath), fakeServer.fileDict[freshPath].sha512)
+            resultList.append(runScenario('fresh download', freshDownload, fakeServer))
+
+            def cacheHit():
+                cachedFilePath = os.path.join(modemFirmwareDirPath, f'Fresh@{freshFilename}')
+                cachedInode = os.stat(cachedFilePath).st_ino
+                checkDownloaded('Fresh', downloadOne('Fresh', freshPath), fakeServer.fileDict[freshPath].sha512)
+                check(os.stat(cachedFilePath).st_ino == cachedInode, 'the cached zip was replaced')
+            resultList.append(runScenario('cache hit', cacheHit, fakeServer))
+
+            resumePath, resumeFilename = addCarrier('Resume')
+
+            def interruptedThenResumed():
+                droppedAfterBytes = cweSize // 3
+                fakeServer.dropAfter(resumePath, droppedAfterBytes)
+                expectFailure(lambda: downloadOne('Resume', resumePath), Exception)
+                keptBytes = os.path.getsize(getPartFilePath('Resume', resumeFilename))
+                check(0 < keptBytes <= droppedAfterBytes, f'.part file has {keptBytes} bytes after the drop')
+
+                checkDownloaded('Resume', downloadOne('Resume', resumePath), fakeServer.fileDict[resumePath].sha512)
+                check(fakeServer.stats['rangeRequests'] == 1, 'the rest was not fetched with a range request')
+                check(fakeServer.stats['rangeBytesSent'] == len(fakeServer.fileDict[resumePath].data) - keptBytes, 'the kept part was fetched again')
+            resultList.append(runScenario('interrupted, then resumed', interruptedThenResumed, fakeServer))
+
+            changedPath, _ = addCarrier('Changed')
+
+            def changedBeforeResume():
+                fakeServer.dropAfter(changedPath, cweSize // 3)
+                expectFailure(lambda: downloadOne('Changed', changedPath), Exception)
+
+                # same size, new contents; the full response still claims to be the old file, so only If-Range can
+                # tell the kept part belongs to something else
+                oldData = fakeServer.fileDict[changedPath].data
+                fakeServer.changeFile(changedPath, oldData[:-4096] + os.urandom(4096))
+                fakeServer.serveStaleValidators(changedPath)
+
+                checkDownloaded('Changed', downloadOne('Changed', changedPath), fakeServer.fileDict[changedPath].sha512)
+                check(fakeServer.stats['ifRangeMismatches'] == 1, 'the range request did not carry the validator of the kept part')
+            resultList.append(runScenario('file changed before the resume (If-Range)', changedBeforeResume, fakeServer))
+
+            segmentedPath, _ = addCarrier('Segmented')
+
+            def segmented():
+                checkDownloaded('Segmented', downloadOne('Segmented', segmentedPath, BENCH_SEGMENT_COUNT), fakeServer.fileDict[segmentedPath].sha512)
+                check(fakeServer.stats['rangeRequests'] == BENCH_SEGMENT_COUNT, f'{fakeServer.stats["rangeRequests"]} range requests for {BENCH_SEGMENT_COUNT} segments')
+            resultList.append(runScenario('segmented', segmented, fakeServer))
+
+            droppedSegmentPath, _ = addCarrier('DroppedSegment')
+
+            def droppedSegmentResumed():
+                fileSize = len(fakeServer.fileDict[droppedSegmentPath].data)
+                segmentBytes = -(-fileSize // BENCH_SEGMENT_COUNT)
+                # cut off the third segment
+                fakeServer.dropAfter(droppedSegmentPath, segmentBytes // 2, startByte=segmentBytes * 2)
+                expectFailure(lambda: downloadOne('DroppedSegment', droppedSegmentPath, BENCH_SEGMENT_COUNT), Exception)
+                rangeRequestsBefore = fakeServer.stats['rangeRequests']
+
+                checkDownloaded('DroppedSegment', downloadOne('DroppedSegment', droppedSegmentPath, BENCH_SEGMENT_COUNT), fakeServer.fileDict[droppedSegmentPath].sha512)
+                check(fakeServer.stats['rangeRequests'] - rangeRequestsBefore == 1, 'more than the dropped segment was fetched again')
+            resultList.append(runScenario('dropped segment, then resumed', droppedSegmentResumed, fakeServer))
+
+            # served under the name of a real package, so it has to match that package's known hash (and does not)
+            knownCarrierName, _, knownFilename = next(iter(KNOWN_FIRMWARE_SHA512)).partition('@')
+            knownPath = fakeServer.addFile(None, knownFilename, makeFakeFirmwareZip('Generic', '02.30.01.01', '002.045_002', cweSize)[1])
+
+            def hashMismatch():
+                expectFailure(lambda: downloadOne(knownCarrierName, knownPath), FirmwareVerificationError)
+                check(not os.path.exists(getPartFilePath(knownCarrierName, knownFilename)), 'the bad download was kept to resume from')
+                check(not os.path.exists(os.path.join(modemFirmwareDirPath, f'{knownCarrierName}@{knownFilename}')), 'the bad download was linked in')
+            resultList.append(runScenario('download does not match its known hash', hashMismatch, fakeServer))
+
+            # ---- downloadFirmware() ----
+
+            fakeServer.chunkDelay = BENCH_CHUNK_DELAY
+            carrierPathDict = {curCarrierName: addCarrier(f'Carrier{curIndex}', curCarrierName)[0] for curIndex, curCarrierName in enumerate(DEFAULT_FIRMWARE_ORDER_LIST)}
+
+            def concurrentDownloads():
+                downloadedFileDict = downloadFirmware(fakeServer.pageUrl, FAKE_MODEL_HEADER, DEFAULT_FIRMWARE_ORDER_LIST, catalogTtl=0)
+                for curCarrierName, curFilePath in downloadedFileDict.items():
+                    checkDownloaded(curCarrierName, curFilePath, fakeServer.fileDict[carrierPathDict[curCarrierName]].sha512)
+                check(fakeServer.stats['maxActiveBodies'] > 1, 'the downloads did not overlap')
+                # the page and every download share one pool
+                check(fakeServer.stats['connections'] <= modem_firmware.DEFAULT_DOWNLOAD_MAX_WORKERS, f'{fakeServer.stats["connections"]} connections for {modem_firmware.DEFAULT_DOWNLOAD_MAX_WORKERS} workers')
+            resultList.append(runScenario('carriers downloaded at the same time', concurrentDownloads, fakeServer))
+
+            brokenCarrierName = 'Broken'
+            brokenPath = addCarrier('Broken', brokenCarrierName)[0]
+            fakeServer.failFile(brokenPath, 500)
+
+            def oneCarrierFails():
+                # new contents, so the others really download again next to the failing one
+                for curFilePath in carrierPathDict.values():
+                    fakeServer.changeFile(curFilePath, fakeServer.fileDict[curFilePath].data[:-4096] + os.urandom(4096))
+                carrierList = DEFAULT_FIRMWARE_ORDER_LIST + [brokenCarrierName]
+                downloadError = expectFailure(lambda: downloadFirmware(fakeServer.pageUrl, FAKE_MODEL_HEADER, carrierList, catalogTtl=0), FirmwareDownloadError)
+                check(list(downloadError.errors) == [brokenCarrierName], f'errors for {list(downloadError.errors)}')
+                for curCarrierName, curFilePath in carrierPathDict.items():
+                    curFileList = [curFilename for curFilename in os.listdir(modemFirmwareDirPath) if curFilename.startswith(f'{curCarrierName}@')]
+                    check(len(curFileList) == 1, f'{curCarrierName} has {curFileList}')
+                    checkDownloaded(curCarrierName, os.path.join(modemFirmwareDirPath, curFileList[0]), fakeServer.fileDict[curFilePath].sha512)
+            resultList.append(runScenario('one carrier fails, the others complete', oneCarrierFails, fakeServer))
+    finally:
+        os.chdir(savedCwd)
+        shutil.rmtree(workDirPath, ignore_errors=True)
+
+    print(f'\n{sum(resultList)} of {len(resultList)} ok')
+    if not all(resultList):
+        sys.exit(1)
@@ -0,0 +1,95 @@
+#!/opt/modem_config/bin/python3
+'''
+Benchmark the firmware table extraction (modem_firmware.parseFirmwarePage()) against the BeautifulSoup way it used to be
+done, using the saved download page in fixtures/
+
+usage: bench_firmware_table.py [iterations]
+'''
+import os
+import sys
+import time
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from modem_firmware import SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, FIRMWARE_TABLE_HEADERS, FIRMWARE_LINK_TABLE_HEADERS, DEFAULT_FIRMWARE_ORDER_LIST, parseFirmwarePage
+from urllib.parse import urljoin
+
+FIXTURE_PAGE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures', 'em_mc74xx_fw_packages.html')
+
+MODEL_HEADER = '7455'
+
+DEFAULT_ITERATIONS = 50
+
+
+def parseFirmwarePageSoup(firmwarePageText, pageUrlToParse, modelHeader, carrierList):
+    '''
+    The BeautifulSoup version, for comparison.  Note: newer soupsieve versions reject the old
+    table.fw-table:has(> tbody > tr:nth-child(1) ...) selector, so the table is picked out in python instead
+    '''
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(firmwarePageText, "html.parser")
+
+    firmwareLinkTableObj = None
+    for curTableObj in soup.select('table.fw-table'):
+        curStrongObj = curTableObj.select_one(':scope > tbody > tr:nth-child(1) > td:nth-child(1) > strong:nth-child(1)')
+        if curStrongObj is not None and modelHeader in ''.join(curStrongObj.find_all(string=True, recursive=False)):
+            firmwareLinkTableObj = curTableObj
+            break
+
+    foundCarrierFwFileLinks = {}
+    for curFirmwareLinkTableRowObj in firmwareLinkTableObj.select(':scope > tbody > tr')[1:]:
+        curFirstCell = curFirmwareLinkTableRowObj.select_one(':scope > td:nth-child(1)')
+        curFirstCellStrippedString = list(curFirstCell.stripped_strings)[0]
+        if curFirstCellStrippedString not in carrierList:
+            continue
+        foundCarrierFwFileLinks[curFirstCellStrippedString] = {}
+        for curCellHeaderIndex in range(1, len(FIRMWARE_TABLE_HEADERS)):
+            curCellHeader = FIRMWARE_TABLE_HEADERS[curCellHeaderIndex]
+            curTargetCell = curFirmwareLinkTableRowObj.select_one(f':scope > td:nth-child({curCellHeaderIndex + 1})')
+            if curCellHeader in FIRMWARE_LINK_TABLE_HEADERS:
+                curLinkObj = curTargetCell.select_one(':scope > p > a:nth-child(1)')
+                if curLinkObj is not None:
+                    foundCarrierFwFileLinks[curFirstCellStrippedString][curCellHeader] = urljoin(pageUrlToParse, curLinkObj['href'])
+            else:
+                foundCarrierFwFileLinks[curFirstCellStrippedString][curCellHeader] = list(curTargetCell.stripped_strings)[0]
+
+    return foundCarrierFwFileLinks
+
+
+def timeIt(methodToCall, iterations):
+    timeList = []
+    result = None
+    for _ in range(iterations):
+        startTime = time.perf_counter()
+        result = methodToCall()
+        timeList.append(time.perf_counter() - startTime)
+    return statistics.median(timeList), result
+
+
+if __name__ == '__main__':
+    iterations = DEFAULT_ITERATIONS
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    with open(FIXTURE_PAGE_PATH, 'r') as pageFile:
+        firmwarePageText = pageFile.read()
+    print(f'Page: {FIXTURE_PAGE_PATH} ({len(firmwarePageText)} bytes), {iterations} iterations')
+
+    parserTime, parserResult = timeIt(lambda: parseFirmwarePage(firmwarePageText, SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, MODEL_HEADER, DEFAULT_FIRMWARE_ORDER_LIST), iterations)
+    print(f'parseFirmwarePage:     {parserTime * 1000:8.2f} ms')
+
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print('BeautifulSoup is not installed; skipping the comparison')
+        sys.exit(0)
+
+    soupTime, soupResult = timeIt(lambda: parseFirmwarePageSoup(firmwarePageText, SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, MODEL_HEADER, DEFAULT_FIRMWARE_ORDER_LIST), iterations)
+    print(f'parseFirmwarePageSoup: {soupTime * 1000:8.2f} ms')
+    print(f'speedup: {soupTime / parserTime:.1f}x')
+
+    if soupResult != parserResult:
+        print(f'Results differ!\nparser: {parserResult}\nsoup:   {soupResult}')
+        sys.exit(1)
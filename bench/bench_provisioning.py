@@ -0,0 +1,167 @@
+#!/opt/modem_config/bin/python3
+'''
+Benchmark provisioning end to end against the simulated modem (see modem_sim.py): configureModem() on a factory fresh
+modem, again on the provisioned modem, in diff only mode after one setting drifted and again with nothing left to apply,
+then qmiResetModem() through qmicli and through the in-process QMI client, and modem_reset.resetModem().  Reports the
+wall time of each run and where it went (from the modem_trace spans)
+
+usage: bench_provisioning.py [time scale] [trace dir]
+    time scale: multiplier for the simulated modem delays (default 0.01)
+    trace dir:  write a Chrome trace of each run in here
+'''
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import modem_config
+import modem_reset
+import modem_trace
+import modem_usb
+from modem_firmware import KNOWN_FIRMWARE_SHA512, DEFAULT_FIRMWARE_ORDER_LIST
+from modem_sim import SimulatedModem, SIM_BIN_DIRPATH, SIM_SOCKET_ENV, SIM_FACTORY_CUSTOMS, DEFAULT_TIME_SCALE
+
+# how many span names to show per run
+REPORT_SPAN_COUNT = 12
+
+# spans that are just wrappers around the whole run
+REPORT_SKIPPED_SPANS = ['configureModem']
+
+
+def makeFakeFirmware(firmwareDirPath:str) -> dict:
+    '''
+    Write small stand-in .cwe/.nvu files, named like the real ones so the versions can be told from them
+
+    :return: carrierFileDict for configureModem()
+    '''
+    carrierFileDict = {}
+    for curZipName in KNOWN_FIRMWARE_SHA512:
+        curCarrierName, _, curFileName = curZipName.partition('@')
+        curBaseName = os.path.splitext(curFileName)[0]
+        curCarrierDirPath = os.path.join(firmwareDirPath, curCarrierName)
+        os.makedirs(curCarrierDirPath, exist_ok=True)
+        carrierFileDict[curCarrierName] = []
+        for curExtension in ['.cwe', '.nvu']:
+            curFilePath = os.path.join(curCarrierDirPath, curBaseName + curExtension)
+            with open(curFilePath, 'wb') as fakeFile:
+                fakeFile.write(curBaseName.encode('utf-8'))
+            carrierFileDict[curCarrierName].append(curFilePath)
+    return carrierFileDict
+
+
+class redirectOutput:
+    '''
+    Send everything written to stdout/stderr (ours and the child processes') to a file
+    '''
+    def __init__(self, filePath:str):
+        self.filePath = filePath
+        self.savedFdList = None
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.savedFdList = [os.dup(1), os.dup(2)]
+        with open(self.filePath, 'ab') as outputFile:
+            os.dup2(outputFile.fileno(), 1)
+            os.dup2(outputFile.fileno(), 2)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for curFd, curSavedFd in zip([1, 2], self.savedFdList):
+            os.dup2(curSavedFd, curFd)
+            os.close(curSavedFd)
+
+
+def summarizeSpans(eventList:list) -> list:
+    '''
+    :return: [(span name, count, total seconds)], the most time first
+    '''
+    spanDict = {}
+    for curEvent in eventList:
+        if curEvent.get('ph') != 'X' or curEvent['name'] in REPORT_SKIPPED_SPANS:
+            continue
+        curCount, curTotal = spanDict.get(curEvent['name'], (0, 0))
+        spanDict[curEvent['name']] = (curCount + 1, curTotal + curEvent['dur'] / 1000000)
+    return sorted(((curName, curCount, curTotal) for curName, (curCount, curTotal) in spanDict.items()), key=lambda curItem: -curItem[2])
+
+
+def runScenario(name:str, methodToCall, modem:SimulatedModem, workDirPath:str, traceDirPath:str=None) -> float:
+    traceFilePath = os.path.join(traceDirPath if traceDirPath is not None else workDirPath, name.replace(' ', '_') + '.json')
+    statsBefore = modem.stats.copy()
+
+    tracer = modem_trace.startTrace(traceFilePath)
+    startTime = time.monotonic()
+    error = None
+    try:
+        with redirectOutput(os.path.join(workDirPath, 'output.log')):
+            methodToCall()
+    except Exception as e:
+        error = e
+    wallTime = time.monotonic() - startTime
+    modem_trace.stopTrace()
+
+    print(f'\n{name}: {wallTime:.2f} s{"" if error is None else f" FAILED ({type(error).__name__}: {error})"}')
+    simStats = modem.stats - statsBefore
+    print('    modem: ' + ', '.join(f'{curName} {curCount}' for curName, curCount in sorted(simStats.items())))
+    for curName, curCount, curTotal in summarizeSpans(tracer.eventList)[:REPORT_SPAN_COUNT]:
+        print(f'    {curName:<28} {curCount:5d} x {curTotal:8.2f} s')
+
+    return wallTime
+
+
+if __name__ == '__main__':
+    timeScale = DEFAULT_TIME_SCALE
+    if len(sys.argv) > 1:
+        timeScale = float(sys.argv[1])
+    traceDirPath = None
+    if len(sys.argv) > 2:
+        traceDirPath = sys.argv[2]
+        os.makedirs(traceDirPath, exist_ok=True)
+
+    workDirPath = tempfile.mkdtemp(prefix='modem-sim-')
+    print(f'Simulated modem in {workDirPath} (time scale {timeScale}); tool output goes to {os.path.join(workDirPath, "output.log")}')
+
+    try:
+        with SimulatedModem(os.path.join(workDirPath, 'root'), timeScale=timeScale) as modem:
+            # point everything at the simulated modem
+            modem_usb.sysfsRoot = modem.sysfsRoot
+            modem_usb.devRoot = modem.devRoot
+            modem_usb.ueventSourceFactory = modem.openUeventSource
+            modem_usb.usbResetMethod = modem.resetUsb
+            os.environ[SIM_SOCKET_ENV] = modem.socketPath
+            os.environ['PATH'] = SIM_BIN_DIRPATH + os.pathsep + os.environ.get('PATH', '')
+            modem_config.qmicliBinaryPath = None
+            modem_config.qmiFlashBinaryPath = None
+
+            carrierFileDict = makeFakeFirmware(os.path.join(workDirPath, 'firmware'))
+
+            totalTime = 0
+            totalTime += runScenario('configureModem factory fresh', lambda: modem_config.configureModem(None, DEFAULT_FIRMWARE_ORDER_LIST, carrierFileDict=carrierFileDict), modem, workDirPath, traceDirPath)
+            # an old image in a slot we do not use has to go too (the modem could switch to it)
+            with modem.lock:
+                modem.firmwareSlots[4] = ('02.24.05.06_GENERIC', '002.026_000')
+                modem.priSet.add(('02.24.05.06_GENERIC', '002.026_000'))
+            totalTime += runScenario('configureModem re-provision', lambda: modem_config.configureModem(None, DEFAULT_FIRMWARE_ORDER_LIST, carrierFileDict=carrierFileDict), modem, workDirPath, traceDirPath)
+            # put one gps setting back to its factory value, so the diff has something to apply (and reset for)
+            with modem.lock:
+                modem.customs['GPSLPM'] = SIM_FACTORY_CUSTOMS['GPSLPM']
+            totalTime += runScenario('configureModem diff after drift', lambda: modem_config.configureModem(None, DEFAULT_FIRMWARE_ORDER_LIST, carrierFileDict=carrierFileDict, diffOnly=True), modem, workDirPath, traceDirPath)
+            # everything is applied now; this should not reset the modem
+            totalTime += runScenario('configureModem diff only', lambda: modem_config.configureModem(None, DEFAULT_FIRMWARE_ORDER_LIST, carrierFileDict=carrierFileDict, diffOnly=True), modem, workDirPath, traceDirPath)
+            totalTime += runScenario('qmiResetModem', lambda: modem_config.qmiResetModem(), modem, workDirPath, traceDirPath)
+            # let the modem come back from the reset before the next one
+            modem_config.waitForModemDevice()
+            modem_config.useQmiClient = True
+            totalTime += runScenario('qmiResetModem in-process', lambda: modem_config.qmiResetModem(), modem, workDirPath, traceDirPath)
+            modem_config.useQmiClient = False
+            modem_config.waitForModemDevice()
+            totalTime += runScenario('modem_reset resetModem', lambda: modem_reset.resetModem(), modem, workDirPath, traceDirPath)
+
+            print(f'\ntotal: {totalTime:.2f} s')
+    finally:
+        shutil.rmtree(workDirPath, ignore_errors=True)
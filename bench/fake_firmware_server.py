@@ -0,0 +1,313 @@
+#!/opt/modem_config/bin/python3
+'''
+Stand-in for the Sierra Wireless firmware download site, for running modem_firmware's downloads without the internet:
+    * a download page with a fw-table of the carriers that were added (what getFirmwareCatalog() parses)
+    * the carrier zips, with ETag/Last-Modified, byte ranges and If-Range like a real web server
+    * faults to put in on purpose: cut a response off part way, answer a file with an error status, or keep advertising
+      the old ETag of a changed file (like a stale CDN edge would)
+    * counters of what was asked for and sent (see FakeFirmwareServer.stats)
+'''
+import io
+import os
+import re
+import time
+import hashlib
+import zipfile
+import threading
+from collections import Counter
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import quote as urllib_quote
+
+FAKE_MODEL_HEADER = '7455'
+FAKE_PAGE_PATH = '/em_mc74xx-approved-fw-packages'
+FAKE_FILE_PATH_PREFIX = '/firmware/'
+
+# how much of a body is written at a time (and how often the per chunk delay applies)
+FAKE_SEND_CHUNK_SIZE = 65536
+
+FAKE_RANGE_REGEX = re.compile(r'^bytes=(?P<start>\d+)-(?P<end>\d*)$')
+
+
+def makeFakeFirmwareZip(priCarrierName:str, fwVersion:str, priVersion:str, cweSize:int) -> tuple:
+    '''
+    Make a zip laid out like the real carrier packages: a .cwe of random bytes and an .nvu named with the versions
+
+    :param priCarrierName: Carrier part of the file names, ie. Verizon or Generic
+    :return: (zip file name, zip bytes)
+    '''
+    baseName = f'SWI9X30C_{fwVersion}_{priCarrierName}_{priVersion}'
+    zipBuffer = io.BytesIO()
+    # stored, so the zip is about as big as asked for
+    with zipfile.ZipFile(zipBuffer, 'w', zipfile.ZIP_STORED) as zipFileObj:
+        zipFileObj.writestr(f'SWI9X30C_{fwVersion}.cwe', os.urandom(cweSize))
+        zipFileObj.writestr(f'{baseName}.nvu', os.urandom(4096))
+    return (f'{baseName}.zip', zipBuffer.getvalue())
+
+
+class FakeFirmwareFile:
+    '''
+    A file the server hands out
+
+    :param carrierName: The carrier row of the download page it is linked from (None if it is not on the page)
+    :param filename: The name the server sends in Content-Disposition
+    :param data: The file contents
+    '''
+    def __init__(self, carrierName:str, filename:str, data:bytes, version:int):
+        self.carrierName = carrierName
+        self.filename = filename
+        self.data = data
+        self.etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        self.lastModified = formatdate(version, usegmt=True)
+        # (etag, last modified) of the contents before the last change
+        self.previousValidators = None
+
+    @property
+    def sha512(self) -> str:
+        return hashlib.sha512(self.data).hexdigest()
+
+
+class FakeFirmwareRequestHandler(BaseHTTPRequestHandler):
+    # keep alive, so the client's connection pool gets used like with the real site
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        fakeServer = self.server.fakeServer
+        with fakeServer.lock:
+            fakeServer.stats['requests'] += 1
+            fakeServer.connectionSet.add(self.client_address)
+
+        if self.path == FAKE_PAGE_PATH:
+            self.sendPage()
+        elif self.path.startswith(FAKE_FILE_PATH_PREFIX) and self.path in fakeServer.fileDict:
+            self.sendFile(fakeServer.fileDict[self.path])
+        else:
+            self.sendStatus(404)
+
+    def sendStatus(self, statusCode:int) -> None:
+        self.send_response(statusCode)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def sendPage(self):
+        pageBytes = self.server.fakeServer.getPageText().encode('utf-8')
+        pageEtag = f'"{hashlib.sha256(pageBytes).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == pageEtag:
+            self.send_response(304)
+            self.send_header('ETag', pageEtag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(pageBytes)))
+        self.send_header('ETag', pageEtag)
+        self.end_headers()
+        self.wfile.write(pageBytes)
+
+    def sendFile(self, fakeFile:FakeFirmwareFile):
+        fakeServer = self.server.fakeServer
+        with fakeServer.lock:
+            failStatus = fakeServer.failDict.get(self.path)
+            staleValidators = fakeFile.previousValidators if self.path in fakeServer.stalePathSet else None
+        if failStatus is not None:
+            self.sendStatus(failStatus)
+            return
+
+        fileSize = len(fakeFile.data)
+        startByte = 0
+        endByte = fileSize - 1
+        isRange = False
+        rangeMatch = FAKE_RANGE_REGEX.match(self.headers.get('Range', ''))
+        if rangeMatch is not None:
+            with fakeServer.lock:
+                fakeServer.stats['rangeRequests'] += 1
+            ifRange = self.headers.get('If-Range')
+            # Note: If-Range is checked against the file as it is now, never the stale validators
+            if ifRange is not None and ifRange not in (fakeFile.etag, fakeFile.lastModified):
+                with fakeServer.lock:
+                    fakeServer.stats['ifRangeMismatches'] += 1
+            else:
+                startByte = int(rangeMatch.group('start'))
+                if rangeMatch.group('end') != '':
+                    endByte = min(int(rangeMatch.group('end')), fileSize - 1)
+                if startByte >= fileSize:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{fileSize}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                isRange = True
+
+        self.send_response(206 if isRange else 200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', f'attachment; filename="{fakeFile.filename}"')
+        self.send_header('Content-Length', str(endByte - startByte + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        etag, lastModified = staleValidators if staleValidators is not None else (fakeFile.etag, fakeFile.lastModified)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        if isRange:
+            self.send_header('Content-Range', f'bytes {startByte}-{endByte}/{fileSize}')
+        self.end_headers()
+
+        with fakeServer.lock:
+            # one shot: the next request for the same bytes goes through
+            dropAfterBytes = fakeServer.dropDict.pop((self.path, startByte), None)
+            fakeServer.activeBodies += 1
+            fakeServer.stats['maxActiveBodies'] = max(fakeServer.stats['maxActiveBodies'], fakeServer.activeBodies)
+        try:
+            sentBytes = 0
+            for curOffset in range(startByte, endByte + 1, FAKE_SEND_CHUNK_SIZE):
+                curChunk = fakeFile.data[curOffset:min(curOffset + FAKE_SEND_CHUNK_SIZE, endByte + 1)]
+                if dropAfterBytes is not None and sentBytes + len(curChunk) > dropAfterBytes:
+                    self.wfile.write(curChunk[:dropAfterBytes - sentBytes])
+                    sentBytes = dropAfterBytes
+                    with fakeServer.lock:
+                        fakeServer.stats['droppedBodies'] += 1
+                    # cut the connection off mid body
+                    self.close_connection = True
+                    break
+                self.wfile.write(curChunk)
+                sentBytes += len(curChunk)
+                if fakeServer.chunkDelay > 0:
+                    time.sleep(fakeServer.chunkDelay)
+            else:
+                with fakeServer.lock:
+                    fakeServer.stats['completeBodies'] += 1
+        except (BrokenPipeError, ConnectionResetError):
+            # the client had what it needed (ie. only the headers) and hung up
+            self.close_connection = True
+        finally:
+            with fakeServer.lock:
+                fakeServer.activeBodies -= 1
+                fakeServer.stats['bytesSent'] += sentBytes
+                if isRange:
+                    fakeServer.stats['rangeBytesSent'] += sentBytes
+
+
+class FakeFirmwareServer:
+    '''
+    The stand-in download site on a local port.  Use it as a context manager
+
+    :param chunkDelay: Seconds to wait after each FAKE_SEND_CHUNK_SIZE bytes of a body (to make the downloads take long
+                       enough to overlap)
+    '''
+    def __init__(self, chunkDelay:float=None):
+        if chunkDelay is None:
+            chunkDelay = 0
+
+        self.chunkDelay = chunkDelay
+
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.activeBodies = 0
+        self.connectionSet = set()
+        # url path -> FakeFirmwareFile
+        self.fileDict = {}
+        # url path -> status code to answer with
+        self.failDict = {}
+        # (url path, start byte) -> bytes to send before cutting the connection
+        self.dropDict = {}
+        # url paths whose full responses still advertise the validators of the contents before the last change
+        self.stalePathSet = set()
+        self.nextVersion = int(time.time()) - 86400
+
+        self.httpServer = None
+        self.serverThread = None
+
+    @property
+    def baseUrl(self) -> str:
+        return f'http://127.0.0.1:{self.httpServer.server_address[1]}'
+
+    @property
+    def pageUrl(self) -> str:
+        return self.baseUrl + FAKE_PAGE_PATH
+
+    def getFilePath(self, filename:str) -> str:
+        return FAKE_FILE_PATH_PREFIX + urllib_quote(filename)
+
+    def addFile(self, carrierName:str, filename:str, data:bytes) -> str:
+        '''
+        :param carrierName: Carrier row to link the file from on the download page (None to leave it off the page)
+        :return: The url path of the file
+        '''
+        filePath = self.getFilePath(filename)
+        with self.lock:
+            self.nextVersion += 1
+            self.fileDict[filePath] = FakeFirmwareFile(carrierName, filename, data, self.nextVersion)
+        return filePath
+
+    def changeFile(self, filePath:str, data:bytes) -> None:
+        '''
+        Give a file new contents (and so a new ETag and Last-Modified)
+        '''
+        with self.lock:
+            oldFile = self.fileDict[filePath]
+            self.nextVersion += 1
+            newFile = FakeFirmwareFile(oldFile.carrierName, oldFile.filename, data, self.nextVersion)
+            newFile.previousValidators = (oldFile.etag, oldFile.lastModified)
+            self.fileDict[filePath] = newFile
+
+    def failFile(self, filePath:str, statusCode:int=None) -> None:
+        with self.lock:
+            self.failDict[filePath] = statusCode if statusCode is not None else 500
+
+    def dropAfter(self, filePath:str, byteCount:int, startByte:int=None) -> None:
+        '''
+        Cut off the next response for filePath that starts at startByte (0 for a full response) after byteCount bytes
+        '''
+        with self.lock:
+            self.dropDict[(filePath, startByte if startByte is not None else 0)] = byteCount
+
+    def serveStaleValidators(self, filePath:str) -> None:
+        with self.lock:
+            self.stalePathSet.add(filePath)
+
+    def resetStats(self) -> Counter:
+        '''
+        :return: The counters so far; they start over from here
+        '''
+        with self.lock:
+            statsSoFar = self.stats
+            statsSoFar['connections'] = len(self.connectionSet)
+            self.stats = Counter()
+            self.connectionSet = set()
+        return statsSoFar
+
+    def getPageText(self) -> str:
+        with self.lock:
+            pageFileList = [curFile for curFile in self.fileDict.values() if curFile.carrierName is not None]
+        rowList = []
+        for curFile in pageFileList:
+            rowList.append(
+                f'<tr><td>{curFile.carrierName}</td><td>{curFile.filename.split("_")[1]}</td><td>{curFile.filename.rsplit("_", 2)[1]}</td>'
+                f'<td><p><a href="{self.getFilePath(curFile.filename)}">{curFile.filename}</a></p></td>'
+                f'<td><p><a href="/exe/{curFile.filename}.exe">exe</a></p></td><td>-</td></tr>')
+        return (
+            '<html><body><h1>AirPrime EM/MC74xx approved firmware packages</h1>\n'
+            f'<table class="fw-table"><tbody><tr><td><strong>MC{FAKE_MODEL_HEADER}</strong></td></tr>\n'
+            + '\n'.join(rowList)
+            + '\n</tbody></table></body></html>\n')
+
+    def start(self) -> None:
+        self.httpServer = ThreadingHTTPServer(('127.0.0.1', 0), FakeFirmwareRequestHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.fakeServer = self
+        self.serverThread = threading.Thread(target=self.httpServer.serve_forever, name='fake-firmware-server', daemon=True)
+        self.serverThread.start()
+
+    def stop(self) -> None:
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+            self.httpServer = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,672 @@
+#!/opt/modem_config/bin/python3
+'''
+Simulated Sierra Wireless MC7455 for running the provisioning tools without the hardware:
+    * a fake sysfs and /dev tree (point modem_usb at it) that goes away and comes back whenever the modem resets
+    * an AT command responder on a pty behind the modem's AT tty, with the AT! commands configureModem() uses and
+      their reboot side effects
+    * uevents for the fake devices (use SimulatedModem.openUeventSource as modem_usb.ueventSourceFactory)
+    * a usb reset hook (use SimulatedModem.resetUsb as modem_usb.usbResetMethod)
+    * a control socket the stand-in qmicli and qmi-firmware-update in sim_bin/ hand their calls to
+    * a QMUX responder on a pty behind the modem's QMI device, for modem_qmi.QmiClient
+Delays are roughly the real ones times a time scale
+'''
+import os
+import sys
+import tty
+import json
+import time
+import queue
+import select
+import shutil
+import socket
+import struct
+import termios
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from collections import Counter
+from modem_firmware import getCarrierImageVersion
+from modem_qmi import QmiMessage, packQmiMessage, parseQmiMessage, splitQmuxFrame, QMI_SERVICE_CTL, QMI_SERVICE_DMS, QMI_CTL_GET_CLIENT_ID, QMI_CTL_RELEASE_CLIENT_ID, QMI_DMS_GET_REVISION, QMI_DMS_VALIDATE_SERVICE_PROGRAMMING_CODE, QMI_DMS_SET_OPERATING_MODE, QMI_DMS_RESTORE_FACTORY_DEFAULTS, QMI_DMS_SWI_GET_USB_COMPOSITION, QMI_DMS_SWI_SET_USB_COMPOSITION, QMI_CTL_FLAG_RESPONSE, QMI_SERVICE_FLAG_RESPONSE, QMI_RESULT_TLV, QMI_RESULT_FORMAT, DMS_OPERATING_MODES
+
+SIM_BIN_DIRPATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'sim_bin')
+# where the stand-in tools find the control socket
+SIM_SOCKET_ENV = 'MODEM_SIM_SOCKET'
+
+# roughly what the real modem takes (seconds); scaled by the time scale
+SIM_BOOT_TIME = 20
+SIM_USB_RESET_TIME = 3
+# from a reset command being accepted to the modem dropping off usb
+SIM_RESET_DELAY = 1
+SIM_FLASH_TIME = 60
+SIM_QMICLI_TIME = 0.5
+SIM_QMI_RESPONSE_TIME = 0.05
+SIM_AT_RESPONSE_TIME = 0.05
+# AT!CUSTOM settings make the modem reboot itself once the AT port has been quiet this long
+SIM_CUSTOM_REBOOT_IDLE_TIME = 2
+
+DEFAULT_TIME_SCALE = 0.01
+
+SIM_UNLOCK_PASSWORD = 'A710'
+SIM_FIRMWARE_SLOT_COUNT = 4
+
+# usb interface number -> tty name; the qmi interface is separate
+SIM_TTY_INTERFACES = {0: 'ttyUSB0', 2: 'ttyUSB1', 3: 'ttyUSB2'}
+SIM_AT_INTERFACE = 3
+SIM_QMI_INTERFACE = 8
+SIM_QMI_DEV_NAME = 'cdc-wdm0'
+
+SIM_REVISION = 'SWI9X30C_02.33.03.00 r8209 CARMD-EV-FRMWR2 2019/08/28 20:59:30'
+SIM_USB_COMPOSITIONS = [6, 8, 9]
+SIM_SERVICE_PROG_CODE = '000000'
+
+# QMI protocol errors the simulator answers with
+SIM_QMI_ERROR_INVALID_CLIENT_ID = 0x07
+SIM_QMI_ERROR_INVALID_ARGUMENT = 0x30
+SIM_QMI_ERROR_INVALID_QMI_COMMAND = 0x47
+
+# NV settings after AT!RMARESET=1 (command name -> value as it was set)
+SIM_FACTORY_SETTINGS = {
+    'IMPREF': '"GENERIC"',
+    'USBCOMP': '1,1,0000100D',
+    'LTECA': '0',
+    'BAND': '00',
+    'GPSXTRADATAENABLE': '0,0,0,0,0',
+    'GPSPOSMODE': '7F',
+    'GPSSUPLURL': '"supl.sierrawireless.com:7275"',
+    'GPSTRANSSEC': '1',
+    'GPSSUPLVER': '1',
+    'GPSNMEASENTENCE': '29FF',
+    'GPSAUTOSTART': '1,1,255,4294967280,1',
+}
+SIM_FACTORY_CUSTOMS = {'GPSLPM': 0, 'GPSSEL': 0}
+
+# settings that reset other settings when applied (see modem_config.DesiredAtSetting.resetBy)
+SIM_SETTING_RESETS = {'GPSXTRADATAENABLE': ['GPSPOSMODE']}
+
+
+def formatUsbcomp(value:str) -> list:
+    return ['Config Index: 1', f'Interface bitmask: {value.split(",")[-1]} (diag,nmea,modem,rmnet0)']
+
+
+# how AT!<name>? shows a setting, if not just !<name>: <value>
+SIM_QUERY_FORMATS = {
+    'IMPREF': lambda value: ['preferred fw version:    000.000.000.000', f'preferred carrier name: {value.strip(chr(34))}'],
+    'USBCOMP': formatUsbcomp,
+    'BAND': lambda value: ['Index, Name', f'{value}, All bands'],
+    'GPSSUPLURL': lambda value: [value.strip('"')],
+}
+
+
+class SimUeventSource:
+    '''
+    uevent source fed by the simulated modem (same receive()/close() as modem_usb.NetlinkUeventSource)
+    '''
+    def __init__(self, modem):
+        self.modem = modem
+        self.eventQueue = queue.Queue()
+        modem.addUeventQueue(self.eventQueue)
+
+    def receive(self, timeout:float) -> dict:
+        try:
+            return self.eventQueue.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.modem.removeUeventQueue(self.eventQueue)
+
+
+class SimulatedModem:
+    '''
+    One simulated modem.  Call start() to plug it in and stop() when done
+
+    :param rootDirPath: Where to build the fake tree; sysfsRoot and devRoot are under it
+    :param timeScale: Multiplier for the simulated delays (ie. 0.01 makes a 20 second boot take 0.2 seconds)
+    '''
+    def __init__(self, rootDirPath:str, timeScale:float=None, vid:str=None, pid:str=None, portPath:str=None, busnum:int=None, serial:str=None):
+        if timeScale is None:
+            timeScale = DEFAULT_TIME_SCALE
+        if vid is None:
+            vid = '1199'
+        if pid is None:
+            pid = '9071'
+        if portPath is None:
+            portPath = '1-1'
+        if busnum is None:
+            busnum = 1
+        if serial is None:
+            serial = 'SIM0000000001'
+
+        self.rootDirPath = rootDirPath
+        self.timeScale = timeScale
+        self.vid = vid
+        self.pid = pid
+        self.portPath = portPath
+        self.busnum = busnum
+        self.serial = serial
+
+        self.sysfsRoot = os.path.join(rootDirPath, 'sys')
+        self.devRoot = os.path.join(rootDirPath, 'dev')
+        self.socketPath = os.path.join(rootDirPath, 'sim.sock')
+        self.usbDeviceDirPath = os.path.join(self.sysfsRoot, 'devices', f'usb{busnum}', portPath)
+        self.usbDeviceLinkPath = os.path.join(self.sysfsRoot, 'bus', 'usb', 'devices', portPath)
+
+        self.lock = threading.RLock()
+        self.stopEvent = threading.Event()
+        self.threadList = []
+        self.ueventQueueList = []
+        self.stats = Counter()
+
+        self.present = False
+        self.devnum = 1
+        self.unlocked = False
+        self.rebootPending = False
+        self.rebootAgainOnBoot = False
+        self.lastAtCommandTime = 0
+        self.customRebootPending = False
+        # (service, client id) of the QMI clients; the modem forgets them when it reboots
+        self.qmiClientIdSet = set()
+        self.nextQmiClientId = 1
+
+        # NV state; survives reboots
+        self.settings = dict(SIM_FACTORY_SETTINGS)
+        self.customs = dict(SIM_FACTORY_CUSTOMS)
+        self.usbComposition = 6
+        # slot index -> (build id, PRI version)
+        self.firmwareSlots = {}
+        # (build id, PRI version) of every PRI on the modem
+        self.priSet = set()
+
+        self.atMasterFd = None
+        self.atSlaveFd = None
+        self.qmiMasterFd = None
+        self.qmiSlaveFd = None
+        self.serverSock = None
+
+    def scaled(self, seconds:float) -> float:
+        return seconds * self.timeScale
+
+    def start(self) -> None:
+        os.makedirs(os.path.dirname(self.usbDeviceLinkPath), exist_ok=True)
+        os.makedirs(os.path.join(self.devRoot, 'bus', 'usb', f'{self.busnum:03d}'), exist_ok=True)
+
+        # the AT and QMI ports are ptys so they are real char devices with their own major:minor
+        self.atMasterFd, self.atSlaveFd = os.openpty()
+        tty.setraw(self.atSlaveFd)
+        self.qmiMasterFd, self.qmiSlaveFd = os.openpty()
+        tty.setraw(self.qmiSlaveFd)
+
+        self.serverSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.serverSock.bind(self.socketPath)
+        self.serverSock.listen(8)
+        self.serverSock.settimeout(0.1)
+
+        for curTarget in [self.runAtResponder, self.runQmiResponder, self.runControlServer]:
+            curThread = threading.Thread(target=curTarget, name=f'sim-{curTarget.__name__}', daemon=True)
+            curThread.start()
+            self.threadList.append(curThread)
+
+        self.bringUp()
+
+    def stop(self) -> None:
+        self.stopEvent.set()
+        for curThread in self.threadList:
+            curThread.join()
+        with self.lock:
+            if self.present:
+                self.takeDown()
+        self.serverSock.close()
+        for curFd in [self.atMasterFd, self.atSlaveFd, self.qmiMasterFd, self.qmiSlaveFd]:
+            os.close(curFd)
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # ---- usb side ----
+
+    def openUeventSource(self) -> SimUeventSource:
+        return SimUeventSource(self)
+
+    def addUeventQueue(self, eventQueue:queue.Queue) -> None:
+        with self.lock:
+            self.ueventQueueList.append(eventQueue)
+
+    def removeUeventQueue(self, eventQueue:queue.Queue) -> None:
+        with self.lock:
+            if eventQueue in self.ueventQueueList:
+                self.ueventQueueList.remove(eventQueue)
+
+    def sendUevents(self, action:str) -> None:
+        devPath = f'/devices/usb{self.busnum}/{self.portPath}'
+        ueventList = [{'ACTION': action, 'SUBSYSTEM': 'usb', 'DEVPATH': devPath, 'PRODUCT': f'{int(self.vid, 16):x}/{int(self.pid, 16):x}/6', 'DEVTYPE': 'usb_device'}]
+        ueventList += [{'ACTION': action, 'SUBSYSTEM': 'tty', 'DEVPATH': f'{devPath}/{self.portPath}:1.{curIface}/{curTtyName}/tty/{curTtyName}', 'DEVNAME': curTtyName} for curIface, curTtyName in SIM_TTY_INTERFACES.items()]
+        ueventList.append({'ACTION': action, 'SUBSYSTEM': 'usbmisc', 'DEVPATH': f'{devPath}/{self.portPath}:1.{SIM_QMI_INTERFACE}/usbmisc/{SIM_QMI_DEV_NAME}', 'DEVNAME': SIM_QMI_DEV_NAME})
+        for curQueue in self.ueventQueueList:
+            for curUevent in ueventList:
+                curQueue.put(dict(curUevent))
+
+    def getCharDevLinkPath(self, fd:int) -> str:
+        fdStat = os.fstat(fd)
+        return os.path.join(self.sysfsRoot, 'dev', 'char', f'{os.major(fdStat.st_rdev)}:{os.minor(fdStat.st_rdev)}')
+
+    def writeAttrs(self, dirPath:str, attrDict:dict) -> None:
+        os.makedirs(dirPath, exist_ok=True)
+        for curName, curValue in attrDict.items():
+            with open(os.path.join(dirPath, curName), 'w') as attrFile:
+                attrFile.write(f'{curValue}\n')
+
+    def bringUp(self) -> None:
+        '''
+        Enumerate on usb: the device, its interfaces and their device files appear, then the uevents go out
+        '''
+        with self.lock:
+            self.devnum += 1
+            self.writeAttrs(self.usbDeviceDirPath, {'idVendor': self.vid, 'idProduct': self.pid, 'busnum': self.busnum, 'devnum': self.devnum, 'serial': self.serial})
+
+            for curIface, curTtyName in SIM_TTY_INTERFACES.items():
+                curIfacePath = os.path.join(self.usbDeviceDirPath, f'{self.portPath}:1.{curIface}')
+                self.writeAttrs(curIfacePath, {'bInterfaceNumber': f'{curIface:02x}'})
+                os.makedirs(os.path.join(curIfacePath, curTtyName), exist_ok=True)
+                curDevPath = os.path.join(self.devRoot, curTtyName)
+                if curIface == SIM_AT_INTERFACE:
+                    os.symlink(os.ttyname(self.atSlaveFd), curDevPath)
+                    self.linkCharDev(self.atSlaveFd, curIfacePath)
+                else:
+                    open(curDevPath, 'w').close()
+
+            qmiIfacePath = os.path.join(self.usbDeviceDirPath, f'{self.portPath}:1.{SIM_QMI_INTERFACE}')
+            self.writeAttrs(qmiIfacePath, {'bInterfaceNumber': f'{SIM_QMI_INTERFACE:02x}'})
+            os.makedirs(os.path.join(qmiIfacePath, 'usbmisc', SIM_QMI_DEV_NAME), exist_ok=True)
+            os.symlink(os.ttyname(self.qmiSlaveFd), os.path.join(self.devRoot, SIM_QMI_DEV_NAME))
+            self.linkCharDev(self.qmiSlaveFd, qmiIfacePath)
+
+            open(self.getUsbDevNodePath(), 'w').close()
+
+            # last, so nobody finds the device before everything of it is there
+            os.symlink(self.usbDeviceDirPath, self.usbDeviceLinkPath)
+            self.present = True
+            self.stats['enumerations'] += 1
+            self.sendUevents('add')
+
+    def linkCharDev(self, fd:int, ifacePath:str) -> None:
+        charDevLinkPath = self.getCharDevLinkPath(fd)
+        os.makedirs(charDevLinkPath, exist_ok=True)
+        os.symlink(ifacePath, os.path.join(charDevLinkPath, 'device'))
+
+    def getUsbDevNodePath(self) -> str:
+        return os.path.join(self.devRoot, 'bus', 'usb', f'{self.busnum:03d}', f'{self.devnum:03d}')
+
+    def takeDown(self) -> None:
+        '''
+        Drop off usb: everything of the device goes away
+        '''
+        with self.lock:
+            self.present = False
+            self.unlocked = False
+            os.remove(self.usbDeviceLinkPath)
+            for curTtyName in SIM_TTY_INTERFACES.values():
+                os.remove(os.path.join(self.devRoot, curTtyName))
+            os.remove(os.path.join(self.devRoot, SIM_QMI_DEV_NAME))
+            os.remove(self.getUsbDevNodePath())
+            for curFd in [self.atSlaveFd, self.qmiSlaveFd]:
+                shutil.rmtree(self.getCharDevLinkPath(curFd))
+            shutil.rmtree(self.usbDeviceDirPath)
+            # whatever was on its way to or from the old AT and QMI ports is lost
+            termios.tcflush(self.atSlaveFd, termios.TCIOFLUSH)
+            termios.tcflush(self.qmiSlaveFd, termios.TCIOFLUSH)
+            self.qmiClientIdSet = set()
+            self.sendUevents('remove')
+
+    def reboot(self, delay:float=None, usbOnly:bool=None) -> None:
+        '''
+        Reboot in the background: drop off usb after delay (seconds, before scaling) and come back after booting
+
+        :param usbOnly: Only re-enumerate on usb (a usb reset); the modem itself keeps running
+        '''
+        if delay is None:
+            delay = SIM_RESET_DELAY
+        if usbOnly is None:
+            usbOnly = False
+
+        with self.lock:
+            if self.rebootPending:
+                return
+            self.rebootPending = True
+            self.stats['reenumerations' if usbOnly else 'reboots'] += 1
+
+        def runReboot():
+            time.sleep(self.scaled(delay))
+            with self.lock:
+                if self.present:
+                    self.takeDown()
+            time.sleep(self.scaled(SIM_USB_RESET_TIME if usbOnly else SIM_BOOT_TIME))
+            with self.lock:
+                self.rebootPending = False
+                self.bringUp()
+                rebootAgain = False
+                if not usbOnly:
+                    rebootAgain = self.rebootAgainOnBoot
+                    self.rebootAgainOnBoot = False
+            # Note: after a factory reset the modem comes up once and then reboots again on its own
+            if rebootAgain:
+                self.reboot()
+
+        threading.Thread(target=runReboot, name='sim-reboot', daemon=True).start()
+
+    def resetUsb(self, devNodePath:str) -> None:
+        '''
+        Stand-in for the USBDEVFS_RESET ioctl on the usb device node
+        '''
+        with self.lock:
+            if not self.present or devNodePath != self.getUsbDevNodePath():
+                raise FileNotFoundError(f'No such usb device node: {devNodePath}')
+            self.stats['usbResets'] += 1
+        # a usb reset re-enumerates the device; it does not reboot the modem
+        self.reboot(delay=0, usbOnly=True)
+
+    # ---- AT side ----
+
+    def runAtResponder(self) -> None:
+        inputBuffer = b''
+        while not self.stopEvent.is_set():
+            readyList, _, _ = select.select([self.atMasterFd], [], [], 0.05)
+
+            with self.lock:
+                if (self.customRebootPending and self.present
+                        and time.monotonic() - self.lastAtCommandTime > self.scaled(SIM_CUSTOM_REBOOT_IDLE_TIME)):
+                    self.customRebootPending = False
+                    self.reboot(delay=0)
+
+            if len(readyList) < 1:
+                continue
+            try:
+                inputBuffer += os.read(self.atMasterFd, 4096)
+            except OSError:
+                continue
+
+            while b'\r' in inputBuffer:
+                commandBytes, _, inputBuffer = inputBuffer.partition(b'\r')
+                command = commandBytes.decode('utf-8', errors='replace').strip()
+                with self.lock:
+                    # a modem that is not on usb does not answer
+                    if not self.present or command == '':
+                        continue
+                    self.lastAtCommandTime = time.monotonic()
+                time.sleep(self.scaled(SIM_AT_RESPONSE_TIME))
+                with self.lock:
+                    if not self.present:
+                        continue
+                    lineList, finalResult = self.handleAtCommand(command)
+                responseText = f'{command}\r\r\n' + ''.join(f'{curLine}\r\n' for curLine in lineList) + f'\r\n{finalResult}\r\n'
+                os.write(self.atMasterFd, responseText.encode('utf-8'))
+
+    def handleAtCommand(self, command:str) -> tuple:
+        '''
+        :return: ([response line], final result)
+        '''
+        self.stats['atCommands'] += 1
+        if command[:2].upper() != 'AT':
+            return ([], 'ERROR')
+        if len(command) == 2:
+            return ([], 'OK')
+
+        # chained commands (AT!A=1;!B=2) stop at the first one that fails
+        lineList = []
+        for curBody in command[2:].split(';'):
+            curLines, curResult = self.handleAtBody(curBody.strip())
+            lineList += curLines
+            if curResult != 'OK':
+                return (lineList, curResult)
+        return (lineList, 'OK')
+
+    def handleAtBody(self, body:str) -> tuple:
+        upperBody = body.upper()
+
+        if upperBody.startswith('!ENTERCND='):
+            if body.split('=', 1)[1].strip('"') != SIM_UNLOCK_PASSWORD:
+                return ([], 'ERROR')
+            self.unlocked = True
+            return ([], 'OK')
+
+        if upperBody == '!IMAGE?':
+            return (self.formatImageList(), 'OK')
+
+        if not upperBody.startswith('!'):
+            return ([], 'ERROR')
+
+        # everything else, queries included, needs AT!ENTERCND first
+        if not self.unlocked:
+            return ([], '+CME ERROR: 3')
+
+        isQuery = upperBody.endswith('?')
+        name, _, value = body[1:].rstrip('?').partition('=')
+        name = name.upper()
+
+        if name == 'CUSTOM' and isQuery:
+            return (['!CUSTOM:'] + [f'    {curName:<12}0x{curValue:02x}' for curName, curValue in sorted(self.customs.items()) if curValue != 0], 'OK')
+
+        if isQuery:
+            if name not in self.settings:
+                return ([], 'ERROR')
+            formatMethod = SIM_QUERY_FORMATS.get(name, lambda curValue: [f'!{name}: {curValue}'])
+            return (formatMethod(self.settings[name]), 'OK')
+
+        if name == 'IMAGE':
+            return self.handleImageDelete(value)
+
+        if name == 'RMARESET':
+            self.settings = dict(SIM_FACTORY_SETTINGS)
+            self.customs = dict(SIM_FACTORY_CUSTOMS)
+            self.rebootAgainOnBoot = True
+            self.stats['factoryResets'] += 1
+            # Note: the real modem ends this one with ERROR too
+            return (['!RMARESET: DEVICE REBOOT REQUIRED', '', 'Items Restored:  2161', 'Items Deleted:   0'], 'ERROR')
+
+        if name == 'CUSTOM':
+            customName, _, customValue = value.partition(',')
+            self.customs[customName.strip('"').upper()] = int(customValue, 0)
+            # NV customizations make the modem reboot itself a moment later
+            self.customRebootPending = True
+            return ([], 'OK')
+
+        if name not in self.settings:
+            return ([], 'ERROR')
+        self.settings[name] = value
+        for curResetName in SIM_SETTING_RESETS.get(name, []):
+            self.settings[curResetName] = SIM_FACTORY_SETTINGS[curResetName]
+        return ([], 'OK')
+
+    def handleImageDelete(self, value:str) -> tuple:
+        # AT!IMAGE=0 deletes everything; AT!IMAGE=0,0,<slot> deletes one firmware slot
+        argList = [curArg.strip() for curArg in value.split(',')]
+        if argList[0] != '0':
+            return ([], 'ERROR')
+        if len(argList) == 1:
+            self.firmwareSlots = {}
+            self.priSet = set()
+        elif len(argList) == 3 and argList[1] == '0':
+            self.firmwareSlots.pop(int(argList[2]), None)
+        else:
+            return ([], 'ERROR')
+        return ([], 'OK')
+
+    def formatImageList(self) -> list:
+        lineList = ['TYPE SLOT STATUS LRU FAILURES UNIQUE_ID   BUILD_ID']
+        for curSlotIndex in range(1, SIM_FIRMWARE_SLOT_COUNT + 1):
+            curImage = self.firmwareSlots.get(curSlotIndex)
+            if curImage is None:
+                lineList.append(f'FW   {curSlotIndex}    EMPTY  0   0    0')
+            else:
+                lineList.append(f'FW   {curSlotIndex}    GOOD   {curSlotIndex}   0    0 ?_?         {curImage[0]}')
+        lineList += [f'Max FW images: {SIM_FIRMWARE_SLOT_COUNT}', 'Active FW image is at slot 1', '']
+        lineList.append('TYPE SLOT STATUS LRU FAILURES UNIQUE_ID   BUILD_ID')
+        for curBuildId, curPriVersion in sorted(self.priSet):
+            lineList.append(f'PRI  FF   GOOD   0   0    0 {curPriVersion} {curBuildId}')
+        lineList.append('Max PRI images: 50')
+        return lineList
+
+    # ---- QMI device ----
+
+    def runQmiResponder(self) -> None:
+        inputBuffer = b''
+        while not self.stopEvent.is_set():
+            readyList, _, _ = select.select([self.qmiMasterFd], [], [], 0.05)
+            if len(readyList) < 1:
+                continue
+            try:
+                inputBuffer += os.read(self.qmiMasterFd, 4096)
+            except OSError:
+                continue
+
+            while True:
+                frameBytes, inputBuffer = splitQmuxFrame(inputBuffer)
+                if frameBytes is None:
+                    break
+                with self.lock:
+                    # a modem that is not on usb does not answer
+                    if not self.present:
+                        continue
+                time.sleep(self.scaled(SIM_QMI_RESPONSE_TIME))
+                with self.lock:
+                    if not self.present:
+                        continue
+                    response = self.handleQmiRequest(parseQmiMessage(frameBytes))
+                os.write(self.qmiMasterFd, packQmiMessage(response))
+
+    def handleQmiRequest(self, request:QmiMessage) -> QmiMessage:
+        self.stats['qmiRequests'] += 1
+        responseFlags = QMI_CTL_FLAG_RESPONSE if request.service == QMI_SERVICE_CTL else QMI_SERVICE_FLAG_RESPONSE
+        response = QmiMessage(request.service, request.clientId, request.transactionId, request.messageId, flags=responseFlags, fromService=True)
+
+        errorCode = 0
+        if request.service == QMI_SERVICE_CTL:
+            if request.messageId == QMI_CTL_GET_CLIENT_ID:
+                clientId = self.nextQmiClientId
+                self.nextQmiClientId = self.nextQmiClientId % 0xFF + 1
+                self.qmiClientIdSet.add((request.tlvs[0x01][0], clientId))
+                response.tlvs[0x01] = bytes([request.tlvs[0x01][0], clientId])
+                self.stats['qmiClientIds'] += 1
+            elif request.messageId == QMI_CTL_RELEASE_CLIENT_ID:
+                self.qmiClientIdSet.discard((request.tlvs[0x01][0], request.tlvs[0x01][1]))
+                response.tlvs[0x01] = request.tlvs[0x01]
+            else:
+                errorCode = SIM_QMI_ERROR_INVALID_QMI_COMMAND
+        elif (request.service, request.clientId) not in self.qmiClientIdSet:
+            errorCode = SIM_QMI_ERROR_INVALID_CLIENT_ID
+        elif request.service != QMI_SERVICE_DMS:
+            errorCode = SIM_QMI_ERROR_INVALID_QMI_COMMAND
+        elif request.messageId == QMI_DMS_SET_OPERATING_MODE:
+            if request.tlvs[0x01][0] == DMS_OPERATING_MODES['reset']:
+                self.reboot()
+        elif request.messageId == QMI_DMS_GET_REVISION:
+            response.tlvs[0x01] = SIM_REVISION.encode('utf-8')
+        elif request.messageId == QMI_DMS_SWI_GET_USB_COMPOSITION:
+            response.tlvs[0x10] = bytes([self.usbComposition])
+            response.tlvs[0x11] = bytes([len(SIM_USB_COMPOSITIONS)] + SIM_USB_COMPOSITIONS)
+        elif request.messageId == QMI_DMS_SWI_SET_USB_COMPOSITION:
+            self.usbComposition = request.tlvs[0x01][0]
+        elif request.messageId in [QMI_DMS_VALIDATE_SERVICE_PROGRAMMING_CODE, QMI_DMS_RESTORE_FACTORY_DEFAULTS]:
+            if request.tlvs[0x01].decode('ascii') != SIM_SERVICE_PROG_CODE:
+                errorCode = SIM_QMI_ERROR_INVALID_ARGUMENT
+            elif request.messageId == QMI_DMS_RESTORE_FACTORY_DEFAULTS:
+                self.settings = dict(SIM_FACTORY_SETTINGS)
+                self.customs = dict(SIM_FACTORY_CUSTOMS)
+        else:
+            errorCode = SIM_QMI_ERROR_INVALID_QMI_COMMAND
+
+        response.tlvs[QMI_RESULT_TLV] = struct.pack(QMI_RESULT_FORMAT, 0 if errorCode == 0 else 1, errorCode)
+        return response
+
+    # ---- qmi tools ----
+
+    def runControlServer(self) -> None:
+        while not self.stopEvent.is_set():
+            try:
+                clientSock, _ = self.serverSock.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=self.handleControlClient, args=(clientSock,), name='sim-tool', daemon=True).start()
+
+    def handleControlClient(self, clientSock:socket.socket) -> None:
+        with clientSock, clientSock.makefile('rwb') as clientFile:
+            requestDict = json.loads(clientFile.readline())
+            if requestDict['tool'] == 'qmi-firmware-update':
+                returnCode, outputText = self.handleFirmwareUpdate(requestDict['argv'])
+            else:
+                returnCode, outputText = self.handleQmicli(requestDict['argv'])
+            clientFile.write(json.dumps({'returncode': returnCode, 'output': outputText}).encode('utf-8') + b'\n')
+
+    def getQmiDevArg(self, argList:list) -> str:
+        for curIndex, curArg in enumerate(argList):
+            if curArg == '-d' and curIndex + 1 < len(argList):
+                return argList[curIndex + 1]
+            if curArg.startswith('--device=') or curArg.startswith('--cdc-wdm='):
+                return curArg.split('=', 1)[1]
+        return None
+
+    def isQmiDevPresent(self, qmiDevPath:str) -> bool:
+        with self.lock:
+            return self.present and qmiDevPath == os.path.join(self.devRoot, SIM_QMI_DEV_NAME)
+
+    def handleQmicli(self, argList:list) -> tuple:
+        qmiDevPath = self.getQmiDevArg(argList)
+        time.sleep(self.scaled(SIM_QMICLI_TIME))
+        if not self.isQmiDevPresent(qmiDevPath):
+            return (1, f"error: couldn't open the QmiDevice: Couldn't open the QMI device: {qmiDevPath}")
+
+        with self.lock:
+            self.stats['qmicli'] += 1
+            for curArg in argList:
+                if curArg == '--dms-set-operating-mode=offline':
+                    return (0, f'[{qmiDevPath}] Operating mode set successfully')
+                if curArg == '--dms-set-operating-mode=reset':
+                    self.reboot()
+                    return (0, f'[{qmiDevPath}] Operating mode set successfully')
+                if curArg.startswith('--dms-swi-set-usb-composition='):
+                    self.usbComposition = int(curArg.split('=', 1)[1])
+                    return (0, f'[{qmiDevPath}] Successfully set USB composition')
+                if curArg.startswith('--dms-validate-service-programming-code='):
+                    return (0, f'[{qmiDevPath}] Service programming code validated')
+                if curArg.startswith('--dms-restore-factory-defaults='):
+                    self.settings = dict(SIM_FACTORY_SETTINGS)
+                    self.customs = dict(SIM_FACTORY_CUSTOMS)
+                    return (0, f'[{qmiDevPath}] Factory defaults restored')
+
+        return (1, f'error: unsupported by the simulator: {argList}')
+
+    def handleFirmwareUpdate(self, argList:list) -> tuple:
+        qmiDevPath = self.getQmiDevArg(argList)
+        slotIndex = None
+        fileList = []
+        for curArg in argList:
+            if curArg.startswith('--modem-storage-index='):
+                slotIndex = int(curArg.split('=', 1)[1])
+            elif not curArg.startswith('-'):
+                fileList.append(curArg)
+
+        nvuFileList = [curFile for curFile in fileList if curFile.lower().endswith('.nvu')]
+        if slotIndex is None or len(nvuFileList) != 1 or not all(os.path.isfile(curFile) for curFile in fileList):
+            return (1, f'error: bad firmware update arguments: {argList}')
+        if not self.isQmiDevPresent(qmiDevPath):
+            return (1, f'error: cannot open {qmiDevPath}')
+
+        imageVersion = getCarrierImageVersion(nvuFileList[0])
+        if imageVersion is None:
+            return (1, f'error: can not tell the firmware version of {nvuFileList[0]}')
+
+        time.sleep(self.scaled(SIM_FLASH_TIME))
+        with self.lock:
+            self.firmwareSlots[slotIndex] = imageVersion
+            self.priSet.add(imageVersion)
+            self.stats['flashes'] += 1
+            # the modem boots into the new image once the download is done
+            self.reboot()
+
+        return (0, f'firmware update operation finished successfully (slot {slotIndex}: {imageVersion[0]})')
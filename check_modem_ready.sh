@@ -37,8 +37,16 @@ rm -f /tmp/xtra3grc.bin
 #  mmcli -m 0 --location-set-gps-refresh-rate=0 && \
 #  mmcli -m 0 --location-set-enable-signal
 
-GPS_DEV=$(find /dev -mindepth 1 -maxdepth 1 -type l -iname 'mm-gps*' | head -1)
-AT_DEV=$(find /dev -mindepth 1 -maxdepth 1 -type l -iname 'mm-at*' | head -1)
+# find the symlinks from 78-mm-tty-links.rules in one pass over /dev (no forks)
+GPS_DEV=''
+AT_DEV=''
+for dev_link in /dev/mm-*; do
+  [ -L "${dev_link}" ] || continue
+  case "${dev_link}" in
+    /dev/mm-gps*) [ -n "${GPS_DEV}" ] || GPS_DEV="${dev_link}" ;;
+    /dev/mm-at*) [ -n "${AT_DEV}" ] || AT_DEV="${dev_link}" ;;
+  esac
+done
 
 # TODO: Force aGPS by clearing data
 #cat /dev/ttyUSB2 &
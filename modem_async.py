@@ -0,0 +1,609 @@
+#!/opt/modem_config/bin/python3
+'''
+asyncio counterparts of the modem helpers in modem_config.py and modem_at.py: waiting for the modem, running qmicli and
+talking to the AT port.  Nothing in here blocks the event loop, so independent steps can overlap and any number of
+modems can be handled on one event loop without a thread each.  The sysfs lookups are still plain calls; they are quick
+
+    resultList = asyncio.run(runModemFleet(lambda deviceSpec: qmiResetModem(vidPid=deviceSpec)))
+'''
+import os
+import sys
+import time
+import codecs
+import asyncio
+import subprocess
+import serial
+from logging import Logger
+from typing import Callable, Any, Awaitable
+from modem_usb import UsbDevice, openUeventSource, closeUeventSource, ueventMatches, findUsbDevices, getWaitDeadline, getNextWaitInterval, WAIT_INITIAL_INTERVAL, WAIT_MAX_INTERVAL
+from modem_at import AT_FINAL_RESULT_REGEX, DEFAULT_AT_BAUD_RATE, DEFAULT_AT_WAIT_TIME, DEFAULT_UNLOCK_PASSWORD, UNLOCK_WAIT_TIME, AtResponse, AtCommandError, AtBatchError, parseAtResponse, getPortGeneration
+from modem_config import DEFAULT_DEVICE_VID_PID, DEFAULT_MODEM_WAIT_TIMEOUT, DEFAULT_MODEM_GONE_TIMEOUT, MODEM_GONE_POLL_INTERVAL, DEVICE_FILES_WAIT_TIMEOUT, NoUsbDeviceFoundError, UsbDeviceFoundError, ModemConfigResult, findSingleModem, findModemPortsOfType, checkModemPortMatches, getQmicliBinaryPath, getFleetDeviceSpecs
+from modem_trace import traced, currentSpan, startTrace, stopTrace
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+# how often to check a uevent source that has no fileno() to wait on (ie. a synthetic one)
+UEVENT_POLL_INTERVAL = 0.05
+
+AT_READ_SIZE = 4096
+
+
+@traced()
+async def runTool(args:list, check:bool=None, captureOutput:bool=None) -> subprocess.CompletedProcess:
+    '''
+    Run an external tool (ie. qmicli) without blocking the event loop; the async subprocess.run()
+
+    :param check: Raise subprocess.CalledProcessError if the tool fails (default)
+    :param captureOutput: Return what the tool printed (as text) instead of passing it through
+    '''
+    if check is None:
+        check = True
+    if captureOutput is None:
+        captureOutput = False
+
+    currentSpan().set('tool', os.path.basename(args[0]))
+    outputPipe = asyncio.subprocess.PIPE if captureOutput else None
+    process = await asyncio.create_subprocess_exec(*args, stdout=outputPipe, stderr=outputPipe)
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        # do not leave the tool running behind us
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if stdout is not None:
+        stdout = stdout.decode('utf-8', errors='replace')
+    if stderr is not None:
+        stderr = stderr.decode('utf-8', errors='replace')
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+async def waitForUevent(eventSource, vidPid, timeout:float) -> bool:
+    '''
+    Wait up to timeout seconds for a uevent that could be about vidPid (see modem_usb.ueventMatches())
+
+    :return: True if one arrived
+    '''
+    loop = asyncio.get_running_loop()
+    endTime = time.monotonic() + timeout
+
+    readyEvent = None
+    if hasattr(eventSource, 'fileno'):
+        readyEvent = asyncio.Event()
+        loop.add_reader(eventSource.fileno(), readyEvent.set)
+    try:
+        while True:
+            if readyEvent is not None:
+                readyEvent.clear()
+            # take everything that is there already
+            curUevent = eventSource.receive(0)
+            while curUevent is not None:
+                if ueventMatches(curUevent, vidPid):
+                    return True
+                curUevent = eventSource.receive(0)
+
+            remainingTime = endTime - time.monotonic()
+            if remainingTime <= 0:
+                return False
+
+            if readyEvent is None:
+                await asyncio.sleep(min(UEVENT_POLL_INTERVAL, remainingTime))
+                continue
+            try:
+                await asyncio.wait_for(readyEvent.wait(), remainingTime)
+            except asyncio.TimeoutError:
+                return False
+    finally:
+        if readyEvent is not None:
+            loop.remove_reader(eventSource.fileno())
+
+
+async def waitForUsbCondition(conditionFn:Callable[[], Any], timeout:float=None, pollInterval:float=None, vidPid=None, eventSource=None, deadline:float=None) -> Any:
+    '''
+    modem_usb.waitForUsbCondition() for the event loop: same backoff and deadline, but the uevents are waited for
+    without blocking.  conditionFn is a plain method; it is called on the event loop
+    '''
+    if pollInterval is None:
+        pollInterval = WAIT_MAX_INTERVAL
+
+    startTime = time.monotonic()
+    deadline = getWaitDeadline(timeout, deadline)
+
+    ownsEventSource = eventSource is None
+    if ownsEventSource and deadline > startTime:
+        eventSource = openUeventSource()
+
+    waitSpan = currentSpan()
+    try:
+        curInterval = min(WAIT_INITIAL_INTERVAL, pollInterval)
+        while True:
+            conditionValue = conditionFn()
+            waitSpan.count('checks')
+            if conditionValue is not None:
+                return conditionValue
+
+            remainingTime = deadline - time.monotonic()
+            if remainingTime <= 0:
+                return None
+
+            if eventSource is None:
+                await asyncio.sleep(min(curInterval, remainingTime))
+                curInterval = getNextWaitInterval(curInterval, pollInterval)
+            elif await waitForUevent(eventSource, vidPid, min(curInterval, remainingTime)):
+                # things are happening; look closely again
+                curInterval = min(WAIT_INITIAL_INTERVAL, pollInterval)
+            else:
+                curInterval = getNextWaitInterval(curInterval, pollInterval)
+    finally:
+        waitSeconds = time.monotonic() - startTime
+        waitSpan.set('waitSeconds', round(waitSeconds, 3))
+        logger.debug(f'Waited {waitSeconds:.2f} s for {getattr(conditionFn, "__name__", "condition")}')
+        if ownsEventSource:
+            closeUeventSource(eventSource)
+
+
+@traced()
+async def waitForModem(vidPid=None, timeout:float=None, deadline:float=None, eventSource=None) -> UsbDevice:
+    '''
+    See modem_config.waitForModem()
+    '''
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
+
+    def findModem():
+        return findSingleModem(vidPid)
+
+    startTime = time.monotonic()
+    foundDevice = await waitForUsbCondition(findModem, timeout=timeout, vidPid=vidPid, eventSource=eventSource, deadline=deadline)
+    if foundDevice is None:
+        raise NoUsbDeviceFoundError(f'No usb device found after {time.monotonic() - startTime:.1f} s')
+
+    return foundDevice
+
+
+async def waitForModemPorts(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None, portType:str=None) -> list:
+    '''
+    See modem_config.waitForModemPorts()
+    '''
+    if pickFirstDevice is None:
+        pickFirstDevice = False
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
+
+    deadline = getWaitDeadline(timeout, deadline)
+    await waitForModem(vidPid=vidPid, deadline=deadline)
+
+    def findPorts():
+        return findModemPortsOfType(vidPid, portType)
+
+    # the usb device can show up a moment before its drivers create the device files; give them a little extra time
+    matches = await waitForUsbCondition(findPorts, vidPid=vidPid, deadline=max(deadline, time.monotonic() + DEVICE_FILES_WAIT_TIMEOUT))
+    return checkModemPortMatches(matches, pickFirstDevice)
+
+
+@traced()
+async def waitForModemDevice(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None) -> str:
+    modemPorts = (await waitForModemPorts(vidPid=vidPid, timeout=timeout, deadline=deadline, pickFirstDevice=pickFirstDevice, portType='qmiDevPaths'))[0]
+    retDev = modemPorts.qmiDevPaths[0]
+
+    logger.debug(f'qmi device path: {retDev}')
+
+    return retDev
+
+
+@traced()
+async def waitForModemAtDevice(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None) -> str:
+    if pickFirstDevice is None:
+        pickFirstDevice = True
+
+    modemPorts = (await waitForModemPorts(vidPid=vidPid, timeout=timeout, deadline=deadline, pickFirstDevice=pickFirstDevice, portType='atDevPath'))[0]
+    retDev = modemPorts.atDevPath
+
+    logger.debug(f'at device path: {retDev}')
+
+    return retDev
+
+
+@traced()
+async def waitForModemGoneAfterCall(methodToCall:Callable[[], Awaitable], vidPid=None, timeout:float=None, pickFirstDevice:bool=None) -> None:
+    '''
+    Await methodToCall() and wait for the modem to drop off the usb bus; see modem_config.waitForModemGoneAfterCall()
+
+    :param methodToCall: Coroutine function that makes the modem go away
+    '''
+    if timeout is None:
+        timeout = DEFAULT_MODEM_GONE_TIMEOUT
+
+    await waitForModemDevice(vidPid=vidPid, pickFirstDevice=pickFirstDevice)
+
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
+
+    def isModemGone():
+        if len(findUsbDevices(vidPid)) > 0:
+            logger.debug('Waiting for modem to disappear from the usb bus ...')
+            return None
+        return True
+
+    # start listening before the call so we can not miss the device going away
+    eventSource = openUeventSource()
+    try:
+        await methodToCall()
+
+        startTime = time.monotonic()
+        if await waitForUsbCondition(isModemGone, timeout=timeout, pollInterval=MODEM_GONE_POLL_INTERVAL, vidPid=vidPid, eventSource=eventSource) is None:
+            raise UsbDeviceFoundError(f'Modem still there after {time.monotonic() - startTime:.1f} s')
+    finally:
+        closeUeventSource(eventSource)
+
+
+@traced()
+async def qmiResetModem(vidPid=None, timeout:float=None, pickFirstDevice:bool=None, offlineRetries:int=None, resetRetries:int=None) -> None:
+    if offlineRetries is None:
+        offlineRetries = 2
+    if resetRetries is None:
+        resetRetries = 3
+
+    qmicliPath = getQmicliBinaryPath()
+
+    modemDevPath = await waitForModemDevice(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
+
+    logger.debug('setting modem offline with QMI ...')
+    # Set modem offline if we can (maybe modem is already offline? if so just reset)
+    for curRetry in range(0, offlineRetries):
+        if curRetry > 0:
+            logger.debug(f'Retrying putting modem offline: {curRetry}')
+            currentSpan().count('offlineRetries')
+        try:
+            await runTool([qmicliPath, '-p', '-d', modemDevPath, '--dms-set-operating-mode=offline'])
+        except subprocess.CalledProcessError as e:
+            logger.warn(f'Could not put modem in offline mode: {e}')
+        else:
+            break
+
+    async def resetWithQmiCli():
+        for curRetry in range(0, resetRetries):
+            if curRetry > 0:
+                logger.debug(f'Retrying putting modem in reset: {curRetry}')
+                currentSpan().count('resetRetries')
+            try:
+                await runTool([qmicliPath, '-p', '-d', modemDevPath, '--dms-set-operating-mode=reset'])
+            except subprocess.CalledProcessError as e:
+                logger.warn(f'Could not put modem in reset: {e}')
+            else:
+                break
+        else:
+            raise RuntimeError('Failed to reset the modem')
+
+    logger.debug('Issuing qmi mode reset command now !!!')
+    await waitForModemGoneAfterCall(methodToCall=resetWithQmiCli, vidPid=vidPid, pickFirstDevice=pickFirstDevice)
+
+
+@traced()
+async def resetModem(vidPid=None, timeout:float=None, pickFirstDevice:bool=None) -> None:
+    await qmiResetModem(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
+
+
+@traced()
+async def setModemToQmiMode(vidPid=None, timeout:float=None, pickFirstDevice:bool=None) -> None:
+    qmicliPath = getQmicliBinaryPath()
+
+    modemDevPath = await waitForModemDevice(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
+
+    # USB composition 6: DM, NMEA, AT, QMI
+    await runTool([qmicliPath, '-p', '-d', modemDevPath, '--dms-swi-set-usb-composition=6'])
+
+
+@traced()
+async def qmiFactoryDefaultModem(serviceProgCode:str=None, vidPid=None, timeout:float=None) -> None:
+    if serviceProgCode is None:
+        serviceProgCode = '000000'
+
+    qmicliPath = getQmicliBinaryPath()
+
+    modemDevPath = await waitForModemDevice(vidPid=vidPid, timeout=timeout)
+
+    # Verify the programming code is correct (just in case; this helps debug)
+    await runTool([qmicliPath, '-p', '-d', modemDevPath, f'--dms-validate-service-programming-code={serviceProgCode}'])
+
+    # Reset the modem to factory defaults
+    await runTool([qmicliPath, '-p', '-d', modemDevPath, f'--dms-restore-factory-defaults={serviceProgCode}'])
+
+
+class AtTimeoutError(RuntimeError):
+    ...
+
+
+class AsyncAtSession:
+    '''
+    modem_at.AtSession for the event loop.  The port is read by a reader callback on the event loop instead of pexpect;
+    it is (re)opened lazily if the modem reset since the last command, and privileged mode is remembered per modem boot.
+    Commands from several tasks are sent one at a time
+
+    :param devPathResolver: Coroutine function that returns the AT port device path, waiting for it if needed
+                            (ie. lambda: waitForModemAtDevice(vidPid=vidPid))
+    :param unlockPassword: Password for AT!ENTERCND
+    :param logfile: Where to echo what the modem sends
+    '''
+    def __init__(self, devPathResolver:Callable[[], Awaitable], unlockPassword:str=None, baudRate:int=None, logfile=None):
+        if unlockPassword is None:
+            unlockPassword = DEFAULT_UNLOCK_PASSWORD
+        if baudRate is None:
+            baudRate = DEFAULT_AT_BAUD_RATE
+        if logfile is None:
+            logfile = sys.stdout
+
+        self.devPathResolver = devPathResolver
+        self.unlockPassword = unlockPassword
+        self.baudRate = baudRate
+        self.logfile = logfile
+
+        self.devPath = None
+        self.serialObj = None
+        self.portFd = None
+        self.loop = None
+        self.generation = None
+        self.unlockedGeneration = None
+
+        self.readBuffer = ''
+        self.readDecoder = None
+        self.readError = None
+        self.dataEvent = None
+
+        self.connectLock = asyncio.Lock()
+        self.commandLock = asyncio.Lock()
+
+    def isStale(self) -> bool:
+        if self.serialObj is None or self.readError is not None:
+            return True
+        # the modem went away or came back as a new device
+        return getPortGeneration(self.devPath) != self.generation
+
+    async def connect(self) -> None:
+        '''
+        Make sure the port is open and belongs to the modem as it is now; reconnects if the modem reset
+        '''
+        async with self.connectLock:
+            if not self.isStale():
+                return
+
+            if self.serialObj is not None:
+                logger.debug(f'AT port {self.devPath} went away; reconnecting')
+                self.close()
+
+            self.devPath = await self.devPathResolver()
+            self.generation = getPortGeneration(self.devPath)
+            # Note: pyserial is only used to set up the tty; reading is done on the event loop
+            self.serialObj = serial.Serial(self.devPath, self.baudRate, timeout=0)
+            self.portFd = self.serialObj.fileno()
+            self.readBuffer = ''
+            self.readDecoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            self.readError = None
+            self.dataEvent = asyncio.Event()
+            self.loop = asyncio.get_running_loop()
+            self.loop.add_reader(self.portFd, self.onReadable)
+            logger.debug(f'Opened AT port {self.devPath}')
+
+    def onReadable(self) -> None:
+        try:
+            data = os.read(self.portFd, AT_READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            data = b''
+            self.readError = e
+
+        if len(data) < 1:
+            # the port went away (ie. the modem reset); stop watching it
+            if self.readError is None:
+                self.readError = EOFError(f'AT port {self.devPath} closed')
+            self.loop.remove_reader(self.portFd)
+        else:
+            text = self.readDecoder.decode(data)
+            self.readBuffer += text
+            self.logfile.write(text)
+            self.logfile.flush()
+
+        self.dataEvent.set()
+
+    def close(self) -> None:
+        if self.serialObj is not None:
+            self.loop.remove_reader(self.portFd)
+            try:
+                self.serialObj.close()
+            except (OSError, serial.SerialException) as e:
+                # the device is most likely gone already
+                logger.debug(f'Error closing AT port {self.devPath}: {e}')
+        self.serialObj = None
+        self.portFd = None
+
+    async def readResponse(self, command:str, waitTime:float, expectedResponse=None) -> AtResponse:
+        '''
+        Wait for the final result code of command and take its response out of the read buffer
+        '''
+        endTime = time.monotonic() + waitTime
+        while True:
+            finalMatch = AT_FINAL_RESULT_REGEX.search(self.readBuffer)
+            if finalMatch is not None:
+                beforeText = self.readBuffer[:finalMatch.start()]
+                self.readBuffer = self.readBuffer[finalMatch.end():]
+                return parseAtResponse(command, beforeText, finalMatch.group(1))
+
+            if self.readError is not None:
+                raise ConnectionError(f'AT port {self.devPath} went away waiting for {command}; found before:\n{self.readBuffer}') from self.readError
+
+            remainingTime = endTime - time.monotonic()
+            if remainingTime <= 0:
+                raise AtTimeoutError(f'No final result code for {command}; expected response:\n{expectedResponse}\nfound before:\n{self.readBuffer}')
+
+            self.dataEvent.clear()
+            try:
+                await asyncio.wait_for(self.dataEvent.wait(), remainingTime)
+            except asyncio.TimeoutError:
+                pass
+
+    @traced()
+    async def sendAtCommand(self, command:str, expectedResponse=None, waitTime:float=None, sleepAfter:float=None, check:bool=None) -> AtResponse:
+        '''
+        See modem_at.getSendAtCommand()
+        '''
+        if waitTime is None:
+            waitTime = DEFAULT_AT_WAIT_TIME
+        if check is None:
+            check = True
+
+        async with self.commandLock:
+            await self.connect()
+            self.serialObj.write(f'{command}\r\n'.encode('utf-8'))
+            atResponse = await self.readResponse(command, waitTime, expectedResponse)
+        currentSpan().set('command', command)
+        currentSpan().set('finalResult', atResponse.finalResult)
+
+        if expectedResponse is None:
+            succeeded = atResponse.success
+        else:
+            succeeded = atResponse.contains(expectedResponse)
+        if check and not succeeded:
+            raise AtCommandError(f'{command} failed with {atResponse.finalResult}; expected response:\n{expectedResponse}\nfound:\n{atResponse.text}', atResponse)
+
+        if sleepAfter:
+            await asyncio.sleep(sleepAfter)
+
+        return atResponse
+
+    @traced()
+    async def sendBatch(self, commands:list, unlock:bool=None, waitTime:float=None) -> list:
+        '''
+        Send an ordered list of commands one by one and return one AtResponse per command.  Stops at the first command
+        that fails and raises AtBatchError saying which one it was.  Note: unlike AtSession.sendBatch(), this does not
+        chain commands
+        '''
+        if unlock is None:
+            unlock = False
+
+        if unlock:
+            await self.ensureUnlocked()
+
+        results = []
+        for curIndex, curCommand in enumerate(commands):
+            try:
+                results.append(await self.sendAtCommand(curCommand, waitTime=waitTime))
+            except AtCommandError as e:
+                results.append(e.response)
+                raise AtBatchError(f'Batch command {curIndex} ({curCommand}) failed with {e.response.finalResult}', curIndex, curCommand, results) from e
+        return results
+
+    @traced()
+    async def unlock(self) -> None:
+        '''
+        Unlock "privileged" commands on the modem
+        '''
+        await self.connect()
+        await self.sendAtCommand(f'AT!ENTERCND="{self.unlockPassword}"', waitTime=UNLOCK_WAIT_TIME)
+        self.unlockedGeneration = self.generation
+
+    async def ensureUnlocked(self) -> None:
+        '''
+        Unlock "privileged" commands unless they are already unlocked since the modem last booted
+        '''
+        await self.connect()
+        if self.unlockedGeneration != self.generation:
+            await self.unlock()
+        else:
+            logger.debug('AT port already unlocked since the modem last booted')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+async def runModemFleet(flowFn:Callable[[str], Awaitable], deviceSpecList:list=None) -> list:
+    '''
+    Run a flow on several modems at once, as one task per modem on the running event loop
+
+    :param flowFn: Coroutine function doing the work for one modem; gets the device spec that binds it to that modem
+                   (ie. lambda deviceSpec: qmiResetModem(vidPid=deviceSpec))
+    :param deviceSpecList: One device spec per modem; if not set, every attached modem, see getFleetDeviceSpecs()
+    :return: A ModemConfigResult per modem, in the same order as deviceSpecList
+    '''
+    if deviceSpecList is None:
+        deviceSpecList = getFleetDeviceSpecs()
+
+    if len(deviceSpecList) < 1:
+        raise NoUsbDeviceFoundError('No modems found')
+
+    async def runOneModem(deviceSpec):
+        startTime = time.monotonic()
+        try:
+            await flowFn(deviceSpec)
+        except Exception as e:
+            logger.exception(f'Failed on modem {deviceSpec}')
+            return ModemConfigResult(deviceSpec, error=e, durationSeconds=time.monotonic() - startTime)
+        return ModemConfigResult(deviceSpec, durationSeconds=time.monotonic() - startTime)
+
+    resultList = await asyncio.gather(*(asyncio.create_task(runOneModem(curDeviceSpec), name=f'modem {curDeviceSpec}') for curDeviceSpec in deviceSpecList))
+
+    for curResult in resultList:
+        logger.info(f'{curResult.deviceSpec}: {"ok" if curResult.success else f"FAILED ({curResult.error})"} after {curResult.durationSeconds:.1f} seconds')
+
+    return list(resultList)
+
+
+async def sendAtCommandToModem(deviceSpec:str, command:str) -> AtResponse:
+    async with AsyncAtSession(lambda: waitForModemAtDevice(vidPid=deviceSpec), logfile=sys.stderr) as atSession:
+        atResponse = await atSession.sendAtCommand(command, check=False)
+    print(f'{deviceSpec}: {atResponse.text}\n{atResponse.finalResult}')
+    return atResponse
+
+
+if __name__ == '__main__':
+    import logging
+    import modem_usb
+
+    # define file handler and set formatter
+    streamHandler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    streamHandler.setFormatter(formatter)
+    streamHandler.setLevel(logging.DEBUG)
+
+    # add file handler to logger
+    logger.addHandler(streamHandler)
+    modem_usb.logger.addHandler(streamHandler)
+
+    # set log level
+    logger.setLevel(logging.DEBUG)
+    modem_usb.logger.setLevel(logging.DEBUG)
+
+    # usage: modem_async.py reset|qmi-mode|at <command>
+    # runs on every attached modem (or the ones listed in MODEM_DEVICES) at the same time
+    action = sys.argv[1] if len(sys.argv) > 1 else 'reset'
+    if action == 'reset':
+        flowFn = lambda deviceSpec: qmiResetModem(vidPid=deviceSpec)
+    elif action == 'qmi-mode':
+        flowFn = lambda deviceSpec: setModemToQmiMode(vidPid=deviceSpec)
+    elif action == 'at' and len(sys.argv) > 2:
+        flowFn = lambda deviceSpec: sendAtCommandToModem(deviceSpec, sys.argv[2])
+    else:
+        print('usage: modem_async.py reset|qmi-mode|at <command>', file=sys.stderr)
+        sys.exit(2)
+
+    trace_file = os.getenv('MODEM_TRACE_FILE')
+    if trace_file:
+        startTrace(trace_file)
+    try:
+        fleet_results = asyncio.run(runModemFleet(flowFn, os.getenv('MODEM_DEVICES', '').split() or None))
+    finally:
+        if trace_file:
+            stopTrace()
+    sys.exit(0 if all(curResult.success for curResult in fleet_results) else 1)
@@ -0,0 +1,358 @@
+#!/opt/modem_config/bin/python3
+'''
+Helpers for talking to the AT command port of a modem
+'''
+import os
+import re
+import sys
+import time
+import serial
+import threading
+import pexpect.fdpexpect
+from dataclasses import dataclass
+from typing import Callable, Any
+from pexpect.exceptions import TIMEOUT
+from logging import Logger
+from modem_usb import getUsbDeviceRecord
+from modem_trace import traced, currentSpan
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+DEFAULT_AT_BAUD_RATE = 115200
+
+DEFAULT_UNLOCK_PASSWORD = 'A710'
+
+# unlocking can take a while to respond
+UNLOCK_WAIT_TIME = 10
+
+
+# Final result codes end a command's response (V.250 plus the +CME/+CMS extended errors); everything before them is the
+# intermediate response.  Note: the line terminator is required so a partially received line is never matched
+AT_FINAL_RESULT_REGEX = re.compile(r'^(OK|ERROR|\+CM[ES] ERROR:[^\r\n]*|NO CARRIER|BUSY|NO ANSWER|NO DIALTONE)\r?\n', re.MULTILINE)
+AT_SUCCESS_RESULT = 'OK'
+
+DEFAULT_AT_WAIT_TIME = 5
+
+# Keep chained command lines well under the modem's input buffer
+AT_MAX_CHAIN_LENGTH = 128
+
+
+@dataclass
+class AtResponse:
+    '''
+    Parsed response to one AT command
+
+    :param command: The command that was sent
+    :param lines: The intermediate response lines (without the command echo and blank lines)
+    :param finalResult: The final result code line (ie. OK, ERROR or +CME ERROR: 3)
+    '''
+    command: str
+    lines: list
+    finalResult: str
+
+    @property
+    def success(self) -> bool:
+        return self.finalResult == AT_SUCCESS_RESULT
+
+    @property
+    def text(self) -> str:
+        return '\n'.join(self.lines)
+
+    def contains(self, expectedResponse) -> bool:
+        '''
+        Check if the response (intermediate lines or final result) contains any of the given strings
+        '''
+        if not isinstance(expectedResponse, list):
+            expectedResponse = [expectedResponse]
+        return any(curExpected in curLine for curExpected in expectedResponse for curLine in self.lines + [self.finalResult])
+
+
+class AtCommandError(RuntimeError):
+    def __init__(self, message, response:AtResponse):
+        super().__init__(message)
+        self.response = response
+
+
+class AtBatchError(RuntimeError):
+    '''
+    A command in a batch failed; the commands after it were not sent
+
+    :param index: Index of the failed command in the batch
+    :param command: The failed command
+    :param results: Responses of the commands up to and including the failed one
+    '''
+    def __init__(self, message, index:int, command:str, results:list):
+        super().__init__(message)
+        self.index = index
+        self.command = command
+        self.results = results
+
+
+def parseAtResponse(command:str, beforeText:str, finalResult:str) -> AtResponse:
+    # drop the echo of the command and empty lines
+    responseLines = [curLine.strip() for curLine in beforeText.splitlines()]
+    responseLines = [curLine for curLine in responseLines if curLine != '' and curLine != command]
+
+    return AtResponse(command=command, lines=responseLines, finalResult=finalResult.strip())
+
+
+def getSendAtCommand(spawn) -> Callable[[str, Any, int], AtResponse]:
+    @traced()
+    def sendAtCommand(command: str, expectedResponse=None, waitTime:int=None, sleepAfter:float=None, check:bool=None) -> AtResponse:
+        '''
+        Send an AT command and wait for its final result code; returns as soon as that arrives
+
+        :param expectedResponse: String(s) that must be in the response for it to count as a success; if not set, the
+                                 final result has to be OK.  Note: this allows commands that print what we want and
+                                 then end with ERROR (ie. AT!RMARESET)
+        :param waitTime: Max seconds to wait for the final result code
+        :param sleepAfter: Seconds to wait after the response; only for commands that need the modem to settle
+        :param check: Raise AtCommandError if the command did not succeed (default); if False, just return the response
+        '''
+        if waitTime is None:
+            waitTime = DEFAULT_AT_WAIT_TIME
+        if check is None:
+            check = True
+
+        spawn.send(f'{command}\r\n')
+        try:
+            spawn.expect(AT_FINAL_RESULT_REGEX, waitTime)
+        except TIMEOUT as e:
+            e.__cause__ = RuntimeError(f'No final result code for {command}; expected response:\n{expectedResponse}\nfound before:\n{spawn.before}\nfound after:\n{spawn.after}')
+            raise e
+
+        atResponse = parseAtResponse(command, spawn.before, spawn.match.group(1))
+        currentSpan().set('command', command)
+        currentSpan().set('finalResult', atResponse.finalResult)
+
+        if expectedResponse is None:
+            succeeded = atResponse.success
+        else:
+            succeeded = atResponse.contains(expectedResponse)
+        if check and not succeeded:
+            raise AtCommandError(f'{command} failed with {atResponse.finalResult}; expected response:\n{expectedResponse}\nfound:\n{atResponse.text}', atResponse)
+
+        if sleepAfter:
+            time.sleep(sleepAfter)
+
+        return atResponse
+    return sendAtCommand
+
+
+def getPortGeneration(devPath) -> tuple:
+    '''
+    Get something that changes every time the device behind the port re-enumerates (ie. the modem rebooted).  Returns
+    None if the port is gone
+    '''
+    try:
+        usbDeviceRecord = getUsbDeviceRecord(devPath)
+    except FileNotFoundError:
+        return None
+    except RuntimeError:
+        # not a usb device; the best we can do is notice the device file being re-created
+        return (os.stat(devPath).st_ino,)
+
+    return (usbDeviceRecord.busnum, usbDeviceRecord.devnum, usbDeviceRecord.inode)
+
+
+# held while any PrefixedLogWriter writes, so lines of different modems never mix
+prefixedLogLock = threading.Lock()
+
+
+class PrefixedLogWriter:
+    '''
+    Logfile for AtSession that echoes the AT conversation of one modem to a shared stream with every line prefixed (ie.
+    by the device spec), so the conversations of several modems configured at once stay readable.  Only whole lines
+    are written; a partial line waits for the rest of it
+
+    :param prefix: What to put in front of every line
+    :param stream: Where to write the lines; defaults to sys.stdout
+    '''
+    def __init__(self, prefix:str, stream=None):
+        if stream is None:
+            stream = sys.stdout
+
+        self.prefix = prefix
+        self.stream = stream
+        self.partialLine = ''
+
+    def write(self, text:str) -> int:
+        *lineList, self.partialLine = (self.partialLine + text).split('\n')
+        if len(lineList) > 0:
+            with prefixedLogLock:
+                self.stream.write(''.join(f'{self.prefix}{curLine}\n' for curLine in lineList))
+        return len(text)
+
+    def flush(self) -> None:
+        with prefixedLogLock:
+            self.stream.flush()
+
+
+class AtSession:
+    '''
+    Owns the AT command port of a modem for as long as it is needed.  The port is (re)opened lazily: if the modem has
+    reset since the last command, the next command finds the port again and reconnects.  Privileged mode is remembered
+    per modem boot, so ensureUnlocked() only sends AT!ENTERCND again after the modem actually rebooted
+
+    :param devPathResolver: Method that returns the AT port device path, waiting for it if needed
+                            (ie. lambda: waitForModemAtDevice(vidPid=vidPid))
+    :param unlockPassword: Password for AT!ENTERCND
+    :param logfile: Where to echo the AT conversation; defaults to sys.stdout (see PrefixedLogWriter to tell several
+                    modems apart)
+    '''
+    def __init__(self, devPathResolver:Callable[[], str], unlockPassword:str=None, baudRate:int=None, logfile=None):
+        if unlockPassword is None:
+            unlockPassword = DEFAULT_UNLOCK_PASSWORD
+        if baudRate is None:
+            baudRate = DEFAULT_AT_BAUD_RATE
+        if logfile is None:
+            logfile = sys.stdout
+
+        self.devPathResolver = devPathResolver
+        self.unlockPassword = unlockPassword
+        self.baudRate = baudRate
+        self.logfile = logfile
+
+        self.devPath = None
+        self.serialObj = None
+        self.spawn = None
+        # sendAtCommand bound to the current spawn; rebuilt whenever connect() opens a new one
+        self.spawnSendAtCommand = None
+        self.generation = None
+        self.unlockedGeneration = None
+
+    def isStale(self) -> bool:
+        if self.serialObj is None:
+            return True
+        # the modem went away or came back as a new device
+        return getPortGeneration(self.devPath) != self.generation
+
+    def connect(self) -> None:
+        '''
+        Make sure the port is open and belongs to the modem as it is now; reconnects if the modem reset
+        '''
+        if not self.isStale():
+            return
+
+        if self.serialObj is not None:
+            logger.debug(f'AT port {self.devPath} went away; reconnecting')
+            self.close()
+
+        self.devPath = self.devPathResolver()
+        self.generation = getPortGeneration(self.devPath)
+        self.serialObj = serial.Serial(self.devPath, self.baudRate, timeout=0)
+        self.spawn = pexpect.fdpexpect.fdspawn(self.serialObj, encoding='utf-8', logfile=self.logfile)
+        self.spawnSendAtCommand = getSendAtCommand(self.spawn)
+        logger.debug(f'Opened AT port {self.devPath}')
+
+    def close(self) -> None:
+        if self.serialObj is not None:
+            try:
+                self.serialObj.close()
+            except (OSError, serial.SerialException) as e:
+                # the device is most likely gone already
+                logger.debug(f'Error closing AT port {self.devPath}: {e}')
+        self.serialObj = None
+        self.spawn = None
+        self.spawnSendAtCommand = None
+
+    def sendAtCommand(self, command:str, expectedResponse=None, waitTime:int=None, sleepAfter:float=None, check:bool=None) -> AtResponse:
+        self.connect()
+        return self.spawnSendAtCommand(command, expectedResponse=expectedResponse, waitTime=waitTime, sleepAfter=sleepAfter, check=check)
+
+    @traced()
+    def sendBatch(self, commands:list, chain:bool=None, unlock:bool=None, waitTime:int=None) -> list:
+        '''
+        Send an ordered list of commands over the open session, back to back, and return one AtResponse per command.
+        Stops at the first command that fails and raises AtBatchError saying which one it was
+
+        :param commands: The commands, in the order they have to be applied
+        :param chain: Join the commands into as few ;-chained command lines as possible (ie. AT!A=1;!B=2).  Only use
+                      this for plain settings commands; if a chained line fails, its commands are re-sent one by one to
+                      find the one that failed
+        :param unlock: Make sure "privileged" commands are unlocked before sending the batch
+        :param waitTime: Max seconds to wait for the final result code of each command line
+        '''
+        if chain is None:
+            chain = False
+        if unlock is None:
+            unlock = False
+
+        if unlock:
+            self.ensureUnlocked()
+        else:
+            self.connect()
+
+        results = []
+
+        def sendSingle(curIndex:int, curCommand:str) -> None:
+            try:
+                results.append(self.sendAtCommand(curCommand, waitTime=waitTime))
+            except AtCommandError as e:
+                results.append(e.response)
+                raise AtBatchError(f'Batch command {curIndex} ({curCommand}) failed with {e.response.finalResult}', curIndex, curCommand, results) from e
+
+        if not chain:
+            for curIndex, curCommand in enumerate(commands):
+                sendSingle(curIndex, curCommand)
+            return results
+
+        # group the commands into chained command lines; only the first command of a line keeps the AT prefix
+        chainGroups = []
+        curGroup = []
+        curLength = 0
+        for curIndex, curCommand in enumerate(commands):
+            curSuffix = curCommand[2:] if curCommand[:2].upper() == 'AT' else curCommand
+            if len(curGroup) > 0 and curLength + len(curSuffix) + 1 > AT_MAX_CHAIN_LENGTH:
+                chainGroups.append(curGroup)
+                curGroup = []
+                curLength = 0
+            curGroup.append((curIndex, curCommand, curSuffix))
+            curLength += len(curSuffix) + 1
+        if len(curGroup) > 0:
+            chainGroups.append(curGroup)
+
+        for curGroup in chainGroups:
+            if len(curGroup) == 1:
+                sendSingle(curGroup[0][0], curGroup[0][1])
+                continue
+
+            chainedCommand = 'AT' + ';'.join(curSuffix for _, _, curSuffix in curGroup)
+            chainedResponse = self.sendAtCommand(chainedCommand, waitTime=waitTime, check=False)
+            if chainedResponse.success:
+                # the modem only gives us one response for the whole line; every command in it shares it
+                results.extend(AtResponse(command=curCommand, lines=chainedResponse.lines, finalResult=chainedResponse.finalResult) for _, curCommand, _ in curGroup)
+                continue
+
+            # the line stops at the first failing command, so send them one at a time to find out which it was
+            logger.debug(f'Chained command {chainedCommand} failed with {chainedResponse.finalResult}; retrying one by one')
+            # Note: if they all pass on their own, the modem just did not like them chained; carry on
+            for curIndex, curCommand, _ in curGroup:
+                sendSingle(curIndex, curCommand)
+
+        return results
+
+    @traced()
+    def unlock(self) -> None:
+        '''
+        Unlock "privileged" commands on the modem
+        '''
+        self.connect()
+        self.sendAtCommand(f'AT!ENTERCND="{self.unlockPassword}"', waitTime=UNLOCK_WAIT_TIME)
+        self.unlockedGeneration = self.generation
+
+    def ensureUnlocked(self) -> None:
+        '''
+        Unlock "privileged" commands unless they are already unlocked since the modem last booted
+        '''
+        self.connect()
+        if self.unlockedGeneration != self.generation:
+            self.unlock()
+        else:
+            logger.debug('AT port already unlocked since the modem last booted')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
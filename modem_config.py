@@ -1,243 +1,116 @@
 #!/opt/modem_config/bin/python3
-from pexpect.exceptions import TIMEOUT
-from typing import Callable, Any
+from typing import Callable
 import os
-import serial
 import sys
 import time
-import pexpect.fdpexpect
 import json
 import re
 import subprocess
-import hashlib
-import glob
 import shutil
-from fcntl import ioctl
-from pySmartDL import SmartDL
-from pexpect import EOF
-from pexpect.exceptions import TIMEOUT
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from logging import Logger
-from urllib.parse import urljoin, urlparse, unquote as urllib_unquote
+from modem_at import AtSession, PrefixedLogWriter
+from modem_qmi import QmiClient, QmiError
+from modem_trace import traced, traceSpan, currentSpan, startTrace, stopTrace
+from modem_firmware import SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, DEFAULT_FIRMWARE_ORDER_LIST, downloadFirmware, prepareCarrierFirmware, startCarrierFirmwarePrep, getCarrierFirmwareFiles, getCarrierNvuFilename, releaseCarrierFirmwareFiles, getCarrierImageVersion
+from modem_usb import DEVICE_SPEC_PORT_PREFIX, DEVICE_SPEC_SERIAL_PREFIX, UsbDevice, findUsbDevices, findModemPorts, getUsbDeviceOfCharDevice, getUsbDeviceRecord, waitForUsbCondition, getWaitDeadline, resetUsbDevice, openUeventSource, closeUeventSource
 
 logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
 
-SIERRA_WIRELESS_MC74XX_FIRMWARE_URL = 'https://source.sierrawireless.com/resources/airprime/minicard/74xx/em_mc74xx-approved-fw-packages'
-
-# FYI: known file hashes
-'''
-18a87c3079efa12f5f4821692a1af3f382e134730e4938748701adbb91fba724127c31c536c32e2f68de44e398ceb92ff21585fbeeb01f1ca70ecd5755fef8b4 *TMO (Generic)@SWI9X30C_02.30.01.01_Generic_002.045_002.zip
-df8ae45a3a5c1279809e2e26524d10ff831f0617f940daba6bad3f5db58339542ceb3046197b846e9bb48cd1e5e47c8702fef9cb9d01c7a4cdfc42977697d2c6 *Verizon@SWI9X30C_02.33.03.00_Verizon_002.079_002.zip
-c2833454ec801fb65a9190a698c68a8a306485903aa82d50facd28791cfc8556ff6fcc3ef948c176101602534ee5ccc710d46db99b20b5c58e07c8bdc1f90f0f *Sprint@SWI9X30C_02.32.11.00_Sprint_002.062_003.zip
-bf2a077d344bed69498c560ca5b14f19491a0545b85faef58617e804dedbccb9ef548bfa8d3bdf8b23a038581df4b604aa2f27c983acce2693caaf35b2f5736c *Generic@SWI9X30C_02.33.03.00_Generic_002.072_001.zip
-'''
-
-# Presumed table headers (hardcoded - modelHeader column is the carrier name cells):
-# ${modelHeader}   Firmware   PRI   Firmware Files   Windows EXE   Comment
-FIRMWARE_TABLE_HEADERS = [
-    'Carrier',
-    'Firmware',
-    'PRI',
-    'Firmware Files',
-    'Windows EXE',
-    'Comment'
-]
+SERVICE_PROG_CODE='000000'
 
-FIRMWARE_LINK_TABLE_HEADERS = [
-    'Firmware Files',
-    'Windows EXE'
-]
+# Note: anything getDeviceMatcher() understands works anywhere a vidPid is taken, ie. '1199:9071|1199:9079|413C:81B6',
+# '1199:*' or a usb port path like '1-1.2'
+DEFAULT_DEVICE_VID_PID = '1199:9071'  # maybe these? 1199:9071|1199:9079|413C:81B6
 
-DEFAULT_FIRMWARE_ORDER_LIST = [
-    'TMO (Generic)',
-    'Verizon',
-    'Sprint',
-    # This seems to be causing issues
-    #'Generic'
-]
+# how many modems to configure at the same time in fleet mode
+DEFAULT_FLEET_MAX_WORKERS = 4
 
-MODEM_FIRMWARE_DIRNAME = 'modem_firmware'
+# how long to wait for the modem, in seconds
+DEFAULT_MODEM_WAIT_TIMEOUT = 30
+# after a reboot (ie. a factory reset or NV settings) the modem can take over a minute to come back
+MODEM_REBOOT_WAIT_TIMEOUT = 90
+DEFAULT_MODEM_GONE_TIMEOUT = 30
+# longest time between checks for the modem going away (uevents usually wake the wait up before that)
+MODEM_GONE_POLL_INTERVAL = 1
+# the usb device can show up a moment before its drivers create the device files
+DEVICE_FILES_WAIT_TIMEOUT = 3
 
-DOWNLOAD_BLOCK_SIZE = 1024 #1 Kibibyte
 
-HASH_READ_BLOCK_SIZE = 65536  # 2**16
+@dataclass(frozen=True)
+class DesiredAtSetting:
+    '''
+    A modem setting configureModem() applies, and how to tell if it is already applied
+
+    :param name: Name for logging (ie. USBCOMP)
+    :param queryCommand: Command that reports the current value
+    :param setCommand: Command that applies the desired value
+    :param expectedPattern: Regex that matches the query response (see normalizeAtResponseText()) when the desired
+                            value is already set
+    :param resetBy: Name of an earlier setting that resets this one when applied (so this one needs applying again)
+    '''
+    name: str
+    queryCommand: str
+    setCommand: str
+    expectedPattern: str
+    resetBy: str = None
+
+
+# Note: keep these in sync with what configureModem() sends
+MODEM_BASE_SETTINGS = [
+    DesiredAtSetting('IMPREF', 'AT!IMPREF?', 'AT!IMPREF="AUTO-SIM"', r'AUTO-SIM'),
+    DesiredAtSetting('USBCOMP', 'AT!USBCOMP?', 'AT!USBCOMP=1,1,0000010D', r'BITMASK:0*10D\b'),
+    DesiredAtSetting('LTECA', 'AT!LTECA?', 'AT!LTECA=1', r'LTECA:0*1\b'),
+    DesiredAtSetting('BAND', 'AT!BAND?', 'AT!BAND=00', r'\b0*0,ALLBANDS'),
+]
 
-SERVICE_PROG_CODE='000000'
+# gps settings sent before the modem resets itself (the AT!CUSTOM NV setting tends to do that)
+MODEM_GPS_SETTINGS = [
+    DesiredAtSetting('GPSXTRADATAENABLE', 'AT!GPSXTRADATAENABLE?', 'AT!GPSXTRADATAENABLE=1,3,10,1,24', r'\b1,3,10,1,24\b'),
+    DesiredAtSetting('GPSPOSMODE', 'AT!GPSPOSMODE?', 'AT!GPSPOSMODE=1FE037F', r'\b0*1FE037F\b', resetBy='GPSXTRADATAENABLE'),
+    DesiredAtSetting('GPSSUPLURL', 'AT!GPSSUPLURL?', 'AT!GPSSUPLURL="supl.google.com:7276"', r'SUPL\.GOOGLE\.COM:7276'),
+    DesiredAtSetting('GPSTRANSSEC', 'AT!GPSTRANSSEC?', 'AT!GPSTRANSSEC=0', r':0*0$'),
+    DesiredAtSetting('GPSSUPLVER', 'AT!GPSSUPLVER?', 'AT!GPSSUPLVER=2', r':0*2$'),
+    # Note: AT!CUSTOM? lists one customization per line, ie. GPSLPM 0x01
+    DesiredAtSetting('GPSLPM', 'AT!CUSTOM?', 'AT!CUSTOM="GPSLPM",1', r'^GPSLPM,?(0X)?0*1$'),
+]
 
-DEFAULT_DEVICE_VID_PID = '1199:9071'  # maybe these? 1199:9071|1199:9079|413C:81B6
+# gps settings sent after that reset
+MODEM_GPS_POST_RESET_SETTINGS = [
+    DesiredAtSetting('GPSNMEASENTENCE', 'AT!GPSNMEASENTENCE?', 'AT!GPSNMEASENTENCE=7FFF', r'\b0*7FFF\b'),
+    # 0 is the default, so it may not be listed at all
+    DesiredAtSetting('GPSSEL', 'AT!CUSTOM?', 'AT!CUSTOM="GPSSEL",0', r'^GPSSEL,?(0X)?0*0$|\A(?![\s\S]*^GPSSEL)'),
+    DesiredAtSetting('GPSAUTOSTART', 'AT!GPSAUTOSTART?', 'AT!GPSAUTOSTART=2,2,60,4294967280,1', r'\b2,2,60,4294967280,1\b'),
+]
 
-#define USBDEVFS_RESET             _IO('U', 20)
-USBDEVFS_RESET = ord('U') << (4*2) | 20
+# one image row of AT!IMAGE?, ie.
+# TYPE SLOT STATUS LRU FAILURES UNIQUE_ID   BUILD_ID
+# FW   1    GOOD   1   0    0 ?_?         02.24.05.06_GENERIC
+# FW   3    EMPTY  0   0    0
+# PRI  FF   GOOD   0   0    0 002.026_000 02.24.05.06_GENERIC
+AT_IMAGE_ROW_REGEX = re.compile(r'^(?P<type>FW|PRI)\s+(?P<slot>[0-9A-F]+)\s+(?P<status>\S+)\s+\d+\s+\d+(?:\s+\d+)?(?:\s+(?P<uniqueId>\S+)\s+(?P<buildId>\S+))?\s*$', re.MULTILINE | re.IGNORECASE)
+AT_IMAGE_GOOD_STATUS = 'GOOD'
 
 
-def downloadFirmware(pageUrlToParse, modelHeader, carrierList=None):
-    import requests
-    from bs4 import BeautifulSoup
+@dataclass(frozen=True)
+class ModemImageSlot:
+    '''
+    A firmware slot of the modem, as reported by AT!IMAGE?
 
-    if carrierList is None:
-        carrierList = DEFAULT_FIRMWARE_ORDER_LIST
+    :param slotIndex: The slot number (what --modem-storage-index takes)
+    :param status: ie. GOOD or EMPTY
+    :param buildId: The firmware in the slot, ie. 02.24.05.06_GENERIC (None if empty)
+    :param priVersions: Versions of the carrier PRIs on the modem for that firmware, ie. ('002.026_000',)
+    '''
+    slotIndex: int
+    status: str
+    buildId: str = None
+    priVersions: tuple = ()
+
+    def hasImage(self, buildId:str, priVersion:str) -> bool:
+        return self.status.upper() == AT_IMAGE_GOOD_STATUS and self.buildId is not None and self.buildId.upper() == buildId.upper() and priVersion.upper() in (curVersion.upper() for curVersion in self.priVersions)
 
-    logger.info(f"Parsing available firmware from {pageUrlToParse}")
-    firmwarePageText = requests.get(pageUrlToParse).text
-    
-    # Prepare the soup
-    soup = BeautifulSoup(firmwarePageText, "html.parser")
-    
-    firmwareLinkTableObj = soup.select_one(
-        f'table.fw-table:has(> tbody > tr:nth-child(1) > td:nth-child(1) > '
-        + f'strong:nth-child(1):-soup-contains-own("{modelHeader}"))')
-    logger.debug(f"found table:\n{firmwareLinkTableObj}")
-
-    foundCarrierFwFileLinks = {}
-    sawHeader = False
-    for curFirmwareLinkTableRowObj in firmwareLinkTableObj.select(':scope > tbody > tr'):
-        # skip the header row
-        if not sawHeader:
-            sawHeader = True
-            continue
-        curFirstCell = curFirmwareLinkTableRowObj.select_one(':scope > td:nth-child(1)')
-
-        curCellStrippedStringList = [curStrippedString for curStrippedString in curFirstCell.stripped_strings]
-
-        logger.debug(f'Checking row with first cell {curCellStrippedStringList}')
-
-        if len(curCellStrippedStringList) != 1:
-            raise RuntimeError("Too many stripped strings found in first cell {curFirstCell}")
-        curFirstCellStrippedString = curCellStrippedStringList[0]
-
-        if curFirstCellStrippedString in carrierList:
-            logger.debug(f"Found row with first cell {curFirstCellStrippedString}")
-
-            if curFirstCellStrippedString in foundCarrierFwFileLinks.keys():
-                raise RuntimeError(
-                    f'foundCarrierFwFileLinks already has a link entry for carrier {curFirstCellStrippedString}')
-
-            # get the target field values (skips the carrier column since we already parsed that one)
-            foundCarrierFwFileLinks[curFirstCellStrippedString] = {}
-            for curCellHeaderIndex in range(1, len(FIRMWARE_TABLE_HEADERS)):
-                curCellHeader = FIRMWARE_TABLE_HEADERS[curCellHeaderIndex]
-                # Note: css index is 1 based, not 0
-                curTargetCell = curFirmwareLinkTableRowObj.select_one(
-                    f':scope > td:nth-child({curCellHeaderIndex + 1})')
-
-                # if this is one of the link fields, get the a href value, else get the cell text
-                curFieldValue = None
-                if curCellHeader in FIRMWARE_LINK_TABLE_HEADERS:
-                    # Note: This presently expects there to be only 1 link in this cell and for it not to be nested
-                    curLinkObj = curTargetCell.select_one(':scope > p > a:nth-child(1)')
-                    # If there is a link in therte, grab it
-                    if curLinkObj is not None:
-                        curFieldValue = urljoin(pageUrlToParse, curLinkObj['href'])
-                else:
-                    curCellStrippedStringList = [
-                        curStrippedString for curStrippedString in curTargetCell.stripped_strings]
-
-                    if not len(curCellStrippedStringList) == 1:
-                        raise RuntimeError(
-                            f"Too many stripped strings found in cell {curCellHeaderIndex} ({curCellHeader}) for "
-                            + f"{curFirstCell}: {curCellStrippedStringList}")
-                    curFieldValue = curCellStrippedStringList[0]
-                # append current field value to the firmware dictionary
-                if curFieldValue is not None:
-                    foundCarrierFwFileLinks[curFirstCellStrippedString].update({curCellHeader: curFieldValue})
-            if len(foundCarrierFwFileLinks[curFirstCellStrippedString].keys()) < 1:
-                del foundCarrierFwFileLinks[curFirstCellStrippedString]
-    logger.info(f'Parsed firmware:\n{json.dumps(foundCarrierFwFileLinks, indent=4)}')
-
-    # Make sure we found them all
-    if sorted(carrierList) != sorted(foundCarrierFwFileLinks.keys()):
-        raise RuntimeError(f'Not all carrier firmware files were found.\nSearch list: {sorted(carrierList)}\nFound list: {sorted(foundCarrierFwFileLinks.keys())}')
-
-    # Parse the firmware filename and download firmware
-    if not os.path.exists(MODEM_FIRMWARE_DIRNAME):
-        os.mkdir(MODEM_FIRMWARE_DIRNAME)
-    modemFirmwareDirPath = os.path.realpath(MODEM_FIRMWARE_DIRNAME)
-
-    # Download them in order
-    # TODO: this could maybe done concurrently to save time
-    for curCarrierName in carrierList:
-        curFirmwareDict = foundCarrierFwFileLinks[curCarrierName]
-        curZipUrl = curFirmwareDict['Firmware Files']
-
-        logger.info(f'Downloading firmware for carrier {curCarrierName} ({curZipUrl})')
-
-        targetFilename = None
-        targetFilePath = None
-        targetFinalUrl = None
-        targetFileBytes = None
-
-        # Streaming, so we can iterate over the response.
-        '''
-        with requests.get(curZipUrl, stream=True, allow_redirects=True) as responseObj:
-            # make sure we got an ok response
-            if responseObj.status_code != 200:
-                responseObj.raise_for_status()  # Will only raise for 4xx codes, so...
-                raise RuntimeError(f"Request to {curZipUrl} returned status code {responseObj.status_code}")
-            targetFinalUrl = responseObj.url
-
-            # find the filename to save as
-            if "Content-Disposition" in responseObj.headers.keys():
-                targetFilename = re.findall('filename="(.+)"', responseObj.headers["Content-Disposition"])[0]
-            else:
-                # get the path after the url has followed redirects
-                curZipUrlObj = urlparse(targetFinalUrl)
-                curZipUrlPath = curZipUrlObj.path
-                targetFilename = urllib_unquote(os.path.basename(curZipUrlPath))
-            targetFilename = f'{curCarrierName}@{targetFilename}'
-            targetFilePath = os.path.join(modemFirmwareDirPath, targetFilename)
-
-            # download the binary to a file
-            logger.debug(f'Writing firmware binary for {curCarrierName} from {targetFinalUrl} to {targetFilePath}')
-        
-            targetFileBytes = int(responseObj.headers.get('content-length', 0))
-            if targetFileBytes == 0:
-                raise RuntimeError(f'http response for {curCarrierName} firmware ({targetFinalUrl}) said content size for requested file is 0! This shouldnt happen')
-            
-            progressBarObj = tqdm(total=targetFileBytes, unit='iB', unit_scale=True)
-            with open(targetFilePath, 'wb') as outputFileObj:
-                for data in responseObj.iter_content(DOWNLOAD_BLOCK_SIZE):
-                    progressBarObj.update(len(data))
-                    outputFileObj.write(data)
-            progressBarObj.close()
-            if progressBarObj.n != targetFileBytes:
-                raise RuntimeError(f"something went wrong; download size ({progressBarObj.n}) does match content size from header ({targetFileBytes})")
-        '''
-        with requests.head(curZipUrl, allow_redirects=True) as responseObj:
-            # make sure we got an ok response
-            responseObj.raise_for_status()
-            targetFinalUrl = responseObj.url
-
-            # find the filename to save as
-            if "Content-Disposition" in responseObj.headers.keys():
-                targetFilename = re.findall('filename="(.+)"', responseObj.headers["Content-Disposition"])[0]
-            else:
-                # get the path after the url has followed redirects
-                curZipUrlObj = urlparse(targetFinalUrl)
-                curZipUrlPath = curZipUrlObj.path
-                targetFilename = urllib_unquote(os.path.basename(curZipUrlPath))
-            targetFilename = f'{curCarrierName}@{targetFilename}'
-            targetFilePath = os.path.join(modemFirmwareDirPath, targetFilename)
-
-            targetFileBytes = int(responseObj.headers.get('content-length', 0))
-            if targetFileBytes == 0:
-                raise RuntimeError(f'http response for {curCarrierName} firmware ({targetFinalUrl}) said content size for requested file is 0! This shouldnt happen')
-            
-        logger.debug(f'Writing firmware binary for {curCarrierName} ({targetFileBytes} bytes) from {targetFinalUrl} to {targetFilePath}')
-
-        # delete the file if it already exists
-        if os.path.exists(targetFilePath):
-            os.remove(targetFilePath)
-
-        smartDlObj = SmartDL(targetFinalUrl, targetFilePath)
-        smartDlObj.start()
-
-        sha512sum = hashlib.sha512()
-        with open(targetFilePath, 'rb') as source:
-            block = source.read(HASH_READ_BLOCK_SIZE)
-            while len(block) != 0:
-                sha512sum.update(block)
-                block = source.read(HASH_READ_BLOCK_SIZE)
-        logger.info(f'sha512sum:\n{sha512sum.hexdigest()} *{targetFilename}')
-            
 
 qmiFlashBinaryPath:str = None
 
@@ -251,169 +124,127 @@ def getQmiFlashBinaryPath():
     return qmiFlashBinaryPath
 
 
-def unpackCarrierZip(carrierName, zipPath):
-    carrierFirmwareDirname = os.path.join(MODEM_FIRMWARE_DIRNAME, carrierName)
-    if not os.path.exists(carrierFirmwareDirname):
-        os.mkdir(carrierFirmwareDirname)
-
-    # remove existing file contents
-    for curfile in glob.glob(os.path.join(carrierFirmwareDirname, '*')):
-        os.remove(curfile)
-
-    # unzip the file into the new directory
-    import zipfile
-    with zipfile.ZipFile(zipPath, 'r') as zip_ref:
-        zip_ref.extractall(carrierFirmwareDirname)
-
-    # ensure the expected files exist, print their hashes, and return them as a list
-    # make sure there is nothing extra
-    deglobbedList = glob.glob(os.path.join(carrierFirmwareDirname, '*.cwe'))
-    if len(deglobbedList) != 1:
-        raise RuntimeError(f'Wrong number of matches found (want exactly 1) when deglobbing cwe file for carrier {carrierName}: {json.dumps(deglobbedList, indent=4)}')
-    cweFilePath = deglobbedList[0]
-    deglobbedList = glob.glob(os.path.join(carrierFirmwareDirname, '*.nvu'))
-    if len(deglobbedList) != 1:
-        raise RuntimeError(f'Wrong number of matches found (want exactly 1) when deglobbing nvu file for carrier {carrierName}: {json.dumps(deglobbedList, indent=4)}')
-    nvuFilePath = deglobbedList[0]
-    deglobbedList = glob.glob(os.path.join(carrierFirmwareDirname, '*'))
-    if len(deglobbedList) != 2:
-        raise RuntimeError(f'Extra matches found (want exactly 2) when counting all files in carrier {carrierName} dir: {json.dumps(deglobbedList, indent=4)}')
-
-    return [cweFilePath, nvuFilePath]
-
-
-def getVidPidRegex(vidPid=None):
-    global vidPidRegex
-
-    if vidPid is None:
-        vidPid = DEFAULT_DEVICE_VID_PID
-
-    # TODO: vidPid could be an re object (for multiple or more interesting matches)
-    # TODO: vidpid could be a list
-    vidPidRegex = re.compile(r'^'+r'\S+\s+'*5+r'(?P<vidpid>' + re.escape(vidPid) + r')\b.*$')
-
-    return vidPidRegex
-
-
 class NoUsbDeviceFoundError(RuntimeError):
     ...
 
 
-lsusbBinaryPath:str = None
-
-def getLsusbBinaryPath():
-    global lsusbBinaryPath
-
-    if lsusbBinaryPath is None:
-        lsusbBinaryPath = shutil.which('lsusb')
-
-    return lsusbBinaryPath
-
+def findSingleModem(vidPid) -> UsbDevice:
+    '''
+    :return: The one usb device matching vidPid, or None if it is not there (yet)
+    '''
+    matches = findUsbDevices(vidPid)
 
-def waitForModem(vidPid=None, maxRetries:int=None, interval:float=None) -> None:
-    if maxRetries is None:
-        maxRetries = 10
-    if interval is None:
-        interval = 3
+    # can only do 1 atm
+    if len(matches) > 1:
+        matchLines = [str(curMatch) for curMatch in matches]
+        raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}:\n{json.dumps(matchLines, indent=4)}')
+    # if we found our device, we are done
+    if len(matches) > 0:
+        logger.debug(f'found the following device:\n{matches[0]}')
+        return matches[0]
+    logger.debug('Waiting for modem to appear on the usb bus ...')
+    return None
+
+
+def findModemPortsOfType(vidPid, portType:str) -> list:
+    '''
+    :param portType: The ModemPorts field that has to be set (ie. qmiDevPaths or atDevPath)
+    :return: The ModemPorts matching vidPid that have the requested port type, or None if there are none (yet)
+    '''
+    matches = [curModemPorts for curModemPorts in findModemPorts(vidPid) if getattr(curModemPorts, portType)]
+    if len(matches) < 1:
+        return None
+    return matches
 
-    lsusbPath = getLsusbBinaryPath()
 
-    # Try this up to 10 times
-    for curTry in range(0, maxRetries):
-        # if this is not the first loop, log that we are waiting and sleep
-        if curTry > 0:
-            logger.debug(f'Waiting for modem to appear in lsusb output (retry {curTry}) ...')
-            time.sleep(interval)
+@traced()
+def waitForModem(vidPid=None, timeout:float=None, deadline:float=None, eventSource=None) -> UsbDevice:
+    '''
+    :param timeout: Seconds to wait for the modem to show up
+    :param deadline: Absolute time.monotonic() to give up at, instead of timeout
+    '''
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
 
-        proccomp = subprocess.run([lsusbPath], capture_output=True, check=True, encoding='utf-8')
+    def findModem():
+        return findSingleModem(vidPid)
 
-        matches = []
-        for curLine in proccomp.stdout.splitlines():
-            curMatch = getVidPidRegex(vidPid).search(curLine)
-            if curMatch is not None:
-                matches += [curMatch]
-        matchLines = [curMatch.group(0) for curMatch in matches]
-
-        # can only do 1 atm
-        if len(matches) > 1:
-            raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}:\n{json.dumps(matchLines, indent=4)}')
-        # if we found our device, exit the loop
-        if len(matches) > 0:
-            logger.debug(f'found the following device line:\n{matches[0]}')
-            break
-    else:
+    startTime = time.monotonic()
+    foundDevice = waitForUsbCondition(findModem, timeout=timeout, vidPid=vidPid, eventSource=eventSource, deadline=deadline)
+    if foundDevice is None:
         # we did not find the target device
-        raise NoUsbDeviceFoundError('No usb device found')
-
-
-findBinaryPath:str = None
+        raise NoUsbDeviceFoundError(f'No usb device found after {time.monotonic() - startTime:.1f} s')
 
-def getFindBinaryPath():
-    global findBinaryPath
+    return foundDevice
 
-    if findBinaryPath is None:
-        findBinaryPath = shutil.which('find')
-
-    return findBinaryPath
 
+def waitForModemPorts(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None, portType:str=None) -> list:
+    '''
+    Wait for the modem and then for its device files of the given type to show up
 
-def waitForModemDevice(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None):
+    :param timeout: Seconds to wait for the modem (the device files get a few more seconds if needed)
+    :param deadline: Absolute time.monotonic() to give up at, instead of timeout
+    :param portType: The ModemPorts field that has to be set (ie. qmiDevPaths or atDevPath)
+    :return: All the found ModemPorts that have the requested port type
+    '''
     if pickFirstDevice is None:
         pickFirstDevice = False
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
 
-    findPath = getFindBinaryPath()
-
-    waitForModem(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
+    deadline = getWaitDeadline(timeout, deadline)
+    waitForModem(vidPid=vidPid, deadline=deadline)
 
     # do we really need this here? searching dmesg is rough
     # this looks for the output from qcserial creating a tty for subdevice 3
     #ttyUSB=$(dmesg | grep '.3: Qualcomm USB modem converter detected' -A1 | grep -Eo 'ttyUSB[0-9]$' | tail -1)
 
-    proccomp = subprocess.run([findPath, '/dev', '-maxdepth', '1', '-regex', '/dev/cdc-wdm[0-9]', '-o', '-regex', '/dev/qcqmi[0-9]'], capture_output=True, check=True, encoding='utf-8')
+    def findPorts():
+        return findModemPortsOfType(vidPid, portType)
 
-    matches = proccomp.stdout.splitlines()
+    # the usb device can show up a moment before its drivers create the device files; give them a little extra time
+    matches = waitForUsbCondition(findPorts, vidPid=vidPid, deadline=max(deadline, time.monotonic() + DEVICE_FILES_WAIT_TIMEOUT))
+    return checkModemPortMatches(matches, pickFirstDevice)
+
+
+def checkModemPortMatches(matches:list, pickFirstDevice:bool) -> list:
+    '''
+    Make sure waiting for the device files found exactly one modem (or at least one, if pickFirstDevice)
+    '''
+    if matches is None:
+        matches = []
 
-    # Make sure the found devices are for the requested vid/pid
-    if vidPid is None:
-        vidPid = DEFAULT_DEVICE_VID_PID
-    matches = list(filter(lambda curDevice: vidPid == getVidPidOfDevice(curDevice), matches))
-    
     # can only do 1 atm
     if len(matches) > 1 and not pickFirstDevice:
         raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}')
     # if we found our device, exit the loop
     if len(matches) < 1:
         raise NoUsbDeviceFoundError(f'No matching device files.  Expected 1, but found {len(matches)}')
-    retDev = matches[0]
+
+    return matches
+
+
+@traced()
+def waitForModemDevice(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None):
+    modemPorts = waitForModemPorts(vidPid=vidPid, timeout=timeout, deadline=deadline, pickFirstDevice=pickFirstDevice, portType='qmiDevPaths')[0]
+    retDev = modemPorts.qmiDevPaths[0]
 
     logger.debug(f'qmi device path: {retDev}')
 
     return retDev
 
 
-def waitForModemAtDevice(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None):
+@traced()
+def waitForModemAtDevice(vidPid=None, timeout:float=None, deadline:float=None, pickFirstDevice:bool=None):
     if pickFirstDevice is None:
         pickFirstDevice = True
 
-    findPath = getFindBinaryPath()
-
-    waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
-
-    # do we really need this here? searching dmesg is rough
-    # this looks for the output from qcserial creating a tty for subdevice 3
-    #ttyUSB=$(dmesg | grep '.3: Qualcomm USB modem converter detected' -A1 | grep -Eo 'ttyUSB[0-9]$' | tail -1)
-
-    proccomp = subprocess.run([findPath, '/dev', '-maxdepth', '1', '-mindepth', '1', '-type', 'l', '-iname', 'mm-at*'], capture_output=True, check=True, encoding='utf-8')
-
-    matches = proccomp.stdout.splitlines()
-
-    # can only do 1 atm
-    if len(matches) > 1 and not pickFirstDevice:
-        raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}')
-    # if we found our device, exit the loop
-    if len(matches) < 1:
-        raise NoUsbDeviceFoundError(f'No matching device files.  Expected 1, but found {len(matches)}')
-    retDev = matches[0]
+    modemPorts = waitForModemPorts(vidPid=vidPid, timeout=timeout, deadline=deadline, pickFirstDevice=pickFirstDevice, portType='atDevPath')[0]
+    retDev = modemPorts.atDevPath
 
     logger.debug(f'at device path: {retDev}')
 
@@ -424,101 +255,62 @@ class UsbDeviceFoundError(RuntimeError):
     ...
 
 
-def waitForModemGoneAfterCall(methodToCall:Callable, vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None) -> None:
-    # by default, wait up to roughly 30 seconds for this to go away
-    if maxRetries is None:
-        maxRetries = 100
-    if interval is None:
-        interval = 0.3
+@traced()
+def waitForModemGoneAfterCall(methodToCall:Callable, vidPid=None, timeout:float=None, pickFirstDevice:bool=None) -> None:
+    '''
+    Call methodToCall and wait for the modem to drop off the usb bus
+
+    :param timeout: Seconds to wait for the modem to go away, counted from when methodToCall returns
+    '''
+    if timeout is None:
+        timeout = DEFAULT_MODEM_GONE_TIMEOUT
 
     waitForModemDevice(vidPid=vidPid, pickFirstDevice=pickFirstDevice)
 
-    methodToCall()
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
 
-    # Wait for the usb device to go away
-    for curTry in range(0, maxRetries):
-        # if this is not the first loop, log that we are waiting and sleep
-        if curTry > 0:
-            logger.debug(f'Waiting for modem to disappear in lsusb output (retry {curTry}) ...')
-            time.sleep(interval)
+    def isModemGone():
+        if len(findUsbDevices(vidPid)) > 0:
+            logger.debug('Waiting for modem to disappear from the usb bus ...')
+            return None
+        return True
 
-        try:
-            waitForModem(vidPid=vidPid, maxRetries=1)
-        except(NoUsbDeviceFoundError):
-            break
-    else:
-        raise UsbDeviceFoundError()
+    # start listening before the call so we can not miss the device going away
+    eventSource = openUeventSource()
+    try:
+        methodToCall()
+
+        # Wait for the usb device to go away
+        startTime = time.monotonic()
+        if waitForUsbCondition(isModemGone, timeout=timeout, pollInterval=MODEM_GONE_POLL_INTERVAL, vidPid=vidPid, eventSource=eventSource) is None:
+            raise UsbDeviceFoundError(f'Modem still there after {time.monotonic() - startTime:.1f} s')
+    finally:
+        closeUeventSource(eventSource)
 
 
 def getVidPidOfDevice(modemDevPath):
-    # get enough device info to find the pci device
-    qmiDevStat = os.stat(modemDevPath)
-    qmiDevRdev = qmiDevStat.st_rdev
-    qmiDevMajor = os.major(qmiDevRdev)
-    qmiDevMinor = os.minor(qmiDevRdev)
-    # USB sysfs for QMI char device of modem
-    sysfsCharDevPath = f'/sys/dev/char/{qmiDevMajor}:{qmiDevMinor}/device'
-    logger.debug(f'* USB sysfs for QMI char device of modem (unresolved): {sysfsCharDevPath}')
-    sysfsCharDevPciPath = os.path.realpath(sysfsCharDevPath)
-    logger.debug(f'* USB sysfs for QMI char device of modem: {sysfsCharDevPciPath}')
-    # PCI device
-    sysfsUsbDevPciPath = os.path.join(sysfsCharDevPciPath, '..')
-    logger.debug(f'* sysfs path for PCI device for QMI char device of modem: {sysfsUsbDevPciPath}')
-    # Device identity info
-    sysfsUsbDevPciVendorPath = os.path.join(sysfsUsbDevPciPath, 'idVendor')
-    sysfsUsbDevPciProductPath = os.path.join(sysfsUsbDevPciPath, 'idProduct')
-
-    usbDevPciVid = None
-    with open(sysfsUsbDevPciVendorPath, 'r') as vidFileObj:
-        usbDevPciVid = vidFileObj.read().strip()
-
-    usbDevPciPidNum = None
-    with open(sysfsUsbDevPciProductPath, 'r') as pidFileObj:
-        usbDevPciPidNum = pidFileObj.read().strip()
-
-    vidPid = f'{usbDevPciVid}:{usbDevPciPidNum}'
+    vidPid = getUsbDeviceOfCharDevice(modemDevPath).vidPid
 
     logger.debug(f'* Device {modemDevPath} has vid:pid of {vidPid}')
 
     return vidPid
 
 
-def resetModemUsb(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice=None):
+@traced()
+def resetModemUsb(vidPid=None, timeout:float=None, pickFirstDevice=None):
     logger.debug(f'Going to reset {vidPid}, pickFirstDevice is {pickFirstDevice}')
-    modemDevPath = waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval, pickFirstDevice=pickFirstDevice)
+    modemDevPath = waitForModemDevice(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
     logger.debug(f'{vidPid} has device path {modemDevPath}')
 
-    # get enough device info to find the pci device
-    qmiDevStat = os.stat(modemDevPath)
-    qmiDevRdev = qmiDevStat.st_rdev
-    qmiDevMajor = os.major(qmiDevRdev)
-    qmiDevMinor = os.minor(qmiDevRdev)
-    # USB sysfs for QMI char device of modem
-    sysfsCharDevPath = f'/sys/dev/char/{qmiDevMajor}:{qmiDevMinor}/device'
-    logger.debug(f'USB sysfs for QMI char device of modem (unresolved): {sysfsCharDevPath}')
-    sysfsCharDevPciPath = os.path.realpath(sysfsCharDevPath)
-    logger.debug(f'USB sysfs for QMI char device of modem: {sysfsCharDevPciPath}')
-    # PCI device
-    sysfsUsbDevPciPath = os.path.join(sysfsCharDevPciPath, '..')
-    logger.debug(f'sysfs path for PCI device for QMI char device of modem: {sysfsUsbDevPciPath}')
-    # PCI device info
-    sysfsUsbDevPciBusnumPath = os.path.join(sysfsUsbDevPciPath, 'busnum')
-    sysfsUsbDevPciDevnumPath = os.path.join(sysfsUsbDevPciPath, 'devnum')
-
-    usbDevPciBusNum = None
-    with open(sysfsUsbDevPciBusnumPath, 'r') as busnumFileObj:
-        usbDevPciBusNum = int(busnumFileObj.read())
-
-    usbDevPciDevNum = None
-    with open(sysfsUsbDevPciDevnumPath, 'r') as devnumFileObj:
-        usbDevPciDevNum = int(devnumFileObj.read())
-
-    devNodePath=f'/dev/bus/usb/{usbDevPciBusNum:03d}/{usbDevPciDevNum:03d}'
+    # usb identity and topology of the QMI char device of the modem (cached until the modem re-enumerates)
+    modemUsbDeviceRecord = getUsbDeviceRecord(modemDevPath)
+    logger.debug(f'USB sysfs for QMI char device of modem: {modemUsbDeviceRecord.sysfsIfacePath}')
+
+    devNodePath = modemUsbDeviceRecord.usbDevNodePath
     logger.debug(f'Path to the USB device node of the modem: {devNodePath}')
 
-    # This part works with ANY usb device
-    with open(devNodePath, "wb") as fd:
-        ioctl(fd, USBDEVFS_RESET, 0)
+    resetUsbDevice(devNodePath)
 
 
 qmicliBinaryPath:str = None
@@ -532,59 +324,79 @@ def getQmicliBinaryPath():
     return qmicliBinaryPath
 
 
-def qmiResetModem(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None, offlineRetries:int=None, resetRetries:int=None):
+# send the QMI requests with the in-process client (modem_qmi) instead of forking qmicli -p for each one
+useQmiClient:bool = False
+
+
+@traced()
+def qmiResetModem(vidPid=None, timeout:float=None, pickFirstDevice:bool=None, offlineRetries:int=None, resetRetries:int=None):
     if offlineRetries is None:
         offlineRetries = 2
     if resetRetries is None:
         resetRetries = 3
 
-    qmicliPath = getQmicliBinaryPath()
+    modemDevPath = waitForModemDevice(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
 
-    modemDevPath = waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval, pickFirstDevice=pickFirstDevice)
+    qmiClient = None
+    if useQmiClient:
+        # one client id for the offline and reset requests (and their retries)
+        qmiClient = QmiClient(modemDevPath)
+        setOperatingMode = qmiClient.setOperatingMode
+    else:
+        qmicliPath = getQmicliBinaryPath()
 
-    logger.debug('setting modem offline with QMI ...')
-    # Set modem offline if we can (maybe modem is already offline? if so just reset)
-    for curRetry in range(0, offlineRetries):
-        if curRetry > 0:
-            logger.debug(f'Retrying putting modem offline: {curRetry}')
-        try:
-            subprocess.run([qmicliPath, '-p', '-d', modemDevPath, '--dms-set-operating-mode=offline'], check=True, encoding='utf-8')
-        except subprocess.CalledProcessError as e:
-            # TODO: if captureing output, could look for message like
-            # error: couldn't create client for the 'dms' service: CID allocation failed in the CTL client: Transaction timed out
-            logger.warn(f'Could not put modem in offline mode: {e}')
-        else:
-            break
+        def setOperatingMode(mode:str):
+            subprocess.run([qmicliPath, '-p', '-d', modemDevPath, f'--dms-set-operating-mode={mode}'], check=True, encoding='utf-8')
 
-    def resetWithQmiCli():
-        for curRetry in range(0, resetRetries):
+    try:
+        logger.debug('setting modem offline with QMI ...')
+        # Set modem offline if we can (maybe modem is already offline? if so just reset)
+        for curRetry in range(0, offlineRetries):
             if curRetry > 0:
-                logger.debug(f'Retrying putting modem in reset: {curRetry}')
+                logger.debug(f'Retrying putting modem offline: {curRetry}')
+                currentSpan().count('offlineRetries')
             try:
-                subprocess.run([qmicliPath, '-p', '-d', modemDevPath, '--dms-set-operating-mode=reset'], check=True, encoding='utf-8')
-            except subprocess.CalledProcessError as e:
+                setOperatingMode('offline')
+            except (subprocess.CalledProcessError, QmiError) as e:
                 # TODO: if captureing output, could look for message like
                 # error: couldn't create client for the 'dms' service: CID allocation failed in the CTL client: Transaction timed out
                 logger.warn(f'Could not put modem in offline mode: {e}')
             else:
                 break
-        else:
-            raise RuntimeError('Failed to reset the modem')
 
-    # issue modem reset
-    logger.debug('Issuing qmi mode reset command now !!!')
-    waitForModemGoneAfterCall(methodToCall=resetWithQmiCli, vidPid=vidPid, pickFirstDevice=pickFirstDevice)
+        def resetWithQmi():
+            for curRetry in range(0, resetRetries):
+                if curRetry > 0:
+                    logger.debug(f'Retrying putting modem in reset: {curRetry}')
+                    currentSpan().count('resetRetries')
+                try:
+                    setOperatingMode('reset')
+                except (subprocess.CalledProcessError, QmiError) as e:
+                    # TODO: if captureing output, could look for message like
+                    # error: couldn't create client for the 'dms' service: CID allocation failed in the CTL client: Transaction timed out
+                    logger.warn(f'Could not put modem in offline mode: {e}')
+                else:
+                    break
+            else:
+                raise RuntimeError('Failed to reset the modem')
 
+        # issue modem reset
+        logger.debug('Issuing qmi mode reset command now !!!')
+        waitForModemGoneAfterCall(methodToCall=resetWithQmi, vidPid=vidPid, pickFirstDevice=pickFirstDevice)
+    finally:
+        if qmiClient is not None:
+            qmiClient.close()
 
-def resetModem(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None):
-    qmiResetModem(vidPid=vidPid, maxRetries=maxRetries, interval=interval, pickFirstDevice=pickFirstDevice)
-    #resetModemUsb(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
 
+@traced()
+def resetModem(vidPid=None, timeout:float=None, pickFirstDevice:bool=None):
+    qmiResetModem(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
+    #resetModemUsb(vidPid=vidPid, timeout=timeout)
 
-def setModemToQmiMode(vidPid=None, maxRetries:int=None, interval:float=None, pickFirstDevice:bool=None):
-    qmicliPath = getQmicliBinaryPath()
 
-    modemDevPath = waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval, pickFirstDevice=pickFirstDevice)
+@traced()
+def setModemToQmiMode(vidPid=None, timeout:float=None, pickFirstDevice:bool=None):
+    modemDevPath = waitForModemDevice(vidPid=vidPid, timeout=timeout, pickFirstDevice=pickFirstDevice)
 
     # Make sure basic device mode is exposed w qmi
     '''
@@ -594,16 +406,28 @@ def setModemToQmiMode(vidPid=None, maxRetries:int=None, interval:float=None, pic
             USB composition 9: MBIM
     '''
 
-    subprocess.run([qmicliPath, '-p', '-d', modemDevPath, '--dms-swi-set-usb-composition=6'], check=True, encoding='utf-8')
+    if useQmiClient:
+        with QmiClient(modemDevPath) as qmiClient:
+            qmiClient.setUsbComposition(6)
+        return
 
+    subprocess.run([getQmicliBinaryPath(), '-p', '-d', modemDevPath, '--dms-swi-set-usb-composition=6'], check=True, encoding='utf-8')
 
-def qmiFactoryDefaultModem(serviceProgCode:str=None, vidPid=None, maxRetries:int=None, interval:float=None):
+
+@traced()
+def qmiFactoryDefaultModem(serviceProgCode:str=None, vidPid=None, timeout:float=None):
     if serviceProgCode is None:
         serviceProgCode = '000000'
 
-    qmicliPath = getQmicliBinaryPath()
+    modemDevPath = waitForModemDevice(vidPid=vidPid, timeout=timeout)
 
-    modemDevPath = waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
+    if useQmiClient:
+        with QmiClient(modemDevPath) as qmiClient:
+            qmiClient.validateServiceProgrammingCode(serviceProgCode)
+            qmiClient.restoreFactoryDefaults(serviceProgCode)
+        return
+
+    qmicliPath = getQmicliBinaryPath()
 
     # Verify the programming code is correct (just in case; this helps debug)
     subprocess.run([qmicliPath, '-p', '-d', modemDevPath, f'--dms-validate-service-programming-code={serviceProgCode}'], check=True, encoding='utf-8')
@@ -616,30 +440,173 @@ def noop():
     pass
 
 
-def getSendAtCommand(spawn) -> Callable[[str, Any, int], None]:
-    def sendAtCommand(command: str, expectedResponse=None, waitTime:int=None, sleepAfter:int=None) -> None:
-        if expectedResponse is None:
-            expectedResponse = ['OK']
-        if waitTime is None:
-            waitTime = 5
-        if sleepAfter is None:
-            sleepAfter = 1
+def normalizeAtResponseText(text:str) -> str:
+    '''
+    Make query responses comparable: upper case, no quotes and no spaces/tabs (line breaks are kept)
+    '''
+    return re.sub(r'[ \t"]', '', text.upper())
 
-        if not isinstance(expectedResponse, list):
-            expectedResponse = [expectedResponse]
 
-        spawn.send(f'{command}\r\n')
+def getModemSettingsDiff(atSession:AtSession, desiredSettings:list) -> list:
+    '''
+    Query the current value of each desired setting
+
+    :return: The settings that are not applied yet, in order
+    '''
+    # a few settings share a query (ie. AT!CUSTOM?); only ask once
+    queryResponseDict = {}
+    settingsToApply = []
+    for curSetting in desiredSettings:
+        if curSetting.queryCommand not in queryResponseDict:
+            queryResponse = atSession.sendAtCommand(curSetting.queryCommand, check=False)
+            queryResponseDict[curSetting.queryCommand] = normalizeAtResponseText(queryResponse.text) if queryResponse.success else None
+        queryResponseText = queryResponseDict[curSetting.queryCommand]
+
+        if queryResponseText is None:
+            # could not query it; just apply it
+            logger.debug(f'{curSetting.name}: could not query it; will apply it')
+            settingsToApply.append(curSetting)
+        elif any(curApplied.name == curSetting.resetBy for curApplied in settingsToApply):
+            logger.debug(f'{curSetting.name}: applying {curSetting.resetBy} resets it; will apply it')
+            settingsToApply.append(curSetting)
+        elif re.search(curSetting.expectedPattern, queryResponseText, re.MULTILINE) is None:
+            logger.debug(f'{curSetting.name}: not set as desired ({queryResponseText!r}); will apply it')
+            settingsToApply.append(curSetting)
+        else:
+            logger.debug(f'{curSetting.name}: already set')
+
+    return settingsToApply
+
+
+def parseModemImageInventory(imageText:str) -> dict:
+    '''
+    Parse the AT!IMAGE? listing into the firmware slots of the modem
+
+    :return: Dictionary of slot index -> ModemImageSlot
+    '''
+    fwRowList = []
+    # the PRIs are not in slots; they belong to whichever firmware has the same build id
+    priVersionDict = {}
+    for curMatch in AT_IMAGE_ROW_REGEX.finditer(imageText):
+        if curMatch.group('type').upper() == 'FW':
+            fwRowList.append(curMatch)
+        elif curMatch.group('buildId') is not None and curMatch.group('status').upper() == AT_IMAGE_GOOD_STATUS:
+            priVersionDict.setdefault(curMatch.group('buildId').upper(), []).append(curMatch.group('uniqueId'))
+
+    slotDict = {}
+    for curMatch in fwRowList:
+        curBuildId = curMatch.group('buildId')
+        slotDict[int(curMatch.group('slot'))] = ModemImageSlot(
+            slotIndex=int(curMatch.group('slot')),
+            status=curMatch.group('status'),
+            buildId=curBuildId,
+            priVersions=tuple(priVersionDict.get(curBuildId.upper(), [])) if curBuildId is not None else ())
+
+    return slotDict
+
+
+def getModemImageInventory(atSession:AtSession) -> dict:
+    return parseModemImageInventory(atSession.sendAtCommand('AT!IMAGE?', waitTime=10).text)
+
+
+@traced()
+def getModemSlotsToFlash(atSession:AtSession, firmwareToApply:list, carrierFileDict:dict) -> tuple:
+    '''
+    Compare the firmware slots of the modem with the firmware we want in them (the carriers go in slots 1, 2, ... in
+    order)
+
+    :return: ([(slot index, carrier name)] of the slots that do not have the firmware and PRI we want yet,
+              [slot index] of the slots after ours that still have firmware in them)
+    '''
+    slotDict = getModemImageInventory(atSession)
+
+    slotsToFlash = []
+    for curSlotIndex, curCarrierName in enumerate(firmwareToApply, start=1):
+        nvuFilename = getCarrierNvuFilename(carrierFileDict, curCarrierName)
+        imageVersion = getCarrierImageVersion(nvuFilename)
+        curSlot = slotDict.get(curSlotIndex)
+        if imageVersion is None:
+            logger.debug(f'Can not tell the firmware version of {curCarrierName} from {nvuFilename}; flashing it')
+        elif curSlot is None or not curSlot.hasImage(*imageVersion):
+            logger.debug(f'Slot {curSlotIndex} has {curSlot}; want {imageVersion[0]} ({imageVersion[1]}) for {curCarrierName}')
+        else:
+            logger.debug(f'Slot {curSlotIndex} already has {imageVersion[0]} ({imageVersion[1]}) for {curCarrierName}')
+            continue
+        slotsToFlash.append((curSlotIndex, curCarrierName))
+
+    # AT!IMPREF="AUTO-SIM" can switch to any image on the modem, so only ours may be left on it
+    slotsToClear = []
+    for curSlotIndex, curSlot in sorted(slotDict.items()):
+        if curSlotIndex > len(firmwareToApply) and curSlot.status.upper() == AT_IMAGE_GOOD_STATUS:
+            logger.debug(f'Slot {curSlotIndex} has {curSlot.buildId}, which we do not want')
+            slotsToClear.append(curSlotIndex)
+
+    return slotsToFlash, slotsToClear
+
+
+def isFirmwareLoaded(atSession:AtSession, firmwareToApply:list, carrierFileDict:dict) -> bool:
+    '''
+    Check that the firmware slots of the modem are exactly what configureModem() would leave in them (see
+    getModemSlotsToFlash())
+    '''
+    slotsToFlash, slotsToClear = getModemSlotsToFlash(atSession, firmwareToApply, carrierFileDict)
+    return len(slotsToFlash) == 0 and len(slotsToClear) == 0
+
+
+@traced()
+def applyModemSettingsDiff(atSession:AtSession, vidPid=None, firmwareToApply:list=None, carrierFileDict:dict=None) -> bool:
+    '''
+    Bring an already flashed modem to the desired configuration by only applying the settings that differ; no factory
+    reset, no image wipe and only the resets the applied settings need
+
+    :return: False if the firmware is not what we want (a full configureModem() run is needed), otherwise True
+    '''
+    if firmwareToApply is None:
+        firmwareToApply = DEFAULT_FIRMWARE_ORDER_LIST
+
+    waitForModemDevice(vidPid=vidPid, pickFirstDevice=True)
+
+    # unlock "privileged" commands on the modem
+    atSession.ensureUnlocked()
+
+    if not isFirmwareLoaded(atSession, firmwareToApply, carrierFileDict):
+        return False
+
+    # the base settings and first gps settings go in together; they all get stored by the reset after them
+    settingsToApply = getModemSettingsDiff(atSession, MODEM_BASE_SETTINGS) + getModemSettingsDiff(atSession, MODEM_GPS_SETTINGS)
+    if len(settingsToApply) > 0:
+        logger.info(f'Applying settings: {[curSetting.name for curSetting in settingsToApply]}')
+        atSession.sendBatch([curSetting.setCommand for curSetting in settingsToApply])
+
+        # The modem may reset itself after NV settings; let it, then reset it ourselves to store the settings
+        explicitTimeout:float = None
         try:
-            spawn.expect(expectedResponse + [EOF], waitTime)
-        except TIMEOUT as e:
-            e.__cause__ = RuntimeError(f'Output did not match expected response:\n{expectedResponse}\nfound before:\n{spawn.before}\nfound after:\n{spawn.after}')
-            raise e
-        time.sleep(sleepAfter)
-    return sendAtCommand
+            waitForModemGoneAfterCall(noop, vidPid=vidPid, pickFirstDevice=True)
+        except UsbDeviceFoundError:
+            pass
+        else:
+            explicitTimeout = MODEM_REBOOT_WAIT_TIMEOUT
+        waitForModemDevice(vidPid=vidPid, timeout=explicitTimeout)
+        if explicitTimeout is not None:
+            resetModemUsb(vidPid=vidPid)
+        resetModem(vidPid=vidPid)
+        waitForModemDevice(vidPid=vidPid, timeout=MODEM_REBOOT_WAIT_TIMEOUT)
 
+    # the reset locked "privileged" commands again; the queries below need them unlocked too
+    atSession.ensureUnlocked()
 
+    settingsToApply = getModemSettingsDiff(atSession, MODEM_GPS_POST_RESET_SETTINGS)
+    if len(settingsToApply) > 0:
+        logger.info(f'Applying settings: {[curSetting.name for curSetting in settingsToApply]}')
+        atSession.sendBatch([curSetting.setCommand for curSetting in settingsToApply])
+        resetModem(vidPid=vidPid)
+        waitForModemDevice(vidPid=vidPid)
 
-def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A710') -> None:
+    return True
+
+
+@traced()
+def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A710', vidPid=None, carrierFileDict:dict=None, diffOnly:bool=None, atLogfile=None) -> None:
     '''
     Method to configure a modem as desired for our carrier(s) and GPS.  This method requires the modem to be currently
     exposing its AT interface via the specified serial device path and for the unlock password provided to work
@@ -648,55 +615,59 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
     :param firmwareToApply: A list of firmware files to expect to exist and be applied.  Each file should be a zip
                             and contain 2 file: the firmware is the .CWE file and the .NVU is the carrier
                             provisioning PRI file
+    :param vidPid: Device spec of the modem to configure (see getDeviceMatcher()); use a port path or serial spec to
+                   pick one modem out of several
+    :param carrierFileDict: Already unpacked firmware files (from prepareCarrierFirmware() or
+                            startCarrierFirmwarePrep()); if not set, the firmware is unpacked in the background while the
+                            modem resets
+    :param diffOnly: Query the modem first and only apply what is not set as desired yet (see applyModemSettingsDiff());
+                     falls back to the full configuration if the firmware needs flashing
+    :param atLogfile: Where to echo the AT conversation (see AtSession); defaults to sys.stdout
     '''
 
     if firmwareToApply is None:
         firmwareToApply = DEFAULT_FIRMWARE_ORDER_LIST
+    if diffOnly is None:
+        diffOnly = False
 
-    modemFirmwareDirPath = os.path.realpath(MODEM_FIRMWARE_DIRNAME)
-    carrierFileDict = {}
-    for curCarrierName in firmwareToApply:
-        logger.debug(f'Unzipping firmware for carrier {curCarrierName}')
-        curCarrierZip = os.path.join(modemFirmwareDirPath, f'{curCarrierName}@*.zip')
+    # the resets below mostly wait on usb; unpack the firmware meanwhile, the flashing waits for each carrier if needed
+    if carrierFileDict is None:
+        carrierFileDict = startCarrierFirmwarePrep(firmwareToApply)
 
-        # deglob carrier zip file
-        deglobbedList = glob.glob(curCarrierZip)
-        if len(deglobbedList) != 1:
-            raise RuntimeError(f'Wrong number of matches found (want exactly 1) when deglobbing firmware files for carrier {curCarrierName}: {json.dumps(deglobbedList, indent=4)}')
-        curCarrierZip = deglobbedList[0]
+    # one AT session for the whole run; it reconnects (and re-unlocks) by itself after the modem reboots
+    atSession = AtSession(
+        lambda: serialDevPath if serialDevPath is not None else waitForModemAtDevice(vidPid=vidPid),
+        unlockPassword=unlockPassword,
+        logfile=atLogfile)
+    sendAtCommand = atSession.sendAtCommand
 
-        carrierFileDict[curCarrierName] = unpackCarrierZip(curCarrierName, curCarrierZip)
+    with atSession:
+        if diffOnly:
+            if applyModemSettingsDiff(atSession, vidPid=vidPid, firmwareToApply=firmwareToApply, carrierFileDict=carrierFileDict):
+                logger.info('Modem is configured')
+                return
+            logger.info('Modem firmware needs flashing; doing a full configuration')
 
-    # Make sure the modem is ready (reset it first)
-    resetModemUsb(pickFirstDevice=True)
+        # Make sure the modem is ready (reset it first)
+        resetModemUsb(vidPid=vidPid, pickFirstDevice=True)
 
-    time.sleep(1)
+        time.sleep(1)
 
-    resetModem(pickFirstDevice=True)
+        resetModem(vidPid=vidPid, pickFirstDevice=True)
 
-    # Make sure device is in qmi mode
-    setModemToQmiMode(pickFirstDevice=True)
+        # Make sure device is in qmi mode
+        setModemToQmiMode(vidPid=vidPid, pickFirstDevice=True)
     
-    # Reset the modem to ensure settings take
-    resetModem(pickFirstDevice=True)
-
-    # factory reset modem
-    # Note: cant get this to work ATM, so doing this with AT command
-    #qmiFactoryDefaultModem()
-    waitForModemDevice()
+        # Reset the modem to ensure settings take
+        resetModem(vidPid=vidPid, pickFirstDevice=True)
 
-    # auto-discover at device name
-    curSerialDevPath = serialDevPath
-    if serialDevPath is None:
-        curSerialDevPath = waitForModemAtDevice()
-
-    with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-        spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
-
-        sendAtCommand = getSendAtCommand(spawn)
+        # factory reset modem
+        # Note: cant get this to work ATM, so doing this with AT command
+        #qmiFactoryDefaultModem()
+        waitForModemDevice(vidPid=vidPid)
 
         # unlock "privileged" commands on the modem
-        sendAtCommand(f'AT!ENTERCND="{unlockPassword}"', waitTime=10)
+        atSession.ensureUnlocked()
 
         # example output from rmareset 
         '''
@@ -713,83 +684,73 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         # <restore point> = 1—“Provision” (Sierra-provisioned SKU configuration)
         # Note: give this some extra time to respond
         sendAtCommand('AT!RMARESET=1', expectedResponse='!RMARESET: DEVICE REBOOT REQUIRED', waitTime=10)
-    
-    # Reset the modem to ensure modem at factory defaults
-    resetModemUsb(pickFirstDevice=True)
-    resetModem(pickFirstDevice=True)
-
-    # Note: the modem may actually reboot twice; watchout! Lets give it some time to see if it will reboot a second time on its own.
-    try:
-        waitForModemGoneAfterCall(noop, pickFirstDevice=True)
-    except UsbDeviceFoundError:
-        pass
-
-    # Give this command some extra buffer time since the modem DID just factory reset; it might take a minute to reappear (this should wait up to roughly 90 seconds)
-    setModemToQmiMode(pickFirstDevice=True, maxRetries=30)
-    resetModem(pickFirstDevice=True) 
-
-    modemQmiDev = waitForModemDevice()
 
-    # auto-discover at device name
-    curSerialDevPath = serialDevPath
-    if serialDevPath is None:
-        curSerialDevPath = waitForModemAtDevice()
-
-    # Dont erase the firmware if we are not programming firmware; the rest of the process gets skipped a different way
-    if os.getenv('SKIP_FIRMWARE_APPLY') != 'true':
-        with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-            spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
-
-            sendAtCommand = getSendAtCommand(spawn)
+        # Reset the modem to ensure modem at factory defaults
+        resetModemUsb(vidPid=vidPid, pickFirstDevice=True)
+        resetModem(vidPid=vidPid, pickFirstDevice=True)
 
+        # Note: the modem may actually reboot twice; watchout! Lets give it some time to see if it will reboot a second time on its own.
+        try:
+            waitForModemGoneAfterCall(noop, vidPid=vidPid, pickFirstDevice=True)
+        except UsbDeviceFoundError:
+            pass
+
+        # Give this command some extra buffer time since the modem DID just factory reset; it might take a minute to reappear
+        setModemToQmiMode(vidPid=vidPid, pickFirstDevice=True, timeout=MODEM_REBOOT_WAIT_TIMEOUT)
+        resetModem(vidPid=vidPid, pickFirstDevice=True) 
+
+        modemQmiDev = waitForModemDevice(vidPid=vidPid)
+
+        # Only flash the slots that do not have what we want yet; each flash is a modem reboot
+        # Note: this needs every carrier's files, so it waits for the rest of the firmware prep; a carrier whose prep
+        # failed raises here, before any image is wiped
+        slotsToFlash = []
+        slotsToClear = []
+        # Dont erase the firmware if we are not programming firmware; the rest of the process gets skipped a different way
+        if os.getenv('SKIP_FIRMWARE_APPLY') != 'true':
             # unlock "privileged" commands on the modem
-            sendAtCommand(f'AT!ENTERCND="{unlockPassword}"', waitTime=10)
-            # clear all firmware images
-            sendAtCommand('AT!IMAGE=0')
-        # reset the modem
-        resetModem()
-        waitForModemDevice()
-
-    # TODO: Move the firmware loading to a method
+            atSession.ensureUnlocked()
+            slotsToFlash, slotsToClear = getModemSlotsToFlash(atSession, firmwareToApply, carrierFileDict)
+
+        if len(slotsToFlash) == 0 and len(slotsToClear) == 0:
+            logger.info('Modem firmware slots already have the firmware we want; not flashing')
+        else:
+            if len(slotsToFlash) == len(firmwareToApply):
+                # clear all firmware images
+                sendAtCommand('AT!IMAGE=0')
+            else:
+                # only clear the firmware images we are replacing, and any we do not want at all
+                for curSlotIndex in [curSlotIndex for curSlotIndex, _ in slotsToFlash] + slotsToClear:
+                    sendAtCommand(f'AT!IMAGE=0,0,{curSlotIndex}')
+            # reset the modem
+            resetModem(vidPid=vidPid)
+            waitForModemDevice(vidPid=vidPid)
+
+        # TODO: Move the firmware loading to a method
     
-    firmwareCommandArgs = [getQmiFlashBinaryPath(), '--update', '-d', '1199:9071', '--override-download']
-    # flash each set of firmware files
-    slotIndex = 0
-    for curCarrierName in firmwareToApply:
-        slotIndex += 1
-        logger.debug(f'Flashing firmware for carrier {curCarrierName} to slot {slotIndex}')
-        # Add on carrier files; each time this is called, the modem will USB will do away AGAIN and come back before its ready
-        waitForModemGoneAfterCall(
-            methodToCall=lambda :subprocess.run(firmwareCommandArgs + [f'--modem-storage-index={slotIndex}'] + carrierFileDict[curCarrierName], check=True, encoding='utf-8'))
-        # give the modem a moment to be ready (for a new image?)
-        logger.debug('Waiting for modem to return ...')
-        waitForModemDevice()
-        # This is good for diag AND to tell us the modem is ready
-        # auto-discover at device name
-        curSerialDevPath = serialDevPath
-        if serialDevPath is None:
-            curSerialDevPath = waitForModemAtDevice()
-
-        with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-            spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
-
-            sendAtCommand = getSendAtCommand(spawn)
-            
-            sendAtCommand('AT!IMAGE?', waitTime=10)
-
-    # auto-discover at device name
-    curSerialDevPath = serialDevPath
-    if serialDevPath is None:
-        curSerialDevPath = waitForModemAtDevice()
-
-    with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-        spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
-
-        sendAtCommand = getSendAtCommand(spawn)
+        firmwareCommandArgs = [getQmiFlashBinaryPath(), '--update', '--override-download']
+        # flash each set of firmware files
+        for slotIndex, curCarrierName in slotsToFlash:
+            with traceSpan('waitForCarrierFirmware', carrier=curCarrierName):
+                carrierFiles = getCarrierFirmwareFiles(carrierFileDict, curCarrierName)
+            with traceSpan('flashSlot', slot=slotIndex, carrier=curCarrierName):
+                logger.debug(f'Flashing firmware for carrier {curCarrierName} to slot {slotIndex}')
+                # select the modem by its qmi device (not by vid:pid) so this works with more than one modem attached
+                modemQmiDev = waitForModemDevice(vidPid=vidPid)
+                # Add on carrier files; each time this is called, the modem will USB will do away AGAIN and come back before its ready
+                waitForModemGoneAfterCall(
+                    vidPid=vidPid,
+                    methodToCall=traced('qmi-firmware-update')(lambda :subprocess.run(firmwareCommandArgs + [f'--cdc-wdm={modemQmiDev}', f'--modem-storage-index={slotIndex}'] + carrierFiles, check=True, encoding='utf-8')))
+                # give the modem a moment to be ready (for a new image?)
+                logger.debug('Waiting for modem to return ...')
+                waitForModemDevice(vidPid=vidPid)
+                # This is good for diag AND to tell us the modem is ready
+                sendAtCommand('AT!IMAGE?', waitTime=10)
+            releaseCarrierFirmwareFiles(carrierFileDict, curCarrierName)
 
         # unlock "privileged" commands on the modem
-        sendAtCommand(f'AT!ENTERCND="{unlockPassword}"', waitTime=10)
-        
+        atSession.ensureUnlocked()
+
         # TODO: need to talk to TJ about this; only have single at!sim w xcape apn (on tmo); can this work??? I've had issues...
         # enable auto-sim for firmware hopping+APN
         sendAtCommand('AT!IMPREF="AUTO-SIM"')
@@ -803,29 +764,19 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         sendAtCommand('AT!LTECA=1')
         # Clears Band Restrictions
         sendAtCommand('AT!BAND=00')
-    # Reboot the modem
-    resetModem()
-    # wait for modem to come back
-    waitForModemDevice(maxRetries=30)
+        # Reboot the modem
+        resetModem(vidPid=vidPid)
+        # wait for modem to come back
+        waitForModemDevice(vidPid=vidPid, timeout=MODEM_REBOOT_WAIT_TIMEOUT)
 
-    # Give the modem a couple seconds to settle down
-    time.sleep(2)
-
-    # auto-discover at device namef
-    curSerialDevPath = serialDevPath
-    if serialDevPath is None:
-        curSerialDevPath = waitForModemAtDevice()
-
-    with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-        spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
-
-        sendAtCommand = getSendAtCommand(spawn)
+        # Give the modem a couple seconds to settle down
+        time.sleep(2)
 
         # Get a final statement about the loaded images
         sendAtCommand('AT!IMAGE?', waitTime=10)
 
         # unlock "privileged" commands on the modem
-        sendAtCommand(f'AT!ENTERCND="{unlockPassword}"', waitTime=10)
+        atSession.ensureUnlocked()
 
         # disable gps auto start
         #sendAtCommand('AT!GPSAUTOSTART=0')
@@ -833,9 +784,12 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         # stop any running gps sessions
         #sendAtCommand('AT!GPSEND=0,255')
 
+        # The gps settings below are independent of each other (other than ordering); send them as one batch
+        gpsCommands = []
+
         ## undocumented command to enable xtra location assistance
         # Note: this MUST go before posmode options as it will reset them
-        sendAtCommand('AT!GPSXTRADATAENABLE=1,3,10,1,24')
+        gpsCommands.append('AT!GPSXTRADATAENABLE=1,3,10,1,24')
 
         # enabled ALL GPS modes
         #sendAtCommand('AT!GPSPOSMODE=7F')
@@ -863,7 +817,7 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         Bit24-A-Glonass CP MS-Assisted(4G)
         '''
         # Enable EVERYTHING
-        sendAtCommand('AT!GPSPOSMODE=1FE037F')
+        gpsCommands.append('AT!GPSPOSMODE=1FE037F')
 
         # TODO: make sure we double check all these settings...
 
@@ -875,14 +829,13 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         #SUPL_NO_SECURE_PORT=3425
         #############################
 
-        try:
-            # get the current server name for assisted gps http calls
-            #sendAtCommand('AT!GPSSUPLURL?', expectedResponse='supl.google.com:7275')
-            sendAtCommand('AT!GPSSUPLURL?', expectedResponse='supl.google.com:7276')
-        except TIMEOUT:
+        # get the current server name for assisted gps http calls
+        #suplUrlResponse = sendAtCommand('AT!GPSSUPLURL?', expectedResponse='supl.google.com:7275', check=False)
+        suplUrlResponse = sendAtCommand('AT!GPSSUPLURL?', expectedResponse='supl.google.com:7276', check=False)
+        if not suplUrlResponse.contains('supl.google.com:7276'):
             # set the server name for assisted gps http calls
-            #sendAtCommand('AT!GPSSUPLURL="supl.google.com:7275"')
-            sendAtCommand('AT!GPSSUPLURL="supl.google.com:7276"')
+            #gpsCommands.append('AT!GPSSUPLURL="supl.google.com:7275"')
+            gpsCommands.append('AT!GPSSUPLURL="supl.google.com:7276"')
 
 
         '''try:
@@ -904,7 +857,7 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
 
         # enable transport security (tls) for assisted gps calls
         # disabled
-        sendAtCommand('AT!GPSTRANSSEC=0')
+        gpsCommands.append('AT!GPSTRANSSEC=0')
         # enabled... ish
         #sendAtCommand('AT!GPSTRANSSEC=1')
         # enabled... tls1.1, sha1, sha256
@@ -912,9 +865,11 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         #sendAtCommand('AT!GPSTRANSSEC=7')
         ##### GOBIIM ?
         # set the agps supl version to 2
-        sendAtCommand('AT!GPSSUPLVER=2')
+        gpsCommands.append('AT!GPSSUPLVER=2')
+
+        gpsCommands.append('AT!CUSTOM="GPSLPM",1')
 
-        sendAtCommand('AT!CUSTOM="GPSLPM",1')
+        atSession.sendBatch(gpsCommands)
 
         # When using an external powered antenna
         #AT+WANT=1
@@ -925,40 +880,29 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         ## orig
         #AT!GPSNMEASENTENCE=3F
 
-    # Whenever we run a "custom"  NV setting AT command, it seems to make the dive reset itself afterwards; lets account for this
-    explicitRetryCount:int = None
-    try:
-        waitForModemGoneAfterCall(noop, pickFirstDevice=True)
-    except UsbDeviceFoundError:
-        pass
-    else:
-        # if the device DID disconnect, we want to wait a little longer for it to reboot if needed
-        explicitRetryCount = 30
-        # otherwise, we just use the defaults
-
-    # we did a lot of things;
-    # Reboot the modem to ensure settings are stored
-    waitForModemDevice(maxRetries=explicitRetryCount)
-
-    # If the nv settings caused a reboot, we probably need to reset the usb before we can reset the modem
-    if explicitRetryCount is not None:
-        resetModemUsb()
-    resetModem()
-    # wait for modem to come back
-    waitForModemDevice()
-
-    # auto-discover at device name
-    curSerialDevPath = serialDevPath
-    if serialDevPath is None:
-        curSerialDevPath = waitForModemAtDevice()
+        # Whenever we run a "custom"  NV setting AT command, it seems to make the dive reset itself afterwards; lets account for this
+        explicitTimeout:float = None
+        try:
+            waitForModemGoneAfterCall(noop, vidPid=vidPid, pickFirstDevice=True)
+        except UsbDeviceFoundError:
+            pass
+        else:
+            # if the device DID disconnect, we want to wait a little longer for it to reboot if needed
+            explicitTimeout = MODEM_REBOOT_WAIT_TIMEOUT
+            # otherwise, we just use the defaults
 
-    with serial.Serial(curSerialDevPath, 115200, timeout=0) as ser:
-        spawn = pexpect.fdpexpect.fdspawn(ser, encoding='utf-8', logfile = sys.stdout)
+        # we did a lot of things;
+        # Reboot the modem to ensure settings are stored
+        waitForModemDevice(vidPid=vidPid, timeout=explicitTimeout)
 
-        sendAtCommand = getSendAtCommand(spawn)
+        # If the nv settings caused a reboot, we probably need to reset the usb before we can reset the modem
+        if explicitTimeout is not None:
+            resetModemUsb(vidPid=vidPid)
+        resetModem(vidPid=vidPid)
+        # wait for modem to come back
+        waitForModemDevice(vidPid=vidPid)
 
-        # unlock "privileged" commands on the modem
-        sendAtCommand(f'AT!ENTERCND="{unlockPassword}"', waitTime=10)
+        gpsCommands = []
 
         ### Set an APN for gps subsystem to use to download data
         #sendAtCommand('AT!GPSLBSAPN=1,0x1F,"IPV4V6","iot.acsdynamic"')
@@ -966,10 +910,10 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
 
         ## recomended nmea sentance for more satellites, etc
         #sendAtCommand('AT!GPSNMEASENTENCE=29FF')
-        sendAtCommand('AT!GPSNMEASENTENCE=7FFF')
+        gpsCommands.append('AT!GPSNMEASENTENCE=7FFF')
         #sendAtCommand('AT!GPSNMEASENTENCE=21FF')
         # Use the aux antenna for shared GPS/RX purposes (GPS/Rx diversity antenna)
-        sendAtCommand('AT!CUSTOM="GPSSEL",0') # use 0 if on external antenna only
+        gpsCommands.append('AT!CUSTOM="GPSSEL",0') # use 0 if on external antenna only
 
         ## send a single fix request to get agps seeded
         #spawn.send('AT!GPSFIX=2,30,4294967280\r\n')
@@ -983,14 +927,17 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         # this mode requires sending the string '$GPS_START' to the gps serial port to trigger the automated sessions creation
         ## note: the google server does not support msa, only msb, hence mode 2 (msb)
         #spawn.send('AT!GPSAUTOSTART=2,2,10,4294967280,15\r\n')
-        sendAtCommand('AT!GPSAUTOSTART=2,2,60,4294967280,1')
-        
+        gpsCommands.append('AT!GPSAUTOSTART=2,2,60,4294967280,1')
+
+        # unlock "privileged" commands on the modem (again, if it rebooted) and send the rest of the gps settings
+        atSession.sendBatch(gpsCommands, unlock=True)
+
         #AT!GPSFIX=2,255,4294967280
-        
+
         #AT!GPSstatus?
         #at!GPSSATINFO?
 
-        
+
         #AT!GPSXTRAINITDNLD
         #AT!GPSPOSMODE=7f
         #at!GPSXTRASTATUS?
@@ -998,35 +945,129 @@ def configureModem(serialDevPath, firmwareToApply:list=None, unlockPassword='A71
         # Putting this note here.
         # Fun fact: on boot, the nmea port is at 115200, but when you enable nmea and raw mode with mmcli, it changes to 9600 . -_-  and if you dont knwo that, it looks like it just stops
 
-    # The modem has been seen to disconnect/reconnect at the end of all of this; give some cushion for that to happen before we force reboot it
-    # Whenever we run a "custom"  NV setting AT command, it seems to make the dive reset itself afterwards; lets account for this
-    explicitRetryCount:int = None
-    try:
-        waitForModemGoneAfterCall(noop, pickFirstDevice=True)
-    except UsbDeviceFoundError:
-        pass
-    else:
-        # if the device DID disconnect, we want to wait a little longer for it to reboot if needed
-        explicitRetryCount = 30
-        # otherwise, we just use the defaults
+        # The modem has been seen to disconnect/reconnect at the end of all of this; give some cushion for that to happen before we force reboot it
+        # Whenever we run a "custom"  NV setting AT command, it seems to make the dive reset itself afterwards; lets account for this
+        explicitTimeout:float = None
+        try:
+            waitForModemGoneAfterCall(noop, vidPid=vidPid, pickFirstDevice=True)
+        except UsbDeviceFoundError:
+            pass
+        else:
+            # if the device DID disconnect, we want to wait a little longer for it to reboot if needed
+            explicitTimeout = MODEM_REBOOT_WAIT_TIMEOUT
+            # otherwise, we just use the defaults
+
+        # we did a lot of things;
+        # Reboot the modem to ensure settings are stored
+        waitForModemDevice(vidPid=vidPid, timeout=explicitTimeout)
+
+        # If the nv settings caused a reboot, we probably need to reset the usb before we can reset the modem
+        if explicitTimeout is not None:
+            resetModemUsb(vidPid=vidPid)
+        resetModem(vidPid=vidPid)
+        # wait for modem to come back
+        waitForModemDevice(vidPid=vidPid)
+
+        #with serial.Serial(gps_serial_dev_path, 115200, timeout=0) as ser:
+        #    ser.write(b'$GPS_START\r\n')
+
+
+@dataclass
+class ModemConfigResult:
+    '''
+    Outcome of configuring one modem in fleet mode
+
+    :param deviceSpec: Device spec the worker was bound to (ie. port:1-1.2)
+    :param error: The exception that stopped the configuration, or None if it worked
+    :param durationSeconds: Wall time the configuration took
+    '''
+    deviceSpec: str
+    error: BaseException = None
+    durationSeconds: float = None
+
+    @property
+    def success(self) -> bool:
+        return self.error is None
+
+
+def getFleetDeviceSpecs(vidPid=None, bindBy:str=None) -> list:
+    '''
+    Get a device spec for every attached modem that matches vidPid, bound to that one modem
+
+    :param bindBy: 'port' to bind by usb port path (default) or 'serial' to bind by usb serial number
+    '''
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
+    if bindBy is None:
+        bindBy = 'port'
+
+    deviceSpecList = []
+    for curUsbDevice in findUsbDevices(vidPid):
+        if bindBy == 'serial':
+            if curUsbDevice.serial is None:
+                raise RuntimeError(f'Can not bind to modem by serial; it does not have one: {curUsbDevice}')
+            deviceSpecList.append(f'{DEVICE_SPEC_SERIAL_PREFIX}{curUsbDevice.serial}')
+        else:
+            deviceSpecList.append(f'{DEVICE_SPEC_PORT_PREFIX}{curUsbDevice.portPath}')
+
+    return deviceSpecList
+
 
-    # we did a lot of things;
-    # Reboot the modem to ensure settings are stored
-    waitForModemDevice(maxRetries=explicitRetryCount)
+@traced()
+def configureModemFleet(deviceSpecList:list=None, firmwareToApply:list=None, unlockPassword='A710', maxWorkers:int=None, diffOnly:bool=None) -> list:
+    '''
+    Configure several modems at once.  Each worker is bound to one modem by its device spec, so the modems can reset and
+    re-enumerate independently of each other
+
+    :param deviceSpecList: One device spec per modem (ie. port:1-1.2 or serial:...); if not set, every attached modem
+                           matching DEFAULT_DEVICE_VID_PID is configured, bound by its usb port path
+    :param firmwareToApply: See configureModem()
+    :param maxWorkers: Max number of modems to configure at the same time
+    :param diffOnly: See configureModem()
+    :return: A ModemConfigResult per modem, in the same order as deviceSpecList
+    '''
+    if deviceSpecList is None:
+        deviceSpecList = getFleetDeviceSpecs()
+    if maxWorkers is None:
+        maxWorkers = DEFAULT_FLEET_MAX_WORKERS
+    if firmwareToApply is None:
+        firmwareToApply = DEFAULT_FIRMWARE_ORDER_LIST
+
+    if len(deviceSpecList) < 1:
+        raise NoUsbDeviceFoundError('No modems found to configure')
+    logger.info(f'Configuring {len(deviceSpecList)} modems, {maxWorkers} at a time: {deviceSpecList}')
+
+    # unpack the firmware once up front; the workers only read it
+    carrierFileDict = prepareCarrierFirmware(firmwareToApply)
+
+    def configureOneModem(deviceSpec):
+        startTime = time.monotonic()
+        try:
+            # the modems share stdout; tag each line of AT traffic with the modem it belongs to
+            atLogfile = PrefixedLogWriter(f'{deviceSpec}: ')
+            configureModem(None, firmwareToApply, unlockPassword, vidPid=deviceSpec, carrierFileDict=carrierFileDict, diffOnly=diffOnly, atLogfile=atLogfile)
+        except Exception as e:
+            logger.exception(f'Failed to configure modem {deviceSpec}')
+            return ModemConfigResult(deviceSpec, error=e, durationSeconds=time.monotonic() - startTime)
+        logger.info(f'Configured modem {deviceSpec}')
+        return ModemConfigResult(deviceSpec, durationSeconds=time.monotonic() - startTime)
+
+    with ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='modem') as executor:
+        resultList = list(executor.map(configureOneModem, deviceSpecList))
 
-    # If the nv settings caused a reboot, we probably need to reset the usb before we can reset the modem
-    if explicitRetryCount is not None:
-        resetModemUsb()
-    resetModem()
-    # wait for modem to come back
-    waitForModemDevice()
+    for curResult in resultList:
+        logger.info(f'{curResult.deviceSpec}: {"ok" if curResult.success else f"FAILED ({curResult.error})"} after {curResult.durationSeconds:.1f} seconds')
 
-    #with serial.Serial(gps_serial_dev_path, 115200, timeout=0) as ser:
-    #    ser.write(b'$GPS_START\r\n')
+    return resultList
 
 
 if __name__ == '__main__':
+    import atexit
     import logging
+    import modem_at
+    import modem_firmware
+    import modem_qmi
+    import modem_usb
 
     # define file handler and set formatter
     streamHandler = logging.StreamHandler()
@@ -1036,14 +1077,36 @@ if __name__ == '__main__':
 
     # add file handler to logger
     logger.addHandler(streamHandler)
+    modem_at.logger.addHandler(streamHandler)
+    modem_firmware.logger.addHandler(streamHandler)
+    modem_qmi.logger.addHandler(streamHandler)
+    modem_usb.logger.addHandler(streamHandler)
 
     # set log level
     logger.setLevel(logging.DEBUG)
+    modem_at.logger.setLevel(logging.DEBUG)
+    modem_firmware.logger.setLevel(logging.DEBUG)
+    modem_qmi.logger.setLevel(logging.DEBUG)
+    modem_usb.logger.setLevel(logging.DEBUG)
+
+    # MODEM_TRACE_FILE=<path> writes a timeline of where the run spent its time (chrome trace json) to that path
+    trace_file = os.getenv('MODEM_TRACE_FILE')
+    if trace_file:
+        startTrace(trace_file)
+        atexit.register(stopTrace)
 
     # Download the firmware images and prep them
     if 'true' != os.getenv('SKIP_FIRMWARE_DL'):
         #  Need to grab Latest T mobile, Verizon, Sprint, and generic; load in that order
-        downloadFirmware(SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, '7455')
+        # FIRMWARE_OFFLINE=true works only from what was downloaded before; FIRMWARE_CATALOG_TTL is in seconds;
+        # FIRMWARE_DOWNLOAD_SEGMENTS splits big downloads into that many parallel byte ranges
+        catalog_ttl = os.getenv('FIRMWARE_CATALOG_TTL')
+        download_segments = os.getenv('FIRMWARE_DOWNLOAD_SEGMENTS')
+        downloadFirmware(
+            SIERRA_WIRELESS_MC74XX_FIRMWARE_URL, '7455',
+            catalogTtl=float(catalog_ttl) if catalog_ttl else None,
+            offline=os.getenv('FIRMWARE_OFFLINE') == 'true',
+            segmentCount=int(download_segments) if download_segments else None)
 
     # TODO: if this gets more complex, implement click
     # call with $(find /dev -mindepth 1 -maxdepth 1 -type l -iname 'mm-at*' | head -1)
@@ -1056,4 +1119,20 @@ if __name__ == '__main__':
     if len(sys.argv) > 2:
         gps_serial_dev_path = sys.argv[2]
 
-    configureModem(serial_dev_path, [] if (os.getenv('SKIP_FIRMWARE_APPLY') == 'true') else None)
\ No newline at end of file
+    firmware_to_apply = [] if (os.getenv('SKIP_FIRMWARE_APPLY') == 'true') else None
+
+    # Only apply what is not already set (re-running on a configured modem takes seconds)
+    diff_only = os.getenv('APPLY_DIFF_ONLY') == 'true'
+
+    # QMI_IN_PROCESS=true talks QMI to the modem directly (modem_qmi) instead of through qmicli -p and qmi-proxy; only
+    # use it when ModemManager is not using the modem
+    useQmiClient = os.getenv('QMI_IN_PROCESS') == 'true'
+
+    # Fleet mode: configure every attached modem (or the ones listed in MODEM_DEVICES) in parallel
+    if os.getenv('MODEM_FLEET') == 'true':
+        fleet_device_specs = os.getenv('MODEM_DEVICES', '').split() or getFleetDeviceSpecs(bindBy=os.getenv('MODEM_FLEET_BIND_BY'))
+        fleet_max_workers = int(os.getenv('MODEM_FLEET_WORKERS', DEFAULT_FLEET_MAX_WORKERS))
+        fleet_results = configureModemFleet(fleet_device_specs, firmware_to_apply, maxWorkers=fleet_max_workers, diffOnly=diff_only)
+        sys.exit(0 if all(curResult.success for curResult in fleet_results) else 1)
+
+    configureModem(serial_dev_path, firmware_to_apply, diffOnly=diff_only)
\ No newline at end of file
@@ -0,0 +1,1328 @@
+#!/opt/modem_config/bin/python3
+'''
+Helpers for getting the modem firmware packages: finding them on the download page, downloading them and unpacking them
+'''
+import os
+import re
+import time
+import json
+import glob
+import shutil
+import hashlib
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, asdict, replace
+from logging import Logger
+from modem_trace import traced
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, unquote as urllib_unquote
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+SIERRA_WIRELESS_MC74XX_FIRMWARE_URL = 'https://source.sierrawireless.com/resources/airprime/minicard/74xx/em_mc74xx-approved-fw-packages'
+
+# FYI: known file hashes; downloads with one of these names have to match
+KNOWN_FIRMWARE_SHA512 = {
+    'TMO (Generic)@SWI9X30C_02.30.01.01_Generic_002.045_002.zip': '18a87c3079efa12f5f4821692a1af3f382e134730e4938748701adbb91fba724127c31c536c32e2f68de44e398ceb92ff21585fbeeb01f1ca70ecd5755fef8b4',
+    'Verizon@SWI9X30C_02.33.03.00_Verizon_002.079_002.zip': 'df8ae45a3a5c1279809e2e26524d10ff831f0617f940daba6bad3f5db58339542ceb3046197b846e9bb48cd1e5e47c8702fef9cb9d01c7a4cdfc42977697d2c6',
+    'Sprint@SWI9X30C_02.32.11.00_Sprint_002.062_003.zip': 'c2833454ec801fb65a9190a698c68a8a306485903aa82d50facd28791cfc8556ff6fcc3ef948c176101602534ee5ccc710d46db99b20b5c58e07c8bdc1f90f0f',
+    'Generic@SWI9X30C_02.33.03.00_Generic_002.072_001.zip': 'bf2a077d344bed69498c560ca5b14f19491a0545b85faef58617e804dedbccb9ef548bfa8d3bdf8b23a038581df4b604aa2f27c983acce2693caaf35b2f5736c',
+}
+
+# Presumed table headers (hardcoded - modelHeader column is the carrier name cells):
+# ${modelHeader}   Firmware   PRI   Firmware Files   Windows EXE   Comment
+FIRMWARE_TABLE_HEADERS = [
+    'Carrier',
+    'Firmware',
+    'PRI',
+    'Firmware Files',
+    'Windows EXE',
+    'Comment'
+]
+
+FIRMWARE_LINK_TABLE_HEADERS = [
+    'Firmware Files',
+    'Windows EXE'
+]
+
+DEFAULT_FIRMWARE_ORDER_LIST = [
+    'TMO (Generic)',
+    'Verizon',
+    'Sprint',
+    # This seems to be causing issues
+    #'Generic'
+]
+
+MODEM_FIRMWARE_DIRNAME = 'modem_firmware'
+
+# downloaded zips are kept in here named by their sha512; the <carrier>@<filename> files are hard links to them
+FIRMWARE_CACHE_DIRNAME = 'cache'
+# carrier -> what was downloaded for it (see FirmwareCacheEntry)
+FIRMWARE_MANIFEST_FILENAME = 'manifest.json'
+# the parsed firmware table of the download page (see getFirmwareCatalog())
+FIRMWARE_CATALOG_FILENAME = 'catalog.json'
+
+# the files we need out of each carrier zip: the firmware and the carrier provisioning PRI
+FIRMWARE_ZIP_MEMBER_EXTENSIONS = ['.cwe', '.nvu']
+# which zip a carrier dir was unpacked from (see unpackCarrierZip())
+UNPACK_STAMP_FILENAME = '.unpacked.json'
+
+# name and version parts of the nvu file name, ie. SWI9X30C_02.33.03.00_VERIZON_002.079_002.nvu
+NVU_FILENAME_REGEX = re.compile(r'_(?P<fwVersion>\d+(?:\.\d+)+)_(?P<carrier>[^_]+)_(?P<priVersion>\d+\.\d+_\d+)\.nvu$', re.IGNORECASE)
+
+# how long the cached firmware table is used without asking the server if the page changed (seconds)
+DEFAULT_CATALOG_TTL = 3600
+
+# Note: a block cut off by a dropped connection never makes it to the .part file, so keep this small
+DOWNLOAD_BLOCK_SIZE = 65536  # 2**16
+
+# (connect, read) timeouts for the download requests (seconds)
+DOWNLOAD_TIMEOUT = (10, 60)
+
+HASH_READ_BLOCK_SIZE = 65536  # 2**16
+
+# how many carrier firmware packages to download at the same time
+DEFAULT_DOWNLOAD_MAX_WORKERS = 4
+
+# how often to log download progress (seconds)
+DOWNLOAD_PROGRESS_INTERVAL = 5
+
+# how many byte ranges of one file to download at the same time (1 downloads front to back and hashes on the way)
+DEFAULT_DOWNLOAD_SEGMENTS = 1
+# files smaller than this are never split into segments
+DOWNLOAD_SEGMENT_MIN_SIZE = 16777216  # 16 Mebibytes
+
+
+class FirmwareDownloadError(RuntimeError):
+    '''
+    One or more carrier firmware downloads failed
+
+    :param errors: Dictionary of carrier name -> exception
+    '''
+    def __init__(self, message, errors:dict):
+        super().__init__(message)
+        self.errors = errors
+
+
+@dataclass(frozen=True)
+class FirmwareCacheEntry:
+    '''
+    What was downloaded for a carrier, so a later run can tell if it is still current
+
+    :param filename: The <carrier>@<filename> name of the zip
+    :param size: Size in bytes
+    :param url: Url the zip came from (after redirects)
+    :param etag: ETag header of the url, if any
+    :param lastModified: Last-Modified header of the url, if any
+    :param sha512: Hash of the zip; this is also its name in the cache dir
+    :param hashedMtimeNs: st_mtime_ns of the cached zip when sha512 was taken of it; while the zip still has that mtime
+                          (and size) it is not hashed again (see verifyCarrierZip())
+    '''
+    filename: str
+    size: int
+    url: str
+    etag: str = None
+    lastModified: str = None
+    sha512: str = None
+    hashedMtimeNs: int = None
+
+    def isSameDownload(self, other) -> bool:
+        '''
+        Check if other describes the same remote file; the validators are only compared when both sides have them
+        '''
+        if (self.filename, self.size, self.url) != (other.filename, other.size, other.url):
+            return False
+        if self.etag is not None and other.etag is not None:
+            return self.etag == other.etag
+        if self.lastModified is not None and other.lastModified is not None:
+            return self.lastModified == other.lastModified
+        return True
+
+
+firmwareManifestLock = threading.Lock()
+
+
+def getFirmwareCacheDirPath() -> str:
+    return os.path.join(os.path.realpath(MODEM_FIRMWARE_DIRNAME), FIRMWARE_CACHE_DIRNAME)
+
+
+def getCachedFirmwarePath(sha512:str) -> str:
+    return os.path.join(getFirmwareCacheDirPath(), f'{sha512}.zip')
+
+
+def loadFirmwareManifest() -> dict:
+    '''
+    Load the firmware manifest
+
+    :return: Dictionary of carrier name -> FirmwareCacheEntry
+    '''
+    manifestPath = os.path.join(os.path.realpath(MODEM_FIRMWARE_DIRNAME), FIRMWARE_MANIFEST_FILENAME)
+    try:
+        with open(manifestPath, 'r') as manifestFile:
+            manifestJson = json.load(manifestFile)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        # start over; worst case we download everything again
+        logger.warning(f'Ignoring unreadable firmware manifest {manifestPath}: {e}')
+        return {}
+
+    return {curCarrierName: FirmwareCacheEntry(**curEntryDict) for curCarrierName, curEntryDict in manifestJson.items()}
+
+
+def saveFirmwareManifest(manifestDict:dict) -> None:
+    manifestPath = os.path.join(os.path.realpath(MODEM_FIRMWARE_DIRNAME), FIRMWARE_MANIFEST_FILENAME)
+    # write it next to the real one and swap it in, so a crash never leaves half a manifest
+    tempManifestPath = f'{manifestPath}.tmp'
+    with open(tempManifestPath, 'w') as manifestFile:
+        json.dump({curCarrierName: asdict(curEntry) for curCarrierName, curEntry in manifestDict.items()}, manifestFile, indent=4, sort_keys=True)
+    os.replace(tempManifestPath, manifestPath)
+
+
+def updateFirmwareManifest(carrierName:str, cacheEntry:FirmwareCacheEntry) -> None:
+    # the downloads run in parallel; dont lose each others entries
+    with firmwareManifestLock:
+        manifestDict = loadFirmwareManifest()
+        manifestDict[carrierName] = cacheEntry
+        saveFirmwareManifest(manifestDict)
+
+
+def getFileSha512(filePath:str) -> str:
+    sha512sum = hashlib.sha512()
+    with open(filePath, 'rb') as source:
+        block = source.read(HASH_READ_BLOCK_SIZE)
+        while len(block) != 0:
+            sha512sum.update(block)
+            block = source.read(HASH_READ_BLOCK_SIZE)
+    return sha512sum.hexdigest()
+
+
+def linkCarrierFirmware(carrierName:str, cachedFilePath:str, targetFilePath:str) -> None:
+    '''
+    Make targetFilePath (<carrier>@<filename>) point at the cached zip and remove any other zip of the carrier
+    '''
+    modemFirmwareDirPath = os.path.dirname(targetFilePath)
+    for curFilePath in glob.glob(os.path.join(glob.escape(modemFirmwareDirPath), f'{glob.escape(carrierName)}@*.zip')):
+        if curFilePath != targetFilePath:
+            logger.debug(f'Removing old firmware file {curFilePath}')
+            os.remove(curFilePath)
+
+    # already linked (note: renaming a link over another link to the same file does nothing, so check first)
+    if os.path.exists(targetFilePath) and os.path.samefile(cachedFilePath, targetFilePath):
+        return
+
+    tempFilePath = f'{targetFilePath}.tmp'
+    if os.path.exists(tempFilePath):
+        os.remove(tempFilePath)
+    try:
+        os.link(cachedFilePath, tempFilePath)
+    except OSError:
+        # ie. a file system without hard links
+        shutil.copyfile(cachedFilePath, tempFilePath)
+    os.replace(tempFilePath, targetFilePath)
+
+
+def storeCachedFirmware(filePath:str, sha512:str) -> str:
+    '''
+    Move a verified zip into the cache dir under its hash
+
+    :return: The path of the zip in the cache
+    '''
+    cachedFilePath = getCachedFirmwarePath(sha512)
+    os.makedirs(os.path.dirname(cachedFilePath), exist_ok=True)
+    os.replace(filePath, cachedFilePath)
+    return cachedFilePath
+
+
+def findCachedFirmware(carrierName:str, cacheEntry:FirmwareCacheEntry, targetFilePath:str) -> FirmwareCacheEntry:
+    '''
+    Find an already downloaded (and verified) copy of the remote file described by cacheEntry
+
+    :return: The cache entry (with its sha512) of the local copy, or None if it has to be downloaded
+    '''
+    # the manifest says we already have exactly this file
+    manifestEntry = loadFirmwareManifest().get(carrierName)
+    if manifestEntry is not None and manifestEntry.sha512 is not None and manifestEntry.isSameDownload(cacheEntry):
+        cachedFilePath = getCachedFirmwarePath(manifestEntry.sha512)
+        if os.path.isfile(cachedFilePath) and os.path.getsize(cachedFilePath) == cacheEntry.size:
+            return manifestEntry
+        logger.debug(f'Cached firmware for {carrierName} is missing or the wrong size; downloading it again')
+
+    # a file we know the hash of; it might be in the cache already (ie. another carrier uses it) or be a download
+    # from before there was a cache
+    knownSha512 = KNOWN_FIRMWARE_SHA512.get(cacheEntry.filename)
+    if knownSha512 is not None:
+        cachedFilePath = getCachedFirmwarePath(knownSha512)
+        if os.path.isfile(cachedFilePath) and os.path.getsize(cachedFilePath) == cacheEntry.size:
+            return replace(cacheEntry, sha512=knownSha512)
+        if os.path.isfile(targetFilePath) and os.path.getsize(targetFilePath) == cacheEntry.size and getFileSha512(targetFilePath) == knownSha512:
+            logger.debug(f'Adding existing firmware file {targetFilePath} to the cache')
+            storeCachedFirmware(targetFilePath, knownSha512)
+            return replace(cacheEntry, sha512=knownSha512, hashedMtimeNs=os.stat(getCachedFirmwarePath(knownSha512)).st_mtime_ns)
+
+    return None
+
+
+def pruneFirmwareCache() -> None:
+    '''
+    Remove cached zips no carrier in the manifest uses anymore
+    '''
+    firmwareCacheDirPath = getFirmwareCacheDirPath()
+    with firmwareManifestLock:
+        usedCachedFilePathSet = set(getCachedFirmwarePath(curEntry.sha512) for curEntry in loadFirmwareManifest().values() if curEntry.sha512 is not None)
+        for curFilePath in glob.glob(os.path.join(glob.escape(firmwareCacheDirPath), '*.zip')):
+            if curFilePath not in usedCachedFilePathSet:
+                logger.debug(f'Removing unused cached firmware {curFilePath}')
+                os.remove(curFilePath)
+
+
+# elements that never have an end tag
+HTML_VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+# how much of the page to hand the parser at a time; it stops being fed once the table was found
+FIRMWARE_PAGE_PARSE_CHUNK_SIZE = 16384
+
+
+class FirmwareTableParser(HTMLParser):
+    '''
+    Streaming parser that picks the fw-table of one model out of the download page.  The table we want is the
+    table.fw-table whose first row's first cell starts with a <strong> containing the model name; once that table has
+    been read, the parser is done (see the done attribute) and the rest of the page can be skipped
+
+    Each row ends up in rows as a list of cells; each cell is a dict with:
+    strings: the stripped text strings in the cell (like BeautifulSoup's stripped_strings)
+    link: the href of the first <a> that is the first child of a <p> directly in the cell (or None)
+    '''
+    def __init__(self, modelHeader:str):
+        super().__init__(convert_charrefs=True)
+        self.modelHeader = modelHeader
+        self.rows = None
+        self.done = False
+
+        # depth of the fw-table we are in (0 if not in one); other tables inside it just bump the depth
+        self.tableDepth = 0
+        self.curRows = None
+        self.curRow = None
+        self.curCell = None
+        # [tag, number of child elements so far] for each open element inside the current cell, starting with the td
+        self.cellStack = None
+        # own text of the <strong> that is the first child of the first cell of the table
+        self.headerStrongText = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if tag == 'table':
+            if self.tableDepth > 0:
+                self.tableDepth += 1
+            elif 'fw-table' in (dict(attrs).get('class') or '').split():
+                self.tableDepth = 1
+                self.curRows = []
+                self.headerStrongText = None
+            return
+
+        # only the rows and cells of the fw-table itself matter, not ones of tables nested in it
+        if self.tableDepth != 1:
+            return
+
+        if tag == 'tr':
+            self.finishRow()
+            self.curRow = []
+        elif tag == 'td' and self.curRow is not None and (self.cellStack is None or len(self.cellStack) == 0):
+            self.curCell = {'strings': [], 'link': None}
+            self.curRow.append(self.curCell)
+            self.cellStack = [['td', 0]]
+        elif self.cellStack is not None and len(self.cellStack) > 0:
+            parentElement = self.cellStack[-1]
+            parentElement[1] += 1
+            childIndex = parentElement[1]
+
+            # td > p > a:nth-child(1)
+            if tag == 'a' and len(self.cellStack) == 2 and parentElement[0] == 'p' and childIndex == 1 and self.curCell['link'] is None:
+                self.curCell['link'] = dict(attrs).get('href')
+            # first cell of the first row: td > strong:nth-child(1)
+            if tag == 'strong' and len(self.cellStack) == 1 and childIndex == 1 and len(self.curRows) == 0 and len(self.curRow) == 1:
+                self.headerStrongText = ''
+
+            if tag not in HTML_VOID_ELEMENTS:
+                self.cellStack.append([tag, 0])
+
+    def handle_startendtag(self, tag, attrs):
+        # ie. <br/>; counts as a child but never has content
+        if not self.done and self.tableDepth == 1 and self.cellStack is not None and len(self.cellStack) > 0:
+            self.cellStack[-1][1] += 1
+
+    def handle_endtag(self, tag):
+        if self.done or self.tableDepth == 0:
+            return
+
+        if tag == 'table':
+            self.tableDepth -= 1
+            if self.tableDepth == 0:
+                self.finishTable()
+            return
+
+        if self.tableDepth != 1:
+            return
+
+        if tag == 'tr':
+            self.finishRow()
+        elif self.cellStack is not None and len(self.cellStack) > 0:
+            # close up to the matching element; browsers put up with missing end tags, so we do too
+            for curIndex in range(len(self.cellStack) - 1, -1, -1):
+                if self.cellStack[curIndex][0] == tag:
+                    del self.cellStack[curIndex:]
+                    break
+
+    def handle_data(self, data):
+        if self.done or self.tableDepth == 0 or self.cellStack is None or len(self.cellStack) == 0:
+            return
+
+        strippedString = data.strip()
+        if len(strippedString) > 0:
+            self.curCell['strings'].append(strippedString)
+        # own text of the header <strong> (not of elements inside it)
+        if self.headerStrongText is not None and len(self.cellStack) == 2 and self.cellStack[-1][0] == 'strong' and len(self.curRows) == 0:
+            self.headerStrongText += data
+
+    def finishRow(self):
+        if self.curRow is not None:
+            self.curRows.append(self.curRow)
+        self.curRow = None
+        self.curCell = None
+        self.cellStack = None
+
+    def finishTable(self):
+        self.finishRow()
+        if self.headerStrongText is not None and self.modelHeader in self.headerStrongText:
+            self.rows = self.curRows
+            self.done = True
+        self.curRows = None
+
+
+def parseFirmwarePage(firmwarePageText:str, pageUrlToParse:str, modelHeader:str, carrierList:list=None) -> dict:
+    '''
+    Find the firmware table of the model on the download page
+
+    :return: Dictionary of carrier name -> {table header: cell value (or link url)}
+    '''
+    if carrierList is None:
+        carrierList = DEFAULT_FIRMWARE_ORDER_LIST
+
+    # Only parse as much of the page as it takes to get to the end of the table
+    tableParser = FirmwareTableParser(modelHeader)
+    for curOffset in range(0, len(firmwarePageText), FIRMWARE_PAGE_PARSE_CHUNK_SIZE):
+        tableParser.feed(firmwarePageText[curOffset:curOffset + FIRMWARE_PAGE_PARSE_CHUNK_SIZE])
+        if tableParser.done:
+            break
+    if not tableParser.done:
+        tableParser.close()
+    if tableParser.rows is None:
+        raise RuntimeError(f'No fw-table found for {modelHeader} on {pageUrlToParse}')
+    logger.debug(f"found table with {len(tableParser.rows)} rows")
+
+    foundCarrierFwFileLinks = {}
+    # skip the header row
+    for curFirmwareLinkTableRow in tableParser.rows[1:]:
+        if len(curFirmwareLinkTableRow) < 1:
+            continue
+        curFirstCell = curFirmwareLinkTableRow[0]
+
+        curCellStrippedStringList = curFirstCell['strings']
+
+        logger.debug(f'Checking row with first cell {curCellStrippedStringList}')
+
+        if len(curCellStrippedStringList) != 1:
+            raise RuntimeError(f"Too many stripped strings found in first cell {curCellStrippedStringList}")
+        curFirstCellStrippedString = curCellStrippedStringList[0]
+
+        if curFirstCellStrippedString in carrierList:
+            logger.debug(f"Found row with first cell {curFirstCellStrippedString}")
+
+            if curFirstCellStrippedString in foundCarrierFwFileLinks.keys():
+                raise RuntimeError(
+                    f'foundCarrierFwFileLinks already has a link entry for carrier {curFirstCellStrippedString}')
+
+            if len(curFirmwareLinkTableRow) < len(FIRMWARE_TABLE_HEADERS):
+                raise RuntimeError(f'Too few cells ({len(curFirmwareLinkTableRow)}) in the row for {curFirstCellStrippedString}; expected {len(FIRMWARE_TABLE_HEADERS)}')
+
+            # get the target field values (skips the carrier column since we already parsed that one)
+            foundCarrierFwFileLinks[curFirstCellStrippedString] = {}
+            for curCellHeaderIndex in range(1, len(FIRMWARE_TABLE_HEADERS)):
+                curCellHeader = FIRMWARE_TABLE_HEADERS[curCellHeaderIndex]
+                curTargetCell = curFirmwareLinkTableRow[curCellHeaderIndex]
+
+                # if this is one of the link fields, get the a href value, else get the cell text
+                curFieldValue = None
+                if curCellHeader in FIRMWARE_LINK_TABLE_HEADERS:
+                    # Note: This presently expects there to be only 1 link in this cell and for it not to be nested
+                    # If there is a link in therte, grab it
+                    if curTargetCell['link'] is not None:
+                        curFieldValue = urljoin(pageUrlToParse, curTargetCell['link'])
+                else:
+                    curCellStrippedStringList = curTargetCell['strings']
+
+                    if not len(curCellStrippedStringList) == 1:
+                        raise RuntimeError(
+                            f"Too many stripped strings found in cell {curCellHeaderIndex} ({curCellHeader}) for "
+                            + f"{curFirstCellStrippedString}: {curCellStrippedStringList}")
+                    curFieldValue = curCellStrippedStringList[0]
+                # append current field value to the firmware dictionary
+                if curFieldValue is not None:
+                    foundCarrierFwFileLinks[curFirstCellStrippedString].update({curCellHeader: curFieldValue})
+            if len(foundCarrierFwFileLinks[curFirstCellStrippedString].keys()) < 1:
+                del foundCarrierFwFileLinks[curFirstCellStrippedString]
+    logger.info(f'Parsed firmware:\n{json.dumps(foundCarrierFwFileLinks, indent=4)}')
+
+    # Make sure we found them all
+    if sorted(carrierList) != sorted(foundCarrierFwFileLinks.keys()):
+        raise RuntimeError(f'Not all carrier firmware files were found.\nSearch list: {sorted(carrierList)}\nFound list: {sorted(foundCarrierFwFileLinks.keys())}')
+
+    return foundCarrierFwFileLinks
+
+
+def loadFirmwareCatalog() -> dict:
+    catalogPath = os.path.join(os.path.realpath(MODEM_FIRMWARE_DIRNAME), FIRMWARE_CATALOG_FILENAME)
+    try:
+        with open(catalogPath, 'r') as catalogFile:
+            return json.load(catalogFile)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f'Ignoring unreadable firmware catalog {catalogPath}: {e}')
+        return None
+
+
+def saveFirmwareCatalog(catalogDict:dict) -> None:
+    catalogPath = os.path.join(os.path.realpath(MODEM_FIRMWARE_DIRNAME), FIRMWARE_CATALOG_FILENAME)
+    tempCatalogPath = f'{catalogPath}.tmp'
+    with open(tempCatalogPath, 'w') as catalogFile:
+        json.dump(catalogDict, catalogFile, indent=4, sort_keys=True)
+    os.replace(tempCatalogPath, catalogPath)
+
+
+@traced()
+def getFirmwareCatalog(session, pageUrlToParse:str, modelHeader:str, carrierList:list=None, ttl:float=None, offline:bool=None) -> dict:
+    '''
+    Get the firmware table of the model, from the cache if it is still good.  Once the cache is older than ttl, the page
+    is fetched with a conditional GET, so it is only downloaded and parsed again if it changed
+
+    :param ttl: Seconds to trust the cache without asking the server
+    :param offline: Only use the cache; fails if it does not have what we need
+    :return: Dictionary of carrier name -> {table header: cell value (or link url)} (see parseFirmwarePage())
+    '''
+    import requests
+
+    if carrierList is None:
+        carrierList = DEFAULT_FIRMWARE_ORDER_LIST
+    if ttl is None:
+        ttl = DEFAULT_CATALOG_TTL
+    if offline is None:
+        offline = False
+
+    # only use the cache if it is for the same page and has every carrier we want
+    catalogDict = loadFirmwareCatalog()
+    if catalogDict is not None and (
+            catalogDict.get('pageUrl') != pageUrlToParse
+            or catalogDict.get('modelHeader') != modelHeader
+            or not set(carrierList).issubset(catalogDict.get('firmware', {}).keys())):
+        catalogDict = None
+
+    def getCachedFirmwareTable():
+        return {curCarrierName: catalogDict['firmware'][curCarrierName] for curCarrierName in carrierList}
+
+    if offline:
+        if catalogDict is None:
+            raise RuntimeError(f'Offline, and the firmware catalog cache does not have the {modelHeader} firmware for {carrierList}')
+        logger.info('Offline; using the cached firmware catalog')
+        return getCachedFirmwareTable()
+
+    if catalogDict is not None and time.time() - catalogDict.get('fetchedTime', 0) < ttl:
+        logger.info('Using the cached firmware catalog')
+        return getCachedFirmwareTable()
+
+    requestHeaders = {}
+    if catalogDict is not None:
+        if catalogDict.get('etag') is not None:
+            requestHeaders['If-None-Match'] = catalogDict['etag']
+        if catalogDict.get('lastModified') is not None:
+            requestHeaders['If-Modified-Since'] = catalogDict['lastModified']
+
+    logger.info(f"Parsing available firmware from {pageUrlToParse}")
+    try:
+        responseObj = session.get(pageUrlToParse, headers=requestHeaders, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        if catalogDict is None:
+            raise
+        # no connectivity; the cache is the best we have
+        logger.warning(f'Could not fetch {pageUrlToParse} ({e}); using the cached firmware catalog')
+        return getCachedFirmwareTable()
+
+    with responseObj:
+        if responseObj.status_code == 304 and catalogDict is not None:
+            logger.info('Firmware page did not change; using the cached firmware catalog')
+            catalogDict['fetchedTime'] = time.time()
+            saveFirmwareCatalog(catalogDict)
+            return getCachedFirmwareTable()
+
+        responseObj.raise_for_status()
+        foundCarrierFwFileLinks = parseFirmwarePage(responseObj.text, pageUrlToParse, modelHeader, carrierList)
+
+        saveFirmwareCatalog({
+            'pageUrl': pageUrlToParse,
+            'modelHeader': modelHeader,
+            'etag': responseObj.headers.get('ETag'),
+            'lastModified': responseObj.headers.get('Last-Modified'),
+            'fetchedTime': time.time(),
+            'firmware': foundCarrierFwFileLinks,
+        })
+
+    return foundCarrierFwFileLinks
+
+
+def getDownloadSession(maxWorkers:int=None):
+    '''
+    Get a requests session whose connection pool is big enough for maxWorkers threads (downloads or segments) to share
+    '''
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    if maxWorkers is None:
+        maxWorkers = DEFAULT_DOWNLOAD_MAX_WORKERS
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxWorkers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class FirmwareVerificationError(RuntimeError):
+    ...
+
+
+@dataclass
+class DownloadPartState:
+    '''
+    What a .part file is a part of, so an interrupted download is only resumed against the same remote file
+
+    :param url: Url the file comes from (after redirects)
+    :param size: Full size of the file
+    :param etag: ETag header of the url, if any
+    :param lastModified: Last-Modified header of the url, if any
+    :param segments: For segmented downloads, [start, end, done] byte ranges (end is inclusive); None if the file is
+                     downloaded front to back (then the size of the .part file is the progress)
+    '''
+    url: str
+    size: int
+    etag: str = None
+    lastModified: str = None
+    segments: list = None
+
+    def isSameFile(self, cacheEntry:FirmwareCacheEntry) -> bool:
+        return FirmwareCacheEntry(cacheEntry.filename, self.size, self.url, self.etag, self.lastModified).isSameDownload(cacheEntry)
+
+
+def loadDownloadPartState(partFilePath:str) -> DownloadPartState:
+    try:
+        with open(f'{partFilePath}.json', 'r') as stateFile:
+            return DownloadPartState(**json.load(stateFile))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as e:
+        logger.debug(f'Ignoring unreadable download state of {partFilePath}: {e}')
+        return None
+
+
+def saveDownloadPartState(partFilePath:str, partState:DownloadPartState) -> None:
+    tempStatePath = f'{partFilePath}.json.tmp'
+    with open(tempStatePath, 'w') as stateFile:
+        json.dump(asdict(partState), stateFile)
+    os.replace(tempStatePath, f'{partFilePath}.json')
+
+
+def removeDownloadPart(partFilePath:str) -> None:
+    for curFilePath in [partFilePath, f'{partFilePath}.json']:
+        if os.path.exists(curFilePath):
+            os.remove(curFilePath)
+
+
+def getResponseFilename(responseObj) -> str:
+    '''
+    Get the name the server wants the file saved as, or the last part of the url (after redirects)
+    '''
+    # find the filename to save as
+    if "Content-Disposition" in responseObj.headers.keys():
+        filenameList = re.findall('filename="(.+)"', responseObj.headers["Content-Disposition"])
+        if len(filenameList) > 0:
+            return filenameList[0]
+    # get the path after the url has followed redirects
+    return urllib_unquote(os.path.basename(urlparse(responseObj.url).path))
+
+
+def acceptsByteRanges(responseObj) -> bool:
+    return responseObj.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+def getRangeValidator(cacheEntry:FirmwareCacheEntry) -> dict:
+    '''
+    Get the If-Range header that makes the server send the whole (new) file instead of a range of a changed one
+    '''
+    # Note: weak etags can not be used with If-Range
+    if cacheEntry.etag is not None and not cacheEntry.etag.startswith('W/'):
+        return {'If-Range': cacheEntry.etag}
+    if cacheEntry.lastModified is not None:
+        return {'If-Range': cacheEntry.lastModified}
+    return {}
+
+
+def isExpectedRange(responseObj, startByte:int) -> bool:
+    return responseObj.status_code == 206 and responseObj.headers.get('Content-Range', '').startswith(f'bytes {startByte}-')
+
+
+class DownloadProgress:
+    '''
+    Logs how far along a download is every DOWNLOAD_PROGRESS_INTERVAL seconds; safe to update from several threads
+    '''
+    def __init__(self, label:str, totalBytes:int, doneBytes:int=None):
+        if doneBytes is None:
+            doneBytes = 0
+
+        self.label = label
+        self.totalBytes = totalBytes
+        self.doneBytes = doneBytes
+        self.lastReportTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, byteCount:int) -> None:
+        with self.lock:
+            self.doneBytes += byteCount
+            if time.monotonic() - self.lastReportTime >= DOWNLOAD_PROGRESS_INTERVAL:
+                # report progress per download; console progress bars of several downloads would garble each other
+                logger.info(f'{self.label}: {self.doneBytes * 100 // self.totalBytes}% ({self.doneBytes}/{self.totalBytes} bytes)')
+                self.lastReportTime = time.monotonic()
+
+
+def streamResponseToFile(responseObj, outputFileObj, maxBytes:int, progress:DownloadProgress, hashObj=None) -> int:
+    '''
+    Write the response body to the (already positioned) file, hashing it on the way if hashObj is set
+
+    :param maxBytes: The most bytes the body may have; stops as soon as there are more
+    :return: Number of bytes written
+    '''
+    writtenBytes = 0
+    for data in responseObj.iter_content(DOWNLOAD_BLOCK_SIZE):
+        writtenBytes += len(data)
+        if writtenBytes > maxBytes:
+            raise FirmwareVerificationError(f'Download of {progress.label} ({responseObj.url}) is bigger than expected ({maxBytes} bytes)')
+        if hashObj is not None:
+            hashObj.update(data)
+        outputFileObj.write(data)
+        progress.update(len(data))
+    return writtenBytes
+
+
+def downloadSequential(session, responseObj, cacheEntry:FirmwareCacheEntry, partFilePath:str, progressLabel:str) -> str:
+    '''
+    Download front to back into partFilePath, hashing the data on the way to disk.  If an earlier attempt left part of the
+    same file behind, only the rest is fetched (with a Range request); the kept part is read back once for the hash (a
+    hashlib state can not be saved with the .part file)
+
+    :param responseObj: The (unread) response for the whole file
+    :return: The sha512 of the file
+    '''
+    sha512sum = hashlib.sha512()
+    resumeBytes = 0
+
+    partState = loadDownloadPartState(partFilePath)
+    if partState is not None and partState.segments is None and partState.isSameFile(cacheEntry) and os.path.exists(partFilePath) and acceptsByteRanges(responseObj):
+        resumeBytes = os.path.getsize(partFilePath)
+        if resumeBytes >= cacheEntry.size:
+            resumeBytes = 0
+
+    bodyResponseObj = responseObj
+    if resumeBytes > 0:
+        # the full body is not needed; dont keep its connection busy while the range comes in
+        responseObj.close()
+        rangeHeaders = {'Range': f'bytes={resumeBytes}-'}
+        rangeHeaders.update(getRangeValidator(cacheEntry))
+        bodyResponseObj = session.get(cacheEntry.url, headers=rangeHeaders, stream=True, timeout=DOWNLOAD_TIMEOUT)
+        bodyResponseObj.raise_for_status()
+        if isExpectedRange(bodyResponseObj, resumeBytes):
+            logger.info(f'{progressLabel}: resuming download at {resumeBytes} of {cacheEntry.size} bytes')
+            # the part we already have still needs to go into the hash; that is a lot less than fetching it again
+            with open(partFilePath, 'rb') as partFileObj:
+                remainingBytes = resumeBytes
+                while remainingBytes > 0:
+                    block = partFileObj.read(min(HASH_READ_BLOCK_SIZE, remainingBytes))
+                    if len(block) == 0:
+                        raise FirmwareVerificationError(f'{partFilePath} got shorter while resuming')
+                    sha512sum.update(block)
+                    remainingBytes -= len(block)
+        else:
+            # the file changed (or the server ignored the range); start over with whatever it sent
+            logger.info(f'{progressLabel}: can not resume; downloading from the start')
+            resumeBytes = 0
+
+    if resumeBytes == 0:
+        saveDownloadPartState(partFilePath, DownloadPartState(url=cacheEntry.url, size=cacheEntry.size, etag=cacheEntry.etag, lastModified=cacheEntry.lastModified))
+
+    progress = DownloadProgress(progressLabel, cacheEntry.size, resumeBytes)
+    try:
+        with open(partFilePath, 'ab' if resumeBytes > 0 else 'wb') as outputFileObj:
+            if resumeBytes > 0:
+                outputFileObj.truncate(resumeBytes)
+            writtenBytes = resumeBytes + streamResponseToFile(bodyResponseObj, outputFileObj, cacheEntry.size - resumeBytes, progress, sha512sum)
+
+            # make sure it is really on disk before it gets renamed into place
+            outputFileObj.flush()
+            os.fsync(outputFileObj.fileno())
+    finally:
+        if bodyResponseObj is not responseObj:
+            bodyResponseObj.close()
+
+    if writtenBytes != cacheEntry.size:
+        raise RuntimeError(f'something went wrong; download size ({writtenBytes}) of {progressLabel} does not match content size from header ({cacheEntry.size})')
+
+    return sha512sum.hexdigest()
+
+
+def downloadSegmented(session, cacheEntry:FirmwareCacheEntry, partFilePath:str, progressLabel:str, segmentCount:int) -> str:
+    '''
+    Download the file as segmentCount byte ranges at the same time, each written in place into partFilePath.  Segments
+    finished by an earlier attempt at the same file are not fetched again
+
+    :return: The sha512 of the file.  The segments arrive out of order, so each one is read back (while it is still in
+             the page cache) and hashed as soon as every segment before it is done, instead of hashing the whole file
+             once it is complete
+    '''
+    partState = loadDownloadPartState(partFilePath)
+    if (partState is None or partState.segments is None or not partState.isSameFile(cacheEntry)
+            or not os.path.exists(partFilePath) or os.path.getsize(partFilePath) != cacheEntry.size):
+        segmentBytes = -(-cacheEntry.size // segmentCount)
+        partState = DownloadPartState(
+            url=cacheEntry.url, size=cacheEntry.size, etag=cacheEntry.etag, lastModified=cacheEntry.lastModified,
+            segments=[[curStart, min(curStart + segmentBytes, cacheEntry.size) - 1, False] for curStart in range(0, cacheEntry.size, segmentBytes)])
+        with open(partFilePath, 'wb') as partFileObj:
+            partFileObj.truncate(cacheEntry.size)
+        saveDownloadPartState(partFilePath, partState)
+    else:
+        logger.info(f'{progressLabel}: resuming download; {sum(1 for curSegment in partState.segments if curSegment[2])} of {len(partState.segments)} segments are done')
+
+    progress = DownloadProgress(progressLabel, cacheEntry.size, sum(curSegment[1] - curSegment[0] + 1 for curSegment in partState.segments if curSegment[2]))
+    stateLock = threading.Lock()
+
+    sha512sum = hashlib.sha512()
+    hashedBytes = 0
+    hashLock = threading.Lock()
+
+    def hashFinishedPrefix() -> None:
+        # fold the done segments at the front of the file into the hash, in order; the first segment that is not done
+        # yet holds up the rest until it is
+        nonlocal hashedBytes
+        with hashLock, open(partFilePath, 'rb') as partFileObj:
+            partFileObj.seek(hashedBytes)
+            for startByte, endByte, isDone in sorted(partState.segments):
+                if endByte < hashedBytes:
+                    continue
+                if not isDone:
+                    break
+                while hashedBytes <= endByte:
+                    block = partFileObj.read(min(HASH_READ_BLOCK_SIZE, endByte + 1 - hashedBytes))
+                    if len(block) == 0:
+                        raise FirmwareVerificationError(f'{partFilePath} got shorter while downloading')
+                    sha512sum.update(block)
+                    hashedBytes += len(block)
+
+    def downloadSegment(segment:list) -> None:
+        startByte, endByte, _ = segment
+        rangeHeaders = {'Range': f'bytes={startByte}-{endByte}'}
+        rangeHeaders.update(getRangeValidator(cacheEntry))
+        with session.get(cacheEntry.url, headers=rangeHeaders, stream=True, timeout=DOWNLOAD_TIMEOUT) as rangeResponseObj:
+            rangeResponseObj.raise_for_status()
+            if not isExpectedRange(rangeResponseObj, startByte):
+                raise RuntimeError(f'Server did not send bytes {startByte}-{endByte} of {cacheEntry.url} (status {rangeResponseObj.status_code}); the file may have changed')
+            with open(partFilePath, 'r+b') as outputFileObj:
+                outputFileObj.seek(startByte)
+                writtenBytes = streamResponseToFile(rangeResponseObj, outputFileObj, endByte - startByte + 1, progress)
+                outputFileObj.flush()
+                os.fsync(outputFileObj.fileno())
+        if writtenBytes != endByte - startByte + 1:
+            raise RuntimeError(f'Got {writtenBytes} bytes for bytes {startByte}-{endByte} of {cacheEntry.url}')
+
+        with stateLock:
+            segment[2] = True
+            saveDownloadPartState(partFilePath, partState)
+        hashFinishedPrefix()
+
+    remainingSegments = [curSegment for curSegment in partState.segments if not curSegment[2]]
+    with ThreadPoolExecutor(max_workers=segmentCount, thread_name_prefix='firmware-dl-segment') as executor:
+        # wait for all of them, so nothing is still writing to the file when we return (or fail)
+        futureList = [executor.submit(downloadSegment, curSegment) for curSegment in remainingSegments]
+        # the segments an earlier attempt finished get hashed while the rest download
+        hashFinishedPrefix()
+        for curFuture in futureList:
+            curFuture.exception()
+    for curFuture in futureList:
+        curFuture.result()
+
+    # Note: only needed if nothing was left to download
+    hashFinishedPrefix()
+    if hashedBytes != cacheEntry.size:
+        raise RuntimeError(f'something went wrong; hashed {hashedBytes} bytes of {progressLabel}, but the content size is {cacheEntry.size}')
+
+    return sha512sum.hexdigest()
+
+
+def useCachedCarrierFirmware(carrierName:str, modemFirmwareDirPath:str) -> str:
+    '''
+    Use whatever the manifest says was last downloaded for the carrier, without asking the server
+
+    :return: Path of the <carrier>@<filename> file
+    '''
+    manifestEntry = loadFirmwareManifest().get(carrierName)
+    if manifestEntry is None or manifestEntry.sha512 is None:
+        raise RuntimeError(f'No firmware for carrier {carrierName} was downloaded before')
+
+    cachedFilePath = getCachedFirmwarePath(manifestEntry.sha512)
+    if not os.path.isfile(cachedFilePath) or os.path.getsize(cachedFilePath) != manifestEntry.size:
+        raise RuntimeError(f'The cached firmware for carrier {carrierName} ({cachedFilePath}) is missing or the wrong size')
+
+    targetFilePath = os.path.join(modemFirmwareDirPath, manifestEntry.filename)
+    linkCarrierFirmware(carrierName, cachedFilePath, targetFilePath)
+    logger.info(f'Using the cached firmware for carrier {carrierName} ({manifestEntry.filename}) without checking the server')
+
+    return targetFilePath
+
+
+@traced()
+def downloadCarrierFirmware(session, carrierName:str, zipUrl:str, modemFirmwareDirPath:str, segmentCount:int=None) -> str:
+    '''
+    Download the firmware zip of one carrier into modemFirmwareDirPath as <carrier>@<filename>; if the manifest (or a
+    known hash) shows we already have the same file, the cached copy is used instead.  An interrupted download is
+    resumed from its .part file next time
+
+    :param session: requests session to download with
+    :param segmentCount: Download files of at least DOWNLOAD_SEGMENT_MIN_SIZE bytes as this many byte ranges at the
+                         same time (if the server supports ranges)
+    :return: Path of the downloaded file
+    '''
+    import requests
+
+    if segmentCount is None:
+        segmentCount = DEFAULT_DOWNLOAD_SEGMENTS
+
+    logger.info(f'Downloading firmware for carrier {carrierName} ({zipUrl})')
+
+    try:
+        # the metadata comes from the download response itself; the body is only read if we need it
+        responseObj = session.get(zipUrl, stream=True, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        # no connectivity; fall back to the last download, if there is one
+        if loadFirmwareManifest().get(carrierName) is None:
+            raise
+        logger.warning(f'Could not reach {zipUrl} ({e})')
+        return useCachedCarrierFirmware(carrierName, modemFirmwareDirPath)
+
+    with responseObj:
+        # make sure we got an ok response
+        responseObj.raise_for_status()
+        targetFinalUrl = responseObj.url
+
+        targetFilename = f'{carrierName}@{getResponseFilename(responseObj)}'
+        targetFilePath = os.path.join(modemFirmwareDirPath, targetFilename)
+
+        targetFileBytes = int(responseObj.headers.get('content-length', 0))
+        if targetFileBytes == 0:
+            raise RuntimeError(f'http response for {carrierName} firmware ({targetFinalUrl}) said content size for requested file is 0! This shouldnt happen')
+
+        cacheEntry = FirmwareCacheEntry(
+            filename=targetFilename,
+            size=targetFileBytes,
+            url=targetFinalUrl,
+            etag=responseObj.headers.get('ETag'),
+            lastModified=responseObj.headers.get('Last-Modified'))
+
+        # Skip the download if we already have this exact file
+        cachedEntry = findCachedFirmware(carrierName, cacheEntry, targetFilePath)
+        if cachedEntry is not None:
+            logger.info(f'Firmware for carrier {carrierName} is already downloaded ({targetFilename})')
+            linkCarrierFirmware(carrierName, getCachedFirmwarePath(cachedEntry.sha512), targetFilePath)
+            updateFirmwareManifest(carrierName, cachedEntry)
+            return targetFilePath
+
+        logger.debug(f'Writing firmware binary for {carrierName} ({targetFileBytes} bytes) from {targetFinalUrl} to {targetFilePath}')
+
+        # download next to the cache; it only goes in once it is verified
+        os.makedirs(getFirmwareCacheDirPath(), exist_ok=True)
+        partFilePath = os.path.join(getFirmwareCacheDirPath(), f'{targetFilename}.part')
+
+        try:
+            if segmentCount > 1 and targetFileBytes >= DOWNLOAD_SEGMENT_MIN_SIZE and acceptsByteRanges(responseObj):
+                responseObj.close()
+                sha512 = downloadSegmented(session, cacheEntry, partFilePath, carrierName, segmentCount)
+            else:
+                sha512 = downloadSequential(session, responseObj, cacheEntry, partFilePath, carrierName)
+            logger.info(f'sha512sum:\n{sha512} *{targetFilename}')
+
+            knownSha512 = KNOWN_FIRMWARE_SHA512.get(targetFilename)
+            if knownSha512 is not None and knownSha512 != sha512:
+                raise FirmwareVerificationError(f'Download of {carrierName} ({targetFinalUrl}) has sha512 {sha512}; expected {knownSha512}')
+        except FirmwareVerificationError:
+            # the data is bad (not just cut short); dont resume from it
+            removeDownloadPart(partFilePath)
+            raise
+        # Note: on anything else (ie. the connection dropped or we got interrupted) the .part file stays to resume from
+
+    os.remove(f'{partFilePath}.json')
+    cachedFilePath = storeCachedFirmware(partFilePath, sha512)
+    linkCarrierFirmware(carrierName, cachedFilePath, targetFilePath)
+    updateFirmwareManifest(carrierName, replace(cacheEntry, sha512=sha512, hashedMtimeNs=os.stat(cachedFilePath).st_mtime_ns))
+
+    return targetFilePath
+
+
+@traced()
+def downloadFirmware(pageUrlToParse, modelHeader, carrierList=None, maxWorkers:int=None, catalogTtl:float=None, offline:bool=None, segmentCount:int=None) -> dict:
+    '''
+    Download the firmware zip of each carrier from the download page; all carriers are downloaded at the same time
+
+    :param maxWorkers: Max number of downloads at the same time
+    :param catalogTtl: Seconds to trust the cached firmware table without asking the server (see getFirmwareCatalog())
+    :param offline: Work entirely from the cached firmware table and downloads; nothing is fetched
+    :param segmentCount: Download big files as this many byte ranges at the same time (see downloadCarrierFirmware())
+    :return: Dictionary of carrier name -> downloaded file path
+    '''
+    if carrierList is None:
+        carrierList = DEFAULT_FIRMWARE_ORDER_LIST
+    if maxWorkers is None:
+        maxWorkers = DEFAULT_DOWNLOAD_MAX_WORKERS
+    if offline is None:
+        offline = False
+    if segmentCount is None:
+        segmentCount = DEFAULT_DOWNLOAD_SEGMENTS
+
+    if not os.path.exists(MODEM_FIRMWARE_DIRNAME):
+        os.mkdir(MODEM_FIRMWARE_DIRNAME)
+    modemFirmwareDirPath = os.path.realpath(MODEM_FIRMWARE_DIRNAME)
+
+    # one connection pool for the page and all the downloads (and their segments)
+    session = getDownloadSession(maxWorkers * segmentCount)
+
+    foundCarrierFwFileLinks = getFirmwareCatalog(session, pageUrlToParse, modelHeader, carrierList, ttl=catalogTtl, offline=offline)
+
+    if offline:
+        session.close()
+        return {curCarrierName: useCachedCarrierFirmware(curCarrierName, modemFirmwareDirPath) for curCarrierName in carrierList}
+
+    # Parse the firmware filename and download firmware
+    with session, ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='firmware-dl') as executor:
+        futureDict = {
+            curCarrierName: executor.submit(downloadCarrierFirmware, session, curCarrierName, foundCarrierFwFileLinks[curCarrierName]['Firmware Files'], modemFirmwareDirPath, segmentCount)
+            for curCarrierName in carrierList}
+
+        # let every download finish (or fail) on its own; one bad carrier does not stop the others
+        downloadedFileDict = {}
+        errorDict = {}
+        for curCarrierName, curFuture in futureDict.items():
+            try:
+                downloadedFileDict[curCarrierName] = curFuture.result()
+            except Exception as e:
+                logger.error(f'Failed to download firmware for carrier {curCarrierName}: {e}')
+                errorDict[curCarrierName] = e
+
+    if len(errorDict) > 0:
+        raise FirmwareDownloadError(f'Failed to download firmware for carriers {sorted(errorDict.keys())}', errorDict)
+
+    pruneFirmwareCache()
+
+    return downloadedFileDict
+
+
+def getZipFirmwareMembers(carrierName:str, zipFileObj) -> list:
+    '''
+    Pick the .cwe and .nvu members out of the zip's central directory (nothing is read or written yet)
+
+    :return: [cwe member, nvu member] (ZipInfo objects)
+    '''
+    memberList = [curMember for curMember in zipFileObj.infolist() if not curMember.is_dir()]
+    firmwareMemberList = []
+    for curExtension in FIRMWARE_ZIP_MEMBER_EXTENSIONS:
+        matchingMemberList = [curMember for curMember in memberList if curMember.filename.lower().endswith(curExtension)]
+        if len(matchingMemberList) != 1:
+            raise RuntimeError(f'Wrong number of matches found (want exactly 1) for {curExtension} file in firmware zip for carrier {carrierName}: {json.dumps([curMember.filename for curMember in matchingMemberList], indent=4)}')
+        firmwareMemberList.append(matchingMemberList[0])
+
+    # the members go straight into the carrier dir; make sure their names can not point anywhere else
+    for curMember in firmwareMemberList:
+        curMemberFilename = os.path.basename(curMember.filename)
+        if curMemberFilename in ('', '.', '..'):
+            raise RuntimeError(f'Bad member name {curMember.filename} in firmware zip for carrier {carrierName}')
+
+    return firmwareMemberList
+
+
+def loadUnpackStamp(carrierFirmwareDirname:str) -> dict:
+    try:
+        with open(os.path.join(carrierFirmwareDirname, UNPACK_STAMP_FILENAME), 'r') as stampFile:
+            return json.load(stampFile)
+    except (OSError, ValueError):
+        return None
+
+
+def isUnpackCurrent(zipPath:str, zipSha512:str, carrierFirmwareDirname:str) -> bool:
+    '''
+    Check if the carrier dir already has the files of this exact zip
+    '''
+    stampDict = loadUnpackStamp(carrierFirmwareDirname)
+    if stampDict is None or stampDict.get('zipFilename') != os.path.basename(zipPath):
+        return False
+
+    # the unpacked files have to still be there as they were written
+    for curFilename, curFileSize in stampDict.get('files', {}).items():
+        curFilePath = os.path.join(carrierFirmwareDirname, curFilename)
+        if not os.path.isfile(curFilePath) or os.path.getsize(curFilePath) != curFileSize:
+            return False
+
+    # Note: a touched zip with the same contents still counts
+    return zipSha512 == stampDict.get('zipSha512')
+
+
+def verifyCarrierZip(carrierName:str, zipPath:str) -> str:
+    '''
+    Hash a carrier firmware zip and check it against the known hashes and the manifest entry of its download, so a zip
+    that was put there by hand or changed on disk since is never flashed.  A zip that still has the size and mtime it had
+    when its download was hashed is not hashed again; the manifest's sha512 is used
+
+    :return: The sha512 of the zip
+    '''
+    zipFilename = os.path.basename(zipPath)
+    manifestEntry = loadFirmwareManifest().get(carrierName)
+    if manifestEntry is not None and manifestEntry.filename != zipFilename:
+        manifestEntry = None
+
+    zipStat = os.stat(zipPath)
+    if (manifestEntry is not None and manifestEntry.sha512 is not None and manifestEntry.hashedMtimeNs is not None
+            and (zipStat.st_size, zipStat.st_mtime_ns) == (manifestEntry.size, manifestEntry.hashedMtimeNs)):
+        logger.debug(f'Firmware zip {zipPath} for carrier {carrierName} did not change since it was hashed')
+        zipSha512 = manifestEntry.sha512
+    else:
+        zipSha512 = getFileSha512(zipPath)
+
+    knownSha512 = KNOWN_FIRMWARE_SHA512.get(zipFilename)
+    if knownSha512 is not None and zipSha512 != knownSha512:
+        raise FirmwareVerificationError(f'Firmware zip {zipPath} for carrier {carrierName} has sha512 {zipSha512}; expected {knownSha512}')
+
+    if manifestEntry is not None and manifestEntry.sha512 is not None and zipSha512 != manifestEntry.sha512:
+        raise FirmwareVerificationError(f'Firmware zip {zipPath} for carrier {carrierName} has sha512 {zipSha512}; it was downloaded with {manifestEntry.sha512}')
+
+    return zipSha512
+
+
+def unpackCarrierZip(carrierName, zipPath, zipSha512:str=None):
+    '''
+    Unpack the .cwe and .nvu files of a carrier firmware zip into its carrier dir; does nothing if the dir already has
+    the files of this exact zip.  The files are unpacked into a temp dir that is then swapped in for the carrier dir, so
+    the carrier dir never holds half an unpack
+
+    :param zipSha512: sha512 of the zip, if it was already hashed (ie. by verifyCarrierZip())
+    :return: [cwe file path, nvu file path]
+    '''
+    import zipfile
+
+    if zipSha512 is None:
+        zipSha512 = getFileSha512(zipPath)
+
+    carrierFirmwareDirname = os.path.join(MODEM_FIRMWARE_DIRNAME, carrierName)
+
+    if isUnpackCurrent(zipPath, zipSha512, carrierFirmwareDirname):
+        logger.debug(f'Firmware for carrier {carrierName} is already unpacked from {zipPath}')
+        stampDict = loadUnpackStamp(carrierFirmwareDirname)
+        return [os.path.join(carrierFirmwareDirname, stampDict['cweFilename']), os.path.join(carrierFirmwareDirname, stampDict['nvuFilename'])]
+
+    tempDirPath = tempfile.mkdtemp(prefix=f'.{carrierName}.', dir=MODEM_FIRMWARE_DIRNAME)
+    try:
+        with zipfile.ZipFile(zipPath, 'r') as zip_ref:
+            # validate from the central directory before writing anything
+            cweMember, nvuMember = getZipFirmwareMembers(carrierName, zip_ref)
+
+            fileSizeDict = {}
+            for curMember in [cweMember, nvuMember]:
+                curFilename = os.path.basename(curMember.filename)
+                # Note: zipfile checks the crc once the member has been read to the end
+                with zip_ref.open(curMember, 'r') as sourceFileObj, open(os.path.join(tempDirPath, curFilename), 'wb') as outputFileObj:
+                    shutil.copyfileobj(sourceFileObj, outputFileObj, HASH_READ_BLOCK_SIZE)
+                fileSizeDict[curFilename] = curMember.file_size
+
+        with open(os.path.join(tempDirPath, UNPACK_STAMP_FILENAME), 'w') as stampFile:
+            json.dump({
+                'zipFilename': os.path.basename(zipPath),
+                'zipSha512': zipSha512,
+                'cweFilename': os.path.basename(cweMember.filename),
+                'nvuFilename': os.path.basename(nvuMember.filename),
+                'files': fileSizeDict,
+            }, stampFile, indent=4)
+
+        # swap the new dir in for the old one
+        oldDirPath = None
+        if os.path.exists(carrierFirmwareDirname):
+            oldDirPath = f'{tempDirPath}.old'
+            os.rename(carrierFirmwareDirname, oldDirPath)
+        os.rename(tempDirPath, carrierFirmwareDirname)
+        if oldDirPath is not None:
+            shutil.rmtree(oldDirPath, ignore_errors=True)
+    finally:
+        if os.path.exists(tempDirPath):
+            shutil.rmtree(tempDirPath, ignore_errors=True)
+
+    logger.debug(f'Unpacked firmware for carrier {carrierName} from {zipPath}')
+
+    return [os.path.join(carrierFirmwareDirname, os.path.basename(cweMember.filename)), os.path.join(carrierFirmwareDirname, os.path.basename(nvuMember.filename))]
+
+
+def getCarrierImageVersion(nvuFilePath:str) -> tuple:
+    '''
+    Get what AT!IMAGE? shows for a carrier's firmware, from its nvu file name
+
+    :return: (build id, PRI version), ie. ('02.33.03.00_VERIZON', '002.079_002'), or None if the name does not tell
+    '''
+    nvuMatch = NVU_FILENAME_REGEX.search(os.path.basename(nvuFilePath))
+    if nvuMatch is None:
+        return None
+    return (f'{nvuMatch.group("fwVersion")}_{nvuMatch.group("carrier")}', nvuMatch.group('priVersion'))
+
+
+@traced()
+def prepareOneCarrierFirmware(carrierName:str) -> list:
+    '''
+    Verify the downloaded firmware zip of one carrier, unpack it and make sure the files are usable
+
+    :return: [cwe file path, nvu file path]
+    '''
+    modemFirmwareDirPath = os.path.realpath(MODEM_FIRMWARE_DIRNAME)
+    logger.debug(f'Unzipping firmware for carrier {carrierName}')
+    curCarrierZip = os.path.join(modemFirmwareDirPath, f'{carrierName}@*.zip')
+
+    # deglob carrier zip file
+    deglobbedList = glob.glob(curCarrierZip)
+    if len(deglobbedList) != 1:
+        raise RuntimeError(f'Wrong number of matches found (want exactly 1) when deglobbing firmware files for carrier {carrierName}: {json.dumps(deglobbedList, indent=4)}')
+    curCarrierZip = deglobbedList[0]
+
+    # hashing the zip (if it changed since its download was hashed) takes a while; that is why this runs in the
+    # background (see startCarrierFirmwarePrep())
+    zipSha512 = verifyCarrierZip(carrierName, curCarrierZip)
+
+    carrierFileList = unpackCarrierZip(carrierName, curCarrierZip, zipSha512)
+
+    # an empty image would only be found out after the modem already dropped off usb for it
+    for curFilePath in carrierFileList:
+        if os.path.getsize(curFilePath) < 1:
+            raise RuntimeError(f'Firmware file for carrier {carrierName} is empty: {curFilePath}')
+
+    return carrierFileList
+
+
+def prepareCarrierFirmware(firmwareToApply:list=None) -> dict:
+    '''
+    Unpack the downloaded firmware zip of each carrier
+
+    :param firmwareToApply: The carriers to unpack the firmware of
+    :return: Dictionary of carrier name -> [cwe file path, nvu file path]
+    '''
+    if firmwareToApply is None:
+        firmwareToApply = DEFAULT_FIRMWARE_ORDER_LIST
+
+    carrierFileDict = {}
+    for curCarrierName in firmwareToApply:
+        carrierFileDict[curCarrierName] = prepareOneCarrierFirmware(curCarrierName)
+
+    return carrierFileDict
+
+
+def startCarrierFirmwarePrep(firmwareToApply:list=None) -> dict:
+    '''
+    Same as prepareCarrierFirmware(), but in the background; use getCarrierFirmwareFiles() to get the files of a carrier
+    once they are needed.  The carriers are done one at a time in the given order (the order they get flashed in), so
+    the first one is ready as early as possible
+
+    :return: Dictionary of carrier name -> Future of [cwe file path, nvu file path]
+    '''
+    if firmwareToApply is None:
+        firmwareToApply = DEFAULT_FIRMWARE_ORDER_LIST
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='firmware-prep')
+    carrierFutureDict = {curCarrierName: executor.submit(prepareOneCarrierFirmware, curCarrierName) for curCarrierName in firmwareToApply}
+    # Note: the queued work still runs; this just lets the thread go away once it is done
+    executor.shutdown(wait=False)
+
+    return carrierFutureDict
+
+
+class CarrierFirmwareSource(ABC):
+    '''
+    Firmware files of a carrier that are only made available once they are about to be flashed (ie. out of a firmware
+    bundle; see modem_firmware_bundle.BundleFirmwareFiles).  Goes in a carrierFileDict in place of the
+    [cwe file path, nvu file path] list
+    '''
+    @abstractmethod
+    def getNvuFilename(self) -> str:
+        '''
+        The name of the nvu file, without making the files available (it tells the version; see getCarrierImageVersion())
+        '''
+        ...
+
+    @abstractmethod
+    def open(self) -> list:
+        '''
+        Make the files available (if they are not already)
+
+        :return: [cwe file path, nvu file path]
+        '''
+        ...
+
+    @abstractmethod
+    def release(self) -> None:
+        '''
+        Done with the files; a later open() makes them available again
+        '''
+        ...
+
+
+def getCarrierFirmwareFiles(carrierFileDict:dict, carrierName:str) -> list:
+    '''
+    Get the [cwe file path, nvu file path] of a carrier out of a prepareCarrierFirmware() or startCarrierFirmwarePrep()
+    result, waiting for it to be ready if needed
+    '''
+    carrierFiles = carrierFileDict[carrierName]
+    if isinstance(carrierFiles, CarrierFirmwareSource):
+        return carrierFiles.open()
+    if isinstance(carrierFiles, Future):
+        if not carrierFiles.done():
+            logger.debug(f'Waiting for the firmware of carrier {carrierName} to be ready')
+        carrierFiles = carrierFiles.result()
+    return carrierFiles
+
+
+def getCarrierNvuFilename(carrierFileDict:dict, carrierName:str) -> str:
+    '''
+    Get the name of a carrier's nvu file (see getCarrierImageVersion()); unlike getCarrierFirmwareFiles(), this does not
+    make the files of a CarrierFirmwareSource available
+    '''
+    carrierFiles = carrierFileDict[carrierName]
+    if isinstance(carrierFiles, CarrierFirmwareSource):
+        return carrierFiles.getNvuFilename()
+    return os.path.basename(getCarrierFirmwareFiles(carrierFileDict, carrierName)[1])
+
+
+def releaseCarrierFirmwareFiles(carrierFileDict:dict, carrierName:str) -> None:
+    '''
+    Let go of the files of a carrier once they are flashed (only does something for a CarrierFirmwareSource)
+    '''
+    carrierFiles = carrierFileDict[carrierName]
+    if isinstance(carrierFiles, CarrierFirmwareSource):
+        carrierFiles.release()
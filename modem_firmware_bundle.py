@@ -0,0 +1,416 @@
+#!/opt/modem_config/bin/python3
+'''
+Single file firmware bundle for provisioning without internet: every carrier's .cwe/.nvu stored uncompressed, with an
+index of where each one is, its sha512 and its carrier/version.  The bundle is read with mmap, so payloads are slices
+of the mapped file and never get unpacked to disk
+
+Layout (all integers little endian):
+    header:   magic (8 bytes), format version (uint32), index length (uint32), index offset (uint64)
+    payloads: the raw .cwe/.nvu files, each starting on a BUNDLE_ALIGNMENT boundary
+    index:    utf-8 json (see buildFirmwareBundle())
+
+usage:
+    modem_firmware_bundle.py build <bundle path> [carrier ...]
+    modem_firmware_bundle.py list <bundle path>
+    modem_firmware_bundle.py verify <bundle path>
+    modem_firmware_bundle.py flash <bundle path> [serial dev path]
+'''
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import struct
+import hashlib
+import tempfile
+import zipfile
+from dataclasses import dataclass, asdict
+from logging import Logger
+from modem_firmware import DEFAULT_FIRMWARE_ORDER_LIST, HASH_READ_BLOCK_SIZE, CarrierFirmwareSource, getCachedFirmwarePath, getCarrierImageVersion, getZipFirmwareMembers, loadFirmwareManifest
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+BUNDLE_MAGIC = b'MDMFWBDL'
+BUNDLE_FORMAT_VERSION = 1
+# magic, format version, index length, index offset
+BUNDLE_HEADER_STRUCT = struct.Struct('<8sIIQ')
+
+# payloads start on page boundaries so any of them can be mapped on its own
+BUNDLE_ALIGNMENT = mmap.PAGESIZE
+
+
+class FirmwareBundleError(RuntimeError):
+    ...
+
+
+@dataclass(frozen=True)
+class BundlePayload:
+    '''
+    One file in a bundle
+
+    :param filename: The name the file had in the carrier zip (qmi-firmware-update goes by the extension, and the nvu
+                     name carries the version)
+    :param offset: Where the file starts in the bundle
+    :param size: Size in bytes
+    :param sha512: Hash of the file
+    '''
+    filename: str
+    offset: int
+    size: int
+    sha512: str
+
+
+@dataclass(frozen=True)
+class BundleCarrier:
+    '''
+    Everything a bundle has for one carrier
+
+    :param carrierName: ie. Verizon
+    :param sourceZip: The <carrier>@<filename> name of the zip it came from
+    :param zipSha512: Hash of that zip
+    :param buildId: Firmware build, as AT!IMAGE? shows it (None if the nvu name does not tell)
+    :param priVersion: Carrier PRI version, as AT!IMAGE? shows it (None if the nvu name does not tell)
+    :param cwe: The firmware payload
+    :param nvu: The carrier provisioning PRI payload
+    '''
+    carrierName: str
+    sourceZip: str
+    zipSha512: str
+    buildId: str
+    priVersion: str
+    cwe: BundlePayload
+    nvu: BundlePayload
+
+
+def alignOffset(offset:int) -> int:
+    return (offset + BUNDLE_ALIGNMENT - 1) // BUNDLE_ALIGNMENT * BUNDLE_ALIGNMENT
+
+
+def buildFirmwareBundle(bundlePath:str, carrierList:list=None) -> list:
+    '''
+    Build a bundle from the download cache (see modem_firmware.downloadFirmware()).  The bundle is written next to
+    bundlePath and renamed into place once it is complete
+
+    :param carrierList: The carriers to put in the bundle, in flashing order
+    :return: The BundleCarrier of each carrier in the bundle
+    '''
+    if carrierList is None:
+        carrierList = DEFAULT_FIRMWARE_ORDER_LIST
+
+    manifestDict = loadFirmwareManifest()
+
+    # find everything first, so a missing carrier does not leave a half written bundle around
+    carrierZipList = []
+    for curCarrierName in carrierList:
+        cacheEntry = manifestDict.get(curCarrierName)
+        if cacheEntry is None or cacheEntry.sha512 is None or not os.path.isfile(getCachedFirmwarePath(cacheEntry.sha512)):
+            raise FirmwareBundleError(f'No downloaded firmware for carrier {curCarrierName}; download it first')
+        carrierZipList.append((curCarrierName, cacheEntry))
+
+    bundleCarrierList = []
+    tempFileObj = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.realpath(bundlePath)), prefix=f'.{os.path.basename(bundlePath)}.', delete=False)
+    try:
+        with tempFileObj as bundleFileObj:
+            # the header gets filled in once we know where the index ends up
+            bundleFileObj.write(b'\0' * BUNDLE_HEADER_STRUCT.size)
+
+            for curCarrierName, curCacheEntry in carrierZipList:
+                logger.debug(f'Adding firmware for carrier {curCarrierName} from {curCacheEntry.filename}')
+                with zipfile.ZipFile(getCachedFirmwarePath(curCacheEntry.sha512), 'r') as zip_ref:
+                    payloadList = []
+                    for curMember in getZipFirmwareMembers(curCarrierName, zip_ref):
+                        payloadOffset = alignOffset(bundleFileObj.tell())
+                        bundleFileObj.seek(payloadOffset)
+                        hashObj = hashlib.sha512()
+                        with zip_ref.open(curMember, 'r') as memberFileObj:
+                            for curBlock in iter(lambda: memberFileObj.read(HASH_READ_BLOCK_SIZE), b''):
+                                hashObj.update(curBlock)
+                                bundleFileObj.write(curBlock)
+                        payloadList.append(BundlePayload(
+                            filename=os.path.basename(curMember.filename),
+                            offset=payloadOffset,
+                            size=curMember.file_size,
+                            sha512=hashObj.hexdigest()))
+
+                imageVersion = getCarrierImageVersion(payloadList[1].filename) or (None, None)
+                bundleCarrierList.append(BundleCarrier(
+                    carrierName=curCarrierName,
+                    sourceZip=curCacheEntry.filename,
+                    zipSha512=curCacheEntry.sha512,
+                    buildId=imageVersion[0],
+                    priVersion=imageVersion[1],
+                    cwe=payloadList[0],
+                    nvu=payloadList[1]))
+
+            indexBytes = json.dumps({
+                'formatVersion': BUNDLE_FORMAT_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'carriers': [asdict(curBundleCarrier) for curBundleCarrier in bundleCarrierList],
+            }, indent=4).encode('utf-8')
+            indexOffset = bundleFileObj.tell()
+            bundleFileObj.write(indexBytes)
+
+            bundleFileObj.seek(0)
+            bundleFileObj.write(BUNDLE_HEADER_STRUCT.pack(BUNDLE_MAGIC, BUNDLE_FORMAT_VERSION, len(indexBytes), indexOffset))
+
+            bundleFileObj.flush()
+            os.fsync(bundleFileObj.fileno())
+        os.replace(tempFileObj.name, bundlePath)
+    finally:
+        if os.path.exists(tempFileObj.name):
+            os.remove(tempFileObj.name)
+
+    logger.info(f'Built firmware bundle {bundlePath} with {[curBundleCarrier.carrierName for curBundleCarrier in bundleCarrierList]}')
+
+    return bundleCarrierList
+
+
+def carrierFromIndexDict(indexDict:dict) -> BundleCarrier:
+    return BundleCarrier(**{**indexDict, 'cwe': BundlePayload(**indexDict['cwe']), 'nvu': BundlePayload(**indexDict['nvu'])})
+
+
+class FirmwareBundle:
+    '''
+    A bundle opened for reading.  Only the header and index are read up front; the payloads are slices of the mapped
+    file, so nothing is copied until something reads them
+
+    :param bundlePath: Path to the bundle file
+    '''
+    def __init__(self, bundlePath:str):
+        self.bundlePath = bundlePath
+
+        with open(bundlePath, 'rb') as bundleFileObj:
+            # Note: an empty file can not be mapped at all
+            if os.fstat(bundleFileObj.fileno()).st_size < BUNDLE_HEADER_STRUCT.size:
+                raise FirmwareBundleError(f'{bundlePath} is too small to be a firmware bundle')
+            self.mmapObj = mmap.mmap(bundleFileObj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self.carriers = self.readIndex()
+        except Exception:
+            self.mmapObj.close()
+            raise
+
+    def readIndex(self) -> dict:
+        magic, formatVersion, indexLength, indexOffset = BUNDLE_HEADER_STRUCT.unpack_from(self.mmapObj, 0)
+        if magic != BUNDLE_MAGIC:
+            raise FirmwareBundleError(f'{self.bundlePath} is not a firmware bundle')
+        if formatVersion != BUNDLE_FORMAT_VERSION:
+            raise FirmwareBundleError(f'{self.bundlePath} is bundle format version {formatVersion}; only version {BUNDLE_FORMAT_VERSION} is supported')
+        if indexOffset + indexLength > len(self.mmapObj):
+            raise FirmwareBundleError(f'{self.bundlePath} is truncated')
+
+        indexDict = json.loads(self.mmapObj[indexOffset:indexOffset + indexLength].decode('utf-8'))
+
+        carrierDict = {}
+        for curCarrierIndexDict in indexDict['carriers']:
+            curBundleCarrier = carrierFromIndexDict(curCarrierIndexDict)
+            for curPayload in [curBundleCarrier.cwe, curBundleCarrier.nvu]:
+                if curPayload.offset + curPayload.size > indexOffset:
+                    raise FirmwareBundleError(f'{curPayload.filename} for carrier {curBundleCarrier.carrierName} is outside of the payloads in {self.bundlePath}')
+            carrierDict[curBundleCarrier.carrierName] = curBundleCarrier
+
+        return carrierDict
+
+    def getPayload(self, payload:BundlePayload) -> memoryview:
+        '''
+        Get the bytes of a payload; this is a view into the mapped file (no copy).  Release it before closing the bundle
+        '''
+        return memoryview(self.mmapObj)[payload.offset:payload.offset + payload.size]
+
+    def verifyPayload(self, payload:BundlePayload) -> None:
+        with self.getPayload(payload) as payloadView:
+            if hashlib.sha512(payloadView).hexdigest() != payload.sha512:
+                raise FirmwareBundleError(f'{payload.filename} in {self.bundlePath} does not match its sha512')
+
+    def verify(self, carrierList:list=None) -> None:
+        '''
+        Check the sha512 of the payloads of the given carriers (all of them if not set)
+        '''
+        if carrierList is None:
+            carrierList = list(self.carriers)
+
+        for curCarrierName in carrierList:
+            curBundleCarrier = self.getCarrier(curCarrierName)
+            self.verifyPayload(curBundleCarrier.cwe)
+            self.verifyPayload(curBundleCarrier.nvu)
+
+    def getCarrier(self, carrierName:str) -> BundleCarrier:
+        if carrierName not in self.carriers:
+            raise FirmwareBundleError(f'No firmware for carrier {carrierName} in {self.bundlePath}; it has {list(self.carriers)}')
+        return self.carriers[carrierName]
+
+    def close(self) -> None:
+        self.mmapObj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BundleCarrierFiles(CarrierFirmwareSource):
+    '''
+    The payloads of one carrier in a bundle, made to look like files for qmi-firmware-update without writing them to
+    disk: on open() each payload goes into a memfd (memory only), and a symlink with the payload's original file name
+    points at that memfd through /proc.  release() closes the memfds and removes the symlinks again
+
+    :param bundle: The opened bundle
+    :param carrierName: The carrier
+    :param linkDirPath: Dir to put the symlinks in (under a dir named after the carrier)
+    :param verify: Check the sha512 of each payload while copying it (default)
+    '''
+    def __init__(self, bundle:FirmwareBundle, carrierName:str, linkDirPath:str, verify:bool=None):
+        if verify is None:
+            verify = True
+
+        self.bundle = bundle
+        self.bundleCarrier = bundle.getCarrier(carrierName)
+        self.linkDirPath = os.path.join(linkDirPath, carrierName)
+        self.verify = verify
+
+        self.fdList = []
+        self.filePathList = None
+
+    def getNvuFilename(self) -> str:
+        # straight from the index; nothing has to be copied for it
+        return self.bundleCarrier.nvu.filename
+
+    def exposePayload(self, payload:BundlePayload) -> str:
+        payloadFd = os.memfd_create(f'{self.bundleCarrier.carrierName}@{payload.filename}')
+        self.fdList.append(payloadFd)
+        hashObj = hashlib.sha512()
+        with self.bundle.getPayload(payload) as payloadView:
+            for curOffset in range(0, len(payloadView), HASH_READ_BLOCK_SIZE):
+                with payloadView[curOffset:curOffset + HASH_READ_BLOCK_SIZE] as blockView:
+                    if self.verify:
+                        hashObj.update(blockView)
+                    writtenSize = 0
+                    while writtenSize < len(blockView):
+                        writtenSize += os.write(payloadFd, blockView[writtenSize:])
+        if self.verify and hashObj.hexdigest() != payload.sha512:
+            raise FirmwareBundleError(f'{payload.filename} in {self.bundle.bundlePath} does not match its sha512')
+
+        # Note: through /proc/<pid>/fd the child process opens the memfd itself; it does not need to inherit it
+        linkPath = os.path.join(self.linkDirPath, payload.filename)
+        os.symlink(f'/proc/{os.getpid()}/fd/{payloadFd}', linkPath)
+        return linkPath
+
+    def open(self) -> list:
+        if self.filePathList is None:
+            logger.debug(f'Copying the firmware for carrier {self.bundleCarrier.carrierName} out of {self.bundle.bundlePath}')
+            os.makedirs(self.linkDirPath, exist_ok=True)
+            try:
+                self.filePathList = [self.exposePayload(self.bundleCarrier.cwe), self.exposePayload(self.bundleCarrier.nvu)]
+            except BaseException:
+                self.release()
+                raise
+        return self.filePathList
+
+    def release(self) -> None:
+        shutil.rmtree(self.linkDirPath, ignore_errors=True)
+        for curFd in self.fdList:
+            os.close(curFd)
+        self.fdList = []
+        self.filePathList = None
+
+
+class BundleFirmwareFiles:
+    '''
+    Makes the payloads of a bundle available to configureModem() (see BundleCarrierFiles).  Nothing is copied up front;
+    each carrier's payloads are copied into memory when its slot gets flashed, and let go of once it is flashed.  Use it
+    as a context manager; whatever is still around goes away on exit
+
+    :param bundle: The opened bundle
+    :param carrierList: The carriers to expose, in flashing order; every carrier in the bundle, in the bundle's order, if not
+                        set
+    :param verify: Check the sha512 of each payload as it gets copied (default)
+    '''
+    def __init__(self, bundle:FirmwareBundle, carrierList:list=None, verify:bool=None):
+        if carrierList is None:
+            # the index is in the order the bundle was built with
+            carrierList = list(bundle.carriers)
+
+        self.bundle = bundle
+        self.carrierList = carrierList
+        self.verify = verify
+
+        self.linkDirPath = None
+        self.carrierFileDict = {}
+
+    def __enter__(self) -> dict:
+        '''
+        :return: Dictionary of carrier name -> BundleCarrierFiles (what configureModem() takes as carrierFileDict)
+        '''
+        self.linkDirPath = tempfile.mkdtemp(prefix='modem-firmware-bundle-')
+        try:
+            for curCarrierName in self.carrierList:
+                self.carrierFileDict[curCarrierName] = BundleCarrierFiles(self.bundle, curCarrierName, self.linkDirPath, verify=self.verify)
+        except BaseException:
+            self.close()
+            raise
+        return dict(self.carrierFileDict)
+
+    def close(self) -> None:
+        for curCarrierFiles in self.carrierFileDict.values():
+            curCarrierFiles.release()
+        self.carrierFileDict = {}
+        if self.linkDirPath is not None:
+            shutil.rmtree(self.linkDirPath, ignore_errors=True)
+            self.linkDirPath = None
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == '__main__':
+    import logging
+    import modem_firmware
+
+    # define file handler and set formatter
+    streamHandler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    streamHandler.setFormatter(formatter)
+    streamHandler.setLevel(logging.DEBUG)
+
+    logger.addHandler(streamHandler)
+    modem_firmware.logger.addHandler(streamHandler)
+    logger.setLevel(logging.DEBUG)
+    modem_firmware.logger.setLevel(logging.DEBUG)
+
+    if len(sys.argv) < 3 or sys.argv[1] not in ('build', 'list', 'verify', 'flash'):
+        print(__doc__.strip().split('usage:')[1], file=sys.stderr)
+        sys.exit(2)
+
+    command = sys.argv[1]
+    bundle_path = sys.argv[2]
+
+    if command == 'build':
+        buildFirmwareBundle(bundle_path, sys.argv[3:] or None)
+        sys.exit(0)
+
+    with FirmwareBundle(bundle_path) as bundle:
+        if command == 'list':
+            for curBundleCarrier in bundle.carriers.values():
+                print(f'{curBundleCarrier.carrierName}: {curBundleCarrier.buildId} ({curBundleCarrier.priVersion}) from {curBundleCarrier.sourceZip}')
+                for curPayload in [curBundleCarrier.cwe, curBundleCarrier.nvu]:
+                    print(f'    {curPayload.filename}: {curPayload.size} bytes at {curPayload.offset}')
+        elif command == 'verify':
+            bundle.verify()
+            print(f'{bundle_path}: ok')
+        elif command == 'flash':
+            import modem_at
+            import modem_config
+            import modem_usb
+
+            for curModule in [modem_at, modem_config, modem_usb]:
+                curModule.logger.addHandler(streamHandler)
+                curModule.logger.setLevel(logging.DEBUG)
+
+            serial_dev_path = sys.argv[3] if len(sys.argv) > 3 else None
+            # flash what the bundle has, in its order
+            firmware_to_apply = list(bundle.carriers)
+            with BundleFirmwareFiles(bundle, firmware_to_apply) as carrier_file_dict:
+                modem_config.configureModem(serial_dev_path, firmware_to_apply, carrierFileDict=carrier_file_dict, diffOnly=os.getenv('APPLY_DIFF_ONLY') == 'true')
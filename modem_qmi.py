@@ -0,0 +1,418 @@
+#!/opt/modem_config/bin/python3
+'''
+In-process QMI client for the DMS requests the modem tools make, so they do not have to fork qmicli for each one.  It
+speaks QMUX straight to the modem's QMI control device (/dev/cdc-wdm*) and keeps its client ids for the whole session.
+Note: this does not go through qmi-proxy, so do not use it while ModemManager is using the device.  Any byte stream
+that speaks QMUX can stand in for the device (ie. a pty or one end of a socketpair); see QmiClient(fd=...)
+'''
+import os
+import sys
+import tty
+import time
+import struct
+import select
+import threading
+from dataclasses import dataclass, field
+from logging import Logger
+from modem_trace import traceSpan
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+# QMUX header: I/F type, length (of everything after the I/F type), control flags, service type, client id
+QMUX_IF_TYPE = 0x01
+QMUX_HEADER_FORMAT = '<BHBBB'
+QMUX_HEADER_SIZE = struct.calcsize(QMUX_HEADER_FORMAT)
+QMUX_FLAG_SERVICE = 0x80
+
+# QMI header after the QMUX one: control flags, transaction id, message id, length of the TLVs.  Note: the CTL service
+# has a 1 byte transaction id and its own control flag values
+QMI_CTL_HEADER_FORMAT = '<BBHH'
+QMI_SERVICE_HEADER_FORMAT = '<BHHH'
+QMI_CTL_FLAG_RESPONSE = 0x01
+QMI_CTL_FLAG_INDICATION = 0x02
+QMI_SERVICE_FLAG_RESPONSE = 0x02
+QMI_SERVICE_FLAG_INDICATION = 0x04
+
+QMI_TLV_HEADER_FORMAT = '<BH'
+QMI_TLV_HEADER_SIZE = struct.calcsize(QMI_TLV_HEADER_FORMAT)
+# every response has this one: result (0 is success), error code
+QMI_RESULT_TLV = 0x02
+QMI_RESULT_FORMAT = '<HH'
+
+QMI_SERVICE_CTL = 0x00
+QMI_SERVICE_DMS = 0x02
+
+QMI_CTL_GET_CLIENT_ID = 0x0022
+QMI_CTL_RELEASE_CLIENT_ID = 0x0023
+
+QMI_DMS_GET_REVISION = 0x0023
+QMI_DMS_VALIDATE_SERVICE_PROGRAMMING_CODE = 0x0028
+QMI_DMS_SET_OPERATING_MODE = 0x002E
+QMI_DMS_RESTORE_FACTORY_DEFAULTS = 0x003A
+QMI_DMS_SWI_GET_USB_COMPOSITION = 0x555B
+QMI_DMS_SWI_SET_USB_COMPOSITION = 0x555C
+
+# for log and error messages; (service, message id) -> name
+QMI_MESSAGE_NAMES = {
+    (QMI_SERVICE_CTL, QMI_CTL_GET_CLIENT_ID): 'CTL Allocate CID',
+    (QMI_SERVICE_CTL, QMI_CTL_RELEASE_CLIENT_ID): 'CTL Release CID',
+    (QMI_SERVICE_DMS, QMI_DMS_GET_REVISION): 'DMS Get Revision',
+    (QMI_SERVICE_DMS, QMI_DMS_VALIDATE_SERVICE_PROGRAMMING_CODE): 'DMS Validate Service Programming Code',
+    (QMI_SERVICE_DMS, QMI_DMS_SET_OPERATING_MODE): 'DMS Set Operating Mode',
+    (QMI_SERVICE_DMS, QMI_DMS_RESTORE_FACTORY_DEFAULTS): 'DMS Restore Factory Defaults',
+    (QMI_SERVICE_DMS, QMI_DMS_SWI_GET_USB_COMPOSITION): 'DMS Swi Get USB Composition',
+    (QMI_SERVICE_DMS, QMI_DMS_SWI_SET_USB_COMPOSITION): 'DMS Swi Set USB Composition',
+}
+
+# the protocol errors we are likely to see; the rest are shown by number
+QMI_ERROR_NAMES = {
+    0x01: 'MalformedMessage',
+    0x03: 'Internal',
+    0x05: 'ClientIdsExhausted',
+    0x07: 'InvalidClientId',
+    0x30: 'InvalidArgument',
+    0x47: 'InvalidQmiCommand',
+    0x5E: 'NotSupported',
+}
+
+# names as qmicli takes them (--dms-set-operating-mode=...) -> value
+DMS_OPERATING_MODES = {
+    'online': 0,
+    'low-power': 1,
+    'factory-test': 2,
+    'offline': 3,
+    'reset': 4,
+    'shutting-down': 5,
+    'persistent-low-power': 6,
+    'mode-only-low-power': 7,
+}
+
+# the service programming code is always 6 digits
+SERVICE_PROGRAMMING_CODE_LENGTH = 6
+
+# seconds to wait for a response (what qmicli waits too)
+DEFAULT_QMI_TIMEOUT = 10
+# releasing the client ids on close is a courtesy; do not hang around for it
+QMI_RELEASE_TIMEOUT = 1
+
+QMI_READ_SIZE = 4096
+
+
+class QmiError(RuntimeError):
+    '''
+    :param errorCode: QMI protocol error code from the response, if it got that far
+    '''
+    def __init__(self, message, errorCode:int=None):
+        super().__init__(message)
+        self.errorCode = errorCode
+
+
+class QmiTimeoutError(QmiError):
+    ...
+
+
+@dataclass
+class QmiMessage:
+    '''
+    One QMUX message
+
+    :param service: QMI service type (ie. QMI_SERVICE_DMS)
+    :param clientId: Client id within the service; 0 for CTL
+    :param transactionId: Matches a response to its request
+    :param flags: QMI control flags (ie. QMI_SERVICE_FLAG_RESPONSE); 0 for a request
+    :param tlvs: TLV type -> value bytes
+    :param fromService: Set in messages sent by the modem
+    '''
+    service: int
+    clientId: int
+    transactionId: int
+    messageId: int
+    flags: int = 0
+    tlvs: dict = field(default_factory=dict)
+    fromService: bool = False
+
+    @property
+    def isResponse(self) -> bool:
+        return self.flags == (QMI_CTL_FLAG_RESPONSE if self.service == QMI_SERVICE_CTL else QMI_SERVICE_FLAG_RESPONSE)
+
+    @property
+    def name(self) -> str:
+        return QMI_MESSAGE_NAMES.get((self.service, self.messageId), f'service {self.service} message 0x{self.messageId:04x}')
+
+
+def packQmiMessage(message:QmiMessage) -> bytes:
+    tlvBytes = b''.join(struct.pack(QMI_TLV_HEADER_FORMAT, curType, len(curValue)) + curValue for curType, curValue in message.tlvs.items())
+    if message.service == QMI_SERVICE_CTL:
+        qmiHeader = struct.pack(QMI_CTL_HEADER_FORMAT, message.flags, message.transactionId, message.messageId, len(tlvBytes))
+    else:
+        qmiHeader = struct.pack(QMI_SERVICE_HEADER_FORMAT, message.flags, message.transactionId, message.messageId, len(tlvBytes))
+
+    qmuxLength = QMUX_HEADER_SIZE - 1 + len(qmiHeader) + len(tlvBytes)
+    qmuxHeader = struct.pack(QMUX_HEADER_FORMAT, QMUX_IF_TYPE, qmuxLength, QMUX_FLAG_SERVICE if message.fromService else 0, message.service, message.clientId)
+    return qmuxHeader + qmiHeader + tlvBytes
+
+
+def parseQmiMessage(frameBytes:bytes) -> QmiMessage:
+    '''
+    Parse one whole QMUX frame (see splitQmuxFrame())
+    '''
+    try:
+        _, _, qmuxFlags, service, clientId = struct.unpack_from(QMUX_HEADER_FORMAT, frameBytes)
+        headerFormat = QMI_CTL_HEADER_FORMAT if service == QMI_SERVICE_CTL else QMI_SERVICE_HEADER_FORMAT
+        flags, transactionId, messageId, tlvLength = struct.unpack_from(headerFormat, frameBytes, QMUX_HEADER_SIZE)
+
+        tlvs = {}
+        offset = QMUX_HEADER_SIZE + struct.calcsize(headerFormat)
+        endOffset = offset + tlvLength
+        if endOffset > len(frameBytes):
+            raise QmiError(f'QMI message is cut short: {frameBytes.hex()}')
+        while offset < endOffset:
+            curType, curLength = struct.unpack_from(QMI_TLV_HEADER_FORMAT, frameBytes, offset)
+            offset += QMI_TLV_HEADER_SIZE
+            if offset + curLength > endOffset:
+                raise QmiError(f'QMI TLV 0x{curType:02x} runs past the end of the message: {frameBytes.hex()}')
+            tlvs[curType] = bytes(frameBytes[offset:offset + curLength])
+            offset += curLength
+    except struct.error as e:
+        raise QmiError(f'Malformed QMI message: {frameBytes.hex()}') from e
+
+    return QmiMessage(service, clientId, transactionId, messageId, flags=flags, tlvs=tlvs, fromService=bool(qmuxFlags & QMUX_FLAG_SERVICE))
+
+
+def splitQmuxFrame(buffer:bytes) -> tuple:
+    '''
+    Take the first whole QMUX frame off a byte stream.  Anything before a frame start is dropped (ie. noise on a pty)
+
+    :return: (frame bytes or None if there is no whole frame yet, rest of the buffer)
+    '''
+    startIndex = buffer.find(bytes([QMUX_IF_TYPE]))
+    if startIndex < 0:
+        return None, b''
+    buffer = buffer[startIndex:]
+
+    if len(buffer) < 3:
+        return None, buffer
+    # Note: the length does not count the I/F type byte
+    frameLength = 1 + struct.unpack_from('<H', buffer, 1)[0]
+    if len(buffer) < frameLength:
+        return None, buffer
+    return buffer[:frameLength], buffer[frameLength:]
+
+
+def checkQmiResult(message:QmiMessage) -> None:
+    '''
+    Raise QmiError if the response says the request failed
+    '''
+    resultBytes = message.tlvs.get(QMI_RESULT_TLV)
+    if resultBytes is None or len(resultBytes) < struct.calcsize(QMI_RESULT_FORMAT):
+        raise QmiError(f'{message.name}: response has no result')
+
+    result, errorCode = struct.unpack_from(QMI_RESULT_FORMAT, resultBytes)
+    if result != 0:
+        raise QmiError(f'{message.name} failed: {QMI_ERROR_NAMES.get(errorCode, f"error {errorCode}")}', errorCode)
+
+
+class QmiClient:
+    '''
+    QMI session on the modem's QMI control device.  A client id is allocated for a service the first time it is used and
+    kept until close(), so a run of requests costs one allocation instead of one per request.  Requests from several
+    threads are sent one at a time
+
+    :param devPath: QMI control device (ie. /dev/cdc-wdm0)
+    :param fd: Already open QMUX byte stream to use instead of opening devPath; it is not closed by close()
+    :param timeout: Seconds to wait for each response
+    '''
+    def __init__(self, devPath:str=None, fd:int=None, timeout:float=None):
+        if devPath is None and fd is None:
+            raise ValueError('Need the QMI device path or an open fd')
+        if timeout is None:
+            timeout = DEFAULT_QMI_TIMEOUT
+
+        self.devPath = devPath if devPath is not None else f'fd {fd}'
+        self.timeout = timeout
+        self.ownsFd = fd is None
+        if fd is None:
+            fd = os.open(devPath, os.O_RDWR | os.O_NOCTTY | os.O_CLOEXEC)
+        self.fd = fd
+        # a tty (ie. a pty standing in for the device) has to pass the frames through untouched
+        if os.isatty(self.fd):
+            tty.setraw(self.fd)
+
+        self.readBuffer = b''
+        # service -> client id
+        self.clientIdDict = {}
+        # service -> last transaction id used
+        self.transactionIdDict = {}
+        self.lock = threading.RLock()
+
+    def getTransactionId(self, service:int) -> int:
+        # Note: 0 is not a valid transaction id; the CTL one is a single byte
+        maxTransactionId = 0xFF if service == QMI_SERVICE_CTL else 0xFFFF
+        transactionId = self.transactionIdDict.get(service, 0) % maxTransactionId + 1
+        self.transactionIdDict[service] = transactionId
+        return transactionId
+
+    def readMessage(self, timeout:float) -> QmiMessage:
+        '''
+        Wait up to timeout seconds for the next message from the modem.  Returns None if nothing came
+        '''
+        endTime = time.monotonic() + timeout
+        while True:
+            frameBytes, self.readBuffer = splitQmuxFrame(self.readBuffer)
+            if frameBytes is not None:
+                return parseQmiMessage(frameBytes)
+
+            remainingTime = endTime - time.monotonic()
+            if remainingTime <= 0:
+                return None
+            readyList, _, _ = select.select([self.fd], [], [], remainingTime)
+            if len(readyList) < 1:
+                continue
+            data = os.read(self.fd, QMI_READ_SIZE)
+            if len(data) < 1:
+                raise QmiError(f'QMI device {self.devPath} closed')
+            self.readBuffer += data
+
+    def sendRequest(self, service:int, messageId:int, tlvs:dict=None, timeout:float=None) -> dict:
+        '''
+        Send a request and wait for its response
+
+        :param tlvs: TLV type -> value bytes
+        :return: The TLVs of the response
+        '''
+        if tlvs is None:
+            tlvs = {}
+        if timeout is None:
+            timeout = self.timeout
+
+        with self.lock:
+            clientId = 0 if service == QMI_SERVICE_CTL else self.getClientId(service)
+            request = QmiMessage(service, clientId, self.getTransactionId(service), messageId, tlvs=tlvs)
+            with traceSpan('qmiRequest', message=request.name):
+                os.write(self.fd, packQmiMessage(request))
+
+                endTime = time.monotonic() + timeout
+                while True:
+                    response = self.readMessage(endTime - time.monotonic())
+                    if response is None:
+                        raise QmiTimeoutError(f'{request.name}: no response from {self.devPath} after {timeout} s')
+                    # skip indications and whatever is not ours (the device can be shared with other clients)
+                    if response.isResponse and (response.service, response.clientId, response.transactionId, response.messageId) == (service, clientId, request.transactionId, messageId):
+                        break
+                    logger.debug(f'Skipping QMI message {response.name} (client {response.clientId}, transaction {response.transactionId})')
+
+        checkQmiResult(response)
+        return response.tlvs
+
+    def getClientId(self, service:int) -> int:
+        '''
+        Client id for the service; allocated on first use and kept for the session
+        '''
+        with self.lock:
+            clientId = self.clientIdDict.get(service)
+            if clientId is None:
+                responseTlvs = self.sendRequest(QMI_SERVICE_CTL, QMI_CTL_GET_CLIENT_ID, {0x01: bytes([service])})
+                _, clientId = struct.unpack_from('<BB', responseTlvs[0x01])
+                self.clientIdDict[service] = clientId
+                logger.debug(f'Allocated QMI client id {clientId} for service {service} on {self.devPath}')
+            return clientId
+
+    def releaseClientIds(self) -> None:
+        with self.lock:
+            for curService, curClientId in self.clientIdDict.items():
+                try:
+                    self.sendRequest(QMI_SERVICE_CTL, QMI_CTL_RELEASE_CLIENT_ID, {0x01: bytes([curService, curClientId])}, timeout=QMI_RELEASE_TIMEOUT)
+                except (QmiError, OSError) as e:
+                    # the modem forgets them when it resets anyway
+                    logger.debug(f'Could not release QMI client id {curClientId} of service {curService}: {e}')
+            self.clientIdDict = {}
+
+    def close(self) -> None:
+        if self.fd is None:
+            return
+        self.releaseClientIds()
+        if self.ownsFd:
+            os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # ---- DMS ----
+
+    def setOperatingMode(self, mode:str) -> None:
+        '''
+        :param mode: One of DMS_OPERATING_MODES (ie. offline or reset)
+        '''
+        if mode not in DMS_OPERATING_MODES:
+            raise ValueError(f'Unknown operating mode {mode}; expected one of {list(DMS_OPERATING_MODES)}')
+        self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_SET_OPERATING_MODE, {0x01: bytes([DMS_OPERATING_MODES[mode]])})
+        if mode == 'reset':
+            # the modem drops all of its clients when it resets; there is nothing left to release
+            self.clientIdDict = {}
+
+    def getRevision(self) -> str:
+        responseTlvs = self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_GET_REVISION)
+        return responseTlvs[0x01].decode('utf-8', errors='replace')
+
+    def getUsbComposition(self) -> tuple:
+        '''
+        :return: (current composition, [supported compositions])
+        '''
+        responseTlvs = self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_SWI_GET_USB_COMPOSITION)
+        currentComposition = responseTlvs[0x10][0] if 0x10 in responseTlvs else None
+        supportedBytes = responseTlvs.get(0x11, b'\0')
+        # a count and then that many compositions
+        return currentComposition, list(supportedBytes[1:1 + supportedBytes[0]])
+
+    def setUsbComposition(self, composition:int) -> None:
+        self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_SWI_SET_USB_COMPOSITION, {0x01: bytes([composition])})
+
+    def validateServiceProgrammingCode(self, serviceProgCode:str) -> None:
+        self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_VALIDATE_SERVICE_PROGRAMMING_CODE, {0x01: encodeServiceProgrammingCode(serviceProgCode)})
+
+    def restoreFactoryDefaults(self, serviceProgCode:str) -> None:
+        self.sendRequest(QMI_SERVICE_DMS, QMI_DMS_RESTORE_FACTORY_DEFAULTS, {0x01: encodeServiceProgrammingCode(serviceProgCode)})
+
+
+def encodeServiceProgrammingCode(serviceProgCode:str) -> bytes:
+    if len(serviceProgCode) != SERVICE_PROGRAMMING_CODE_LENGTH or not serviceProgCode.isdigit():
+        raise ValueError(f'The service programming code has to be {SERVICE_PROGRAMMING_CODE_LENGTH} digits')
+    return serviceProgCode.encode('ascii')
+
+
+if __name__ == '__main__':
+    import logging
+
+    # define file handler and set formatter
+    streamHandler = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    streamHandler.setFormatter(formatter)
+
+    # add file handler to logger
+    logger.addHandler(streamHandler)
+    logger.setLevel(logging.DEBUG)
+
+    # usage: modem_qmi.py <qmi device> get-revision|get-usb-composition|set-usb-composition <n>|set-operating-mode <mode>
+    if len(sys.argv) < 3:
+        print('usage: modem_qmi.py <qmi device> get-revision|get-usb-composition|set-usb-composition <n>|set-operating-mode <mode>', file=sys.stderr)
+        sys.exit(2)
+    qmi_dev_path = sys.argv[1]
+    action = sys.argv[2]
+
+    with QmiClient(qmi_dev_path) as qmiClient:
+        if action == 'get-revision':
+            print(qmiClient.getRevision())
+        elif action == 'get-usb-composition':
+            current_composition, supported_compositions = qmiClient.getUsbComposition()
+            print(f'current: {current_composition}, supported: {supported_compositions}')
+        elif action == 'set-usb-composition' and len(sys.argv) > 3:
+            qmiClient.setUsbComposition(int(sys.argv[3]))
+        elif action == 'set-operating-mode' and len(sys.argv) > 3:
+            qmiClient.setOperatingMode(sys.argv[3])
+        else:
+            print(f'Unknown action {action}', file=sys.stderr)
+            sys.exit(2)
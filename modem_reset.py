@@ -1,85 +1,81 @@
 #!/usr/bin/env python3
 
 import json
-import shutil
 import time
-import re
-import subprocess
 import sys
 import os
 import os.path
 from logging import Logger
-from fcntl import ioctl
+from modem_usb import UsbDevice, findUsbDevices, findModemPorts, getUsbDeviceRecord, waitForUsbCondition, getWaitDeadline, resetUsbDevice
+from modem_trace import traced, startTrace, stopTrace
 
 logger = Logger(os.path.split(os.path.basename(__file__))[0])
 
+# Note: anything getDeviceMatcher() understands works anywhere a vidPid is taken
 DEFAULT_DEVICE_VID_PID = '1199:9071'  # maybe these? 1199:9071|1199:9079|413C:81B6
 
-#define USBDEVFS_RESET             _IO('U', 20)
-USBDEVFS_RESET = ord('U') << (4*2) | 20
+# how long to wait for the modem, in seconds
+DEFAULT_MODEM_WAIT_TIMEOUT = 30
+# the usb device can show up a moment before its driver creates the device file
+DEVICE_FILES_WAIT_TIMEOUT = 3
 
 class NoUsbDeviceFoundError(RuntimeError):
     ...
 
-def getVidPidRegex(vidPid=None):
-    global vidPidRegex
-
+@traced()
+def waitForModem(vidPid=None, timeout:float=None, deadline:float=None) -> UsbDevice:
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
     if vidPid is None:
         vidPid = DEFAULT_DEVICE_VID_PID
 
-    # TODO: vidPid could be an re object (for multiple or more interesting matches)
-    # TODO: vidpid could be a list
-    vidPidRegex = re.compile(r'^'+r'\S+\s+'*5+r'(?P<vidpid>' + re.escape(vidPid) + r')\b.*$')
-
-    return vidPidRegex
-
-def waitForModem(vidPid=None, maxRetries:int=None, interval:float=None) -> None:
-    if maxRetries is None:
-        maxRetries = 10
-    if interval is None:
-        interval = 3
-
-    lsusbPath = shutil.which('lsusb')
-
-    # Try this up to 10 times
-    for curTry in range(0,maxRetries):
-        # if this is not the first loop, log that we are waiting and sleep
-        logging.debug(f'Waiting for modem to appear in lsusb output (retry {curTry}) ...')
-        time.sleep(interval)
-
-        proccomp = subprocess.run([lsusbPath], capture_output=True, check=True, encoding='utf-8')
-
-        matches = []
-        for curLine in proccomp.stdout.splitlines():
-            curMatch = getVidPidRegex(vidPid).search(curLine)
-            if curMatch is not None:
-                matches += [curMatch]
-        matchLines = [curMatch.group(0) for curMatch in matches]
+    def findModem():
+        matches = findUsbDevices(vidPid)
 
         # can only do 1 atm
         if len(matches) > 1:
+            matchLines = [str(curMatch) for curMatch in matches]
             raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}:\n{json.dumps(matchLines, indent=4)}')
-        # if we found our device, exit the loop
+        # if we found our device, we are done
         if len(matches) > 0:
-            logger.debug(f'found the following device line:\n{matches[0]}')
-            break
-    else:
+            logger.debug(f'found the following device:\n{matches[0]}')
+            return matches[0]
+        logger.debug('Waiting for modem to appear on the usb bus ...')
+        return None
+
+    startTime = time.monotonic()
+    foundDevice = waitForUsbCondition(findModem, timeout=timeout, vidPid=vidPid, deadline=deadline)
+    if foundDevice is None:
         # we did not find the target device
-        raise NoUsbDeviceFoundError('No usb device found')
+        raise NoUsbDeviceFoundError(f'No usb device found after {time.monotonic() - startTime:.1f} s')
 
-def waitForModemDevice(vidPid=None, maxRetries:int=None, interval:float=None):
-    findPath = shutil.which('find')
+    return foundDevice
 
-    waitForModem(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
+@traced()
+def waitForModemDevice(vidPid=None, timeout:float=None, deadline:float=None):
+    if timeout is None:
+        timeout = DEFAULT_MODEM_WAIT_TIMEOUT
+    if vidPid is None:
+        vidPid = DEFAULT_DEVICE_VID_PID
+
+    deadline = getWaitDeadline(timeout, deadline)
+    waitForModem(vidPid=vidPid, deadline=deadline)
 
     # do we really need this here? searching dmesg is rough
     # this looks for the output from qcserial creating a tty for subdevice 3
     #ttyUSB=$(dmesg | grep '.3: Qualcomm USB modem converter detected' -A1 | grep -Eo 'ttyUSB[0-9]$' | tail -1)
 
-    proccomp = subprocess.run([findPath, '/dev', '-maxdepth', '1', '-regex', '/dev/cdc-wdm[0-9]', '-o', '-regex', '/dev/qcqmi[0-9]'], capture_output=True, check=True, encoding='utf-8')
+    def findModemDevices():
+        matches = [curQmiDevPath for curModemPorts in findModemPorts(vidPid) for curQmiDevPath in curModemPorts.qmiDevPaths]
+        if len(matches) < 1:
+            return None
+        return matches
+
+    # the usb device can show up a moment before its driver creates the device file; give it a little extra time
+    matches = waitForUsbCondition(findModemDevices, vidPid=vidPid, deadline=max(deadline, time.monotonic() + DEVICE_FILES_WAIT_TIMEOUT))
+    if matches is None:
+        matches = []
 
-    matches = proccomp.stdout.splitlines()
-    
     # can only do 1 atm
     #if len(matches) > 1:
     #    raise RuntimeError(f'Too many matching devices.  Expected max of 1, but found {len(matches)}')
@@ -89,43 +85,23 @@ def waitForModemDevice(vidPid=None, maxRetries:int=None, interval:float=None):
 
     return matches[0]
 
-def resetModem(vidPid=None, maxRetries:int=None, interval:float=None):
-    modemDevPath = waitForModemDevice(vidPid=vidPid, maxRetries=maxRetries, interval=interval)
-
-    # get enough device info to find the pci device
-    qmiDevStat = os.stat(modemDevPath)
-    qmiDevRdev = qmiDevStat.st_rdev
-    qmiDevMajor = os.major(qmiDevRdev)
-    qmiDevMinor = os.minor(qmiDevRdev)
-    # USB sysfs for QMI char device of modem
-    sysfsCharDevPath = f'/sys/dev/char/{qmiDevMajor}:{qmiDevMinor}/device'
-    sysfsCharDevPciPath = os.path.realpath(sysfsCharDevPath)
-    logger.debug(f'USB sysfs for QMI char device of modem: {sysfsCharDevPciPath}')
-    # PCI device
-    sysfsUsbDevPciPath = os.path.join(sysfsCharDevPciPath, '..')
-    logger.debug(f'sysfs path for PCI device for QMI char device of modem: {sysfsUsbDevPciPath}')
-    # PCI device info
-    sysfsUsbDevPciBusnumPath = os.path.join(sysfsUsbDevPciPath, 'busnum')
-    sysfsUsbDevPciDevnumPath = os.path.join(sysfsUsbDevPciPath, 'devnum')
-
-    usbDevPciBusNum = None
-    with open(sysfsUsbDevPciBusnumPath, 'r') as busnumFileObj:
-        usbDevPciBusNum = int(busnumFileObj.read())
-
-    usbDevPciDevNum = None
-    with open(sysfsUsbDevPciDevnumPath, 'r') as devnumFileObj:
-        usbDevPciDevNum = int(devnumFileObj.read())
-
-    devNodePath=f'/dev/bus/usb/{usbDevPciBusNum:03d}/{usbDevPciDevNum:03d}'
+@traced()
+def resetModem(vidPid=None, timeout:float=None):
+    modemDevPath = waitForModemDevice(vidPid=vidPid, timeout=timeout)
+
+    # usb identity and topology of the QMI char device of the modem (cached until the modem re-enumerates)
+    modemUsbDeviceRecord = getUsbDeviceRecord(modemDevPath)
+    logger.debug(f'USB sysfs for QMI char device of modem: {modemUsbDeviceRecord.sysfsIfacePath}')
+
+    devNodePath = modemUsbDeviceRecord.usbDevNodePath
     logger.debug(f'Path to the USB device node of the modem: {devNodePath}')
 
     if os.environ.get('PREP_ONLY', 'false') != 'true':
-        # This part works with ANY usb device
-        with open(devNodePath, "wb") as fd:
-            ioctl(fd, USBDEVFS_RESET, 0)
+        resetUsbDevice(devNodePath)
 
 if __name__ == '__main__':
     import logging
+    import modem_usb
 
     # define file handler and set formatter
     streamHandler = logging.StreamHandler()
@@ -134,13 +110,24 @@ if __name__ == '__main__':
 
     # add file handler to logger
     logger.addHandler(streamHandler)
+    modem_usb.logger.addHandler(streamHandler)
 
     # set log level
     logger.setLevel(logging.DEBUG)
+    modem_usb.logger.setLevel(logging.DEBUG)
 
     # TODO: if this gets more complex, implement click
+    # Note: takes any number of device specs (ie. 1199:9071 1199:9079, '1199:*' or port:1-1.2); any of them can match
     devVidPid = None
     if len(sys.argv) > 1:
-        devVidPid = sys.argv[1]
-
-    resetModem(devVidPid)
\ No newline at end of file
+        devVidPid = sys.argv[1:]
+
+    # MODEM_TRACE_FILE=<path> writes a timeline of the reset (chrome trace json) to that path
+    traceFile = os.getenv('MODEM_TRACE_FILE')
+    if traceFile:
+        startTrace(traceFile)
+    try:
+        resetModem(devVidPid)
+    finally:
+        if traceFile:
+            stopTrace()
\ No newline at end of file
@@ -0,0 +1,224 @@
+#!/opt/modem_config/bin/python3
+'''
+Timing spans for the modem tools, exported as a Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+Tracing is off unless startTrace() is called; while it is off, traced() functions are called straight through and
+traceSpan() hands back a shared do-nothing span, so the instrumentation can stay in place.  Spans nest per thread and per
+asyncio task; each asyncio task gets its own row in the trace
+'''
+import os
+import json
+import time
+import asyncio
+import inspect
+import threading
+import functools
+import contextvars
+from logging import Logger
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+# the active Tracer; None while tracing is off
+activeTracer = None
+
+
+class NullSpan:
+    '''
+    What traceSpan() returns while tracing is off
+    '''
+    def set(self, key:str, value) -> None:
+        pass
+
+    def count(self, key:str, amount:int=None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class TraceSpan:
+    '''
+    One timed phase; spans opened inside it (on the same thread) are nested under it
+
+    :param name: What is being timed (ie. waitForModemDevice)
+    :param args: Extra details shown with the span (ie. the AT command)
+    '''
+    def __init__(self, tracer, name:str, args:dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.startNs = None
+        self.stackToken = None
+
+    def set(self, key:str, value) -> None:
+        self.args[key] = value
+
+    def count(self, key:str, amount:int=None) -> None:
+        '''
+        Add to a counter of the span (ie. retries)
+        '''
+        if amount is None:
+            amount = 1
+        self.args[key] = self.args.get(key, 0) + amount
+
+    def __enter__(self):
+        self.stackToken = self.tracer.spanStackVar.set(self.tracer.getSpanStack() + (self,))
+        self.startNs = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        endNs = time.perf_counter_ns()
+        self.tracer.spanStackVar.reset(self.stackToken)
+        if excType is not None:
+            self.args['error'] = f'{excType.__name__}: {excValue}'
+        self.tracer.addEvent(self.name, self.startNs, endNs, self.args)
+
+
+class Tracer:
+    '''
+    Collects the spans of one run
+
+    :param filePath: Where writeTrace() puts the Chrome trace json
+    '''
+    def __init__(self, filePath:str):
+        self.filePath = filePath
+        self.startNs = time.perf_counter_ns()
+        self.eventList = []
+        self.eventLock = threading.Lock()
+        # open spans, innermost last; a context variable so every thread and every asyncio task has its own
+        self.spanStackVar = contextvars.ContextVar('spanStack', default=())
+        # names of the asyncio tasks that have spans, by their trace tid
+        self.taskNameDict = {}
+
+    def getSpanStack(self) -> tuple:
+        return self.spanStackVar.get()
+
+    def getTraceTid(self) -> int:
+        '''
+        The row of the trace the current code goes in: the asyncio task if there is one, otherwise the thread
+        '''
+        try:
+            curTask = asyncio.current_task()
+        except RuntimeError:
+            # no event loop running in this thread
+            curTask = None
+        if curTask is None:
+            return threading.get_ident()
+
+        with self.eventLock:
+            self.taskNameDict[id(curTask)] = curTask.get_name()
+        return id(curTask)
+
+    def addEvent(self, name:str, startNs:int, endNs:int, args:dict) -> None:
+        # a complete ("X") event; the viewer nests the events of a thread by their times
+        traceEvent = {
+            'name': name,
+            'ph': 'X',
+            'ts': (startNs - self.startNs) / 1000,
+            'dur': (endNs - startNs) / 1000,
+            'pid': os.getpid(),
+            'tid': self.getTraceTid(),
+        }
+        if len(args) > 0:
+            traceEvent['args'] = args
+        with self.eventLock:
+            self.eventList.append(traceEvent)
+
+    def writeTrace(self) -> None:
+        with self.eventLock:
+            eventList = list(self.eventList)
+            taskNameDict = dict(self.taskNameDict)
+
+        # name the threads (and tasks) so the fleet workers are told apart
+        threadNameDict = {curThread.ident: curThread.name for curThread in threading.enumerate()}
+        threadNameDict.update(taskNameDict)
+        metadataEventList = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': curTid, 'args': {'name': threadNameDict.get(curTid, str(curTid))}}
+            for curTid in sorted({curEvent['tid'] for curEvent in eventList})]
+
+        tempFilePath = f'{self.filePath}.tmp'
+        with open(tempFilePath, 'w') as traceFile:
+            json.dump({'traceEvents': metadataEventList + eventList, 'displayTimeUnit': 'ms'}, traceFile, default=str)
+        os.replace(tempFilePath, self.filePath)
+
+        logger.info(f'Wrote {len(eventList)} trace spans to {self.filePath}')
+
+
+def startTrace(filePath:str) -> Tracer:
+    '''
+    Turn tracing on; spans from now on are collected until stopTrace()
+    '''
+    global activeTracer
+
+    activeTracer = Tracer(filePath)
+    return activeTracer
+
+
+def stopTrace() -> None:
+    '''
+    Turn tracing off and write out what was collected
+    '''
+    global activeTracer
+
+    tracer = activeTracer
+    activeTracer = None
+    if tracer is not None:
+        tracer.writeTrace()
+
+
+def traceSpan(name:str, **args):
+    '''
+    Time a block: with traceSpan('flash slot', slot=1) as span: ...
+    '''
+    tracer = activeTracer
+    if tracer is None:
+        return NULL_SPAN
+    return TraceSpan(tracer, name, args)
+
+
+def currentSpan():
+    '''
+    The innermost open span of this thread (a do-nothing span if there is none or tracing is off)
+    '''
+    tracer = activeTracer
+    if tracer is None:
+        return NULL_SPAN
+    spanStack = tracer.getSpanStack()
+    if len(spanStack) < 1:
+        return NULL_SPAN
+    return spanStack[-1]
+
+
+def traced(name:str=None):
+    '''
+    Decorator that puts a span around every call of the function (for a coroutine function, around the awaiting of it)
+
+    :param name: Name of the span; the function name if not set
+    '''
+    def decorator(method):
+        spanName = name if name is not None else method.__name__
+
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def asyncWrapper(*args, **kwargs):
+                tracer = activeTracer
+                if tracer is None:
+                    return await method(*args, **kwargs)
+                with TraceSpan(tracer, spanName, {}):
+                    return await method(*args, **kwargs)
+            return asyncWrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            tracer = activeTracer
+            if tracer is None:
+                return method(*args, **kwargs)
+            with TraceSpan(tracer, spanName, {}):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
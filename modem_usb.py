@@ -0,0 +1,726 @@
+#!/usr/bin/env python3
+'''
+Helpers for finding USB modems by reading sysfs directly instead of forking lsusb/find.  This only uses the standard
+library so it can be shared by modem_config.py and modem_reset.py
+'''
+import os
+import os.path
+import errno
+import re
+import threading
+import select
+import socket
+import struct
+import time
+import random
+from fcntl import ioctl
+from dataclasses import dataclass
+from logging import Logger
+from typing import Callable, Any
+from modem_trace import currentSpan
+
+logger = Logger(os.path.splitext(os.path.basename(__file__))[0])
+
+DEFAULT_SYSFS_ROOT = '/sys'
+DEFAULT_DEV_ROOT = '/dev'
+
+# Note: relative to the sysfs root
+USB_DEVICES_SYSFS_RELPATH = os.path.join('bus', 'usb', 'devices')
+
+#define NETLINK_KOBJECT_UEVENT	15
+NETLINK_KOBJECT_UEVENT = 15
+# multicast groups: 1 is the raw kernel event, 2 is the same event re-sent by udevd after its rules ran (symlinks exist)
+UEVENT_GROUP_KERNEL = 1
+UEVENT_GROUP_UDEV = 2
+UEVENT_RECEIVE_BUFFER_SIZE = 1024 * 1024
+UEVENT_MAX_MESSAGE_SIZE = 8192
+
+#define USBDEVFS_RESET             _IO('U', 20)
+USBDEVFS_RESET = ord('U') << (4*2) | 20
+
+# Note: libudev sends events with a binary header in front of the properties
+LIBUDEV_MESSAGE_PREFIX = b'libudev\0'
+LIBUDEV_MESSAGE_HEADER_FORMAT = '8sIIII'
+
+UEVENT_SUBSYSTEMS = ['usb', 'tty', 'usbmisc']
+UEVENT_ACTIONS = ['add', 'remove']
+
+# Device spec formats understood by DeviceMatcher
+DEVICE_SPEC_SEPARATOR = '|'
+DEVICE_SPEC_WILDCARD = '*'
+DEVICE_SPEC_PORT_PREFIX = 'port:'
+DEVICE_SPEC_SERIAL_PREFIX = 'serial:'
+VID_PID_SPEC_REGEX = re.compile(r'^(?P<vid>[0-9a-fA-F]{4}|\*):(?P<pid>[0-9a-fA-F]{4}|\*)$')
+PORT_PATH_SPEC_REGEX = re.compile(r'^\d+-\d+(\.\d+)*$')
+
+# Port types of the tty interfaces of the Sierra MC74xx family (same as ModemManager's 77-mm-sierra.rules hints).  The
+# QMI port is found by its driver (cdc-wdm/GobiQMI) instead, since its interface number depends on the usb composition
+MODEM_PORT_TYPE_QCDM = 'qcdm'
+MODEM_PORT_TYPE_GPS = 'gps'
+MODEM_PORT_TYPE_AT = 'at'
+DEFAULT_INTERFACE_PORT_TYPES = {
+    0: MODEM_PORT_TYPE_QCDM,
+    2: MODEM_PORT_TYPE_GPS,
+    3: MODEM_PORT_TYPE_AT,
+}
+# sysfs class directories (under the usb interface) that hold QMI control devices
+QMI_SYSFS_CLASS_DIRNAMES = ['usbmisc', 'GobiQMI']
+
+# waiting for devices: re-check quickly at first, then back off to WAIT_MAX_INTERVAL
+DEFAULT_WAIT_TIMEOUT = 30
+WAIT_INITIAL_INTERVAL = 0.05
+WAIT_BACKOFF_FACTOR = 2
+WAIT_MAX_INTERVAL = 3
+# each interval is shortened by up to this fraction
+WAIT_JITTER = 0.25
+
+
+@dataclass(frozen=True)
+class UsbDevice:
+    '''
+    Identity and topology of a single USB device as found under /sys/bus/usb/devices
+
+    :param sysfsPath: Path to the device directory in sysfs
+    :param portPath: USB port path of the device (ie. 1-1.2); this stays the same across re-enumeration
+    :param vid: Vendor id as lowercase hex (ie. 1199)
+    :param pid: Product id as lowercase hex (ie. 9071)
+    :param busnum: USB bus number
+    :param devnum: USB device number on the bus; this changes every time the device re-enumerates
+    :param serial: Serial number string of the device, if it has one
+    '''
+    sysfsPath: str
+    portPath: str
+    vid: str
+    pid: str
+    busnum: int
+    devnum: int
+    serial: str = None
+
+    @property
+    def vidPid(self) -> str:
+        return f'{self.vid}:{self.pid}'
+
+    def __str__(self) -> str:
+        return f'Bus {self.busnum:03d} Device {self.devnum:03d}: ID {self.vidPid} (port {self.portPath}, serial {self.serial})'
+
+
+devRoot:str = None
+
+def getDevRoot():
+    global devRoot
+
+    if devRoot is None:
+        devRoot = os.environ.get('MODEM_DEV_ROOT', DEFAULT_DEV_ROOT)
+
+    return devRoot
+
+
+sysfsRoot:str = None
+
+def getSysfsRoot():
+    global sysfsRoot
+
+    if sysfsRoot is None:
+        # allow pointing everything at a fake tree (ie. for testing)
+        sysfsRoot = os.environ.get('MODEM_SYSFS_ROOT', DEFAULT_SYSFS_ROOT)
+
+    return sysfsRoot
+
+
+def readSysfsAttr(dirPath, attrName, default=None):
+    # Note: devices can go away while we are looking at them, so a missing attribute is not an error
+    try:
+        with open(os.path.join(dirPath, attrName), 'r') as attrFileObj:
+            return attrFileObj.read().strip()
+    except OSError:
+        return default
+
+
+def readUsbDevice(usbDevSysfsPath, portPath=None):
+    if portPath is None:
+        portPath = os.path.basename(os.path.realpath(usbDevSysfsPath))
+
+    usbDevVid = readSysfsAttr(usbDevSysfsPath, 'idVendor')
+    usbDevPid = readSysfsAttr(usbDevSysfsPath, 'idProduct')
+    usbDevBusnum = readSysfsAttr(usbDevSysfsPath, 'busnum')
+    usbDevDevnum = readSysfsAttr(usbDevSysfsPath, 'devnum')
+
+    # not a usb device (or it went away while reading it)
+    if None in (usbDevVid, usbDevPid, usbDevBusnum, usbDevDevnum):
+        return None
+
+    return UsbDevice(
+        sysfsPath=usbDevSysfsPath,
+        portPath=portPath,
+        vid=usbDevVid.lower(),
+        pid=usbDevPid.lower(),
+        busnum=int(usbDevBusnum),
+        devnum=int(usbDevDevnum),
+        serial=readSysfsAttr(usbDevSysfsPath, 'serial'))
+
+
+def scanUsbDevices(sysfsRoot=None) -> list:
+    '''
+    List every USB device currently known to the kernel (the same set of devices lsusb would show)
+
+    :param sysfsRoot: Root of the sysfs tree to scan; defaults to getSysfsRoot()
+    '''
+    if sysfsRoot is None:
+        sysfsRoot = getSysfsRoot()
+
+    usbDevicesDirPath = os.path.join(sysfsRoot, USB_DEVICES_SYSFS_RELPATH)
+
+    foundDevices = []
+    try:
+        with os.scandir(usbDevicesDirPath) as dirEntryIter:
+            for curDirEntry in dirEntryIter:
+                # skip interfaces (ie. 1-1.2:1.0); they share a directory with the devices
+                if ':' in curDirEntry.name:
+                    continue
+                curUsbDevice = readUsbDevice(curDirEntry.path, curDirEntry.name)
+                if curUsbDevice is not None:
+                    foundDevices.append(curUsbDevice)
+    except FileNotFoundError:
+        # no usb subsystem at all
+        logger.debug(f'No usb devices directory found at {usbDevicesDirPath}')
+
+    foundDevices.sort(key=lambda curUsbDevice: (curUsbDevice.busnum, curUsbDevice.devnum))
+
+    return foundDevices
+
+
+def findUsbDevices(vidPid, sysfsRoot=None) -> list:
+    '''
+    List the USB devices matching the given device spec (ie. 1199:9071); see DeviceMatcher for the spec formats
+    '''
+    deviceMatcher = getDeviceMatcher(vidPid)
+
+    return [curUsbDevice for curUsbDevice in scanUsbDevices(sysfsRoot=sysfsRoot) if deviceMatcher.matches(curUsbDevice)]
+
+
+@dataclass(frozen=True)
+class UsbDeviceRecord:
+    '''
+    Everything resolved about the usb device behind a char device (ie. /dev/cdc-wdm0 or /dev/ttyUSB2)
+
+    :param devPath: Path of the char device this was resolved from
+    :param major: Major number of the char device
+    :param minor: Minor number of the char device
+    :param inode: Inode of the char device file; a new file (new inode) means the device was re-created
+    :param sysfsIfacePath: Path to the usb interface in sysfs that the char device belongs to
+    :param interfaceNumber: Usb interface number (bInterfaceNumber) of that interface
+    :param usbDevice: The usb device the interface belongs to
+    '''
+    devPath: str
+    major: int
+    minor: int
+    inode: int
+    sysfsIfacePath: str
+    interfaceNumber: int
+    usbDevice: UsbDevice
+
+    @property
+    def vidPid(self) -> str:
+        return self.usbDevice.vidPid
+
+    @property
+    def busnum(self) -> int:
+        return self.usbDevice.busnum
+
+    @property
+    def devnum(self) -> int:
+        return self.usbDevice.devnum
+
+    @property
+    def usbDevNodePath(self) -> str:
+        return os.path.join(getDevRoot(), 'bus', 'usb', f'{self.busnum:03d}', f'{self.devnum:03d}')
+
+
+# Note: keyed by (major, minor) of the char device
+usbDeviceRecordCache = {}
+usbDeviceRecordCacheLock = threading.Lock()
+
+def resolveUsbDeviceRecord(devPath, devStat, sysfsRoot) -> UsbDeviceRecord:
+    charDevMajor = os.major(devStat.st_rdev)
+    charDevMinor = os.minor(devStat.st_rdev)
+    # USB sysfs for the char device; this is the usb interface, so the usb device is its parent
+    sysfsCharDevPath = os.path.join(sysfsRoot, 'dev', 'char', f'{charDevMajor}:{charDevMinor}', 'device')
+    sysfsUsbIfacePath = os.path.realpath(sysfsCharDevPath)
+    logger.debug(f'* USB sysfs for char device {devPath}: {sysfsUsbIfacePath}')
+    sysfsUsbDevPath = os.path.dirname(sysfsUsbIfacePath)
+
+    usbDevice = readUsbDevice(sysfsUsbDevPath)
+    if usbDevice is None:
+        raise RuntimeError(f'{devPath} is not a usb device (no usb device info found at {sysfsUsbDevPath})')
+
+    interfaceNumber = readSysfsAttr(sysfsUsbIfacePath, 'bInterfaceNumber')
+
+    return UsbDeviceRecord(
+        devPath=devPath,
+        major=charDevMajor,
+        minor=charDevMinor,
+        inode=devStat.st_ino,
+        sysfsIfacePath=sysfsUsbIfacePath,
+        interfaceNumber=None if interfaceNumber is None else int(interfaceNumber, 16),
+        usbDevice=usbDevice)
+
+
+def getUsbDeviceRecord(devPath, sysfsRoot=None) -> UsbDeviceRecord:
+    '''
+    Get the usb identity and topology of a char device (ie. /dev/cdc-wdm0).  Records are cached by the device's
+    major:minor; a cached record is only re-resolved if the device file was re-created (inode changed) or the usb device
+    re-enumerated (devnum changed), so repeat lookups only cost a stat and one small sysfs read
+    '''
+    if sysfsRoot is None:
+        sysfsRoot = getSysfsRoot()
+
+    devStat = os.stat(devPath)
+    cacheKey = (os.major(devStat.st_rdev), os.minor(devStat.st_rdev))
+
+    with usbDeviceRecordCacheLock:
+        cachedRecord = usbDeviceRecordCache.get(cacheKey)
+
+    if (cachedRecord is not None and cachedRecord.inode == devStat.st_ino
+            and readSysfsAttr(cachedRecord.usbDevice.sysfsPath, 'devnum') == str(cachedRecord.devnum)):
+        return cachedRecord
+
+    usbDeviceRecord = resolveUsbDeviceRecord(devPath, devStat, sysfsRoot)
+
+    with usbDeviceRecordCacheLock:
+        usbDeviceRecordCache[cacheKey] = usbDeviceRecord
+
+    return usbDeviceRecord
+
+
+def getUsbDeviceOfCharDevice(devPath, sysfsRoot=None) -> UsbDevice:
+    '''
+    Find the USB device that a char device (ie. /dev/cdc-wdm0 or /dev/ttyUSB2) belongs to
+    '''
+    return getUsbDeviceRecord(devPath, sysfsRoot=sysfsRoot).usbDevice
+
+
+@dataclass(frozen=True)
+class ModemPorts:
+    '''
+    All the device files of a single modem
+
+    :param usbDevice: The usb device of the modem
+    :param qmiDevPaths: QMI control devices (ie. /dev/cdc-wdm0 or /dev/qcqmi0), in interface order
+    :param atDevPath: Primary AT command tty, if found
+    :param gpsDevPath: GPS/NMEA tty, if found
+    :param qcdmDevPath: QCDM/diag tty, if found
+    :param ttyDevPaths: Every tty of the modem, by usb interface number
+    '''
+    usbDevice: UsbDevice
+    qmiDevPaths: tuple
+    atDevPath: str
+    gpsDevPath: str
+    qcdmDevPath: str
+    ttyDevPaths: dict
+
+
+def listChildNames(dirPath) -> list:
+    try:
+        return sorted(os.listdir(dirPath))
+    except OSError:
+        return []
+
+
+def discoverModemPorts(usbDevice:UsbDevice, devRoot=None, interfacePortTypes:dict=None) -> ModemPorts:
+    '''
+    Find all the QMI, AT, GPS and QCDM device files of a modem in one pass over its usb interfaces in sysfs.  tty roles
+    come from the usb interface number, so this works before ModemManager has created its mm-* symlinks
+
+    :param usbDevice: The modem (ie. from findUsbDevices())
+    :param devRoot: Where the device files are; defaults to getDevRoot()
+    :param interfacePortTypes: Port type of each tty interface number; defaults to DEFAULT_INTERFACE_PORT_TYPES
+    '''
+    if devRoot is None:
+        devRoot = getDevRoot()
+    if interfacePortTypes is None:
+        interfacePortTypes = DEFAULT_INTERFACE_PORT_TYPES
+
+    qmiDevPaths = []
+    ttyDevPaths = {}
+    # interfaces of the device are its child directories named <port path>:<config>.<interface>
+    for curIfaceDirname in listChildNames(usbDevice.sysfsPath):
+        if not curIfaceDirname.startswith(f'{usbDevice.portPath}:'):
+            continue
+        curIfacePath = os.path.join(usbDevice.sysfsPath, curIfaceDirname)
+        curIfaceNumber = readSysfsAttr(curIfacePath, 'bInterfaceNumber')
+        if curIfaceNumber is None:
+            continue
+        curIfaceNumber = int(curIfaceNumber, 16)
+
+        for curChildName in listChildNames(curIfacePath):
+            if curChildName in QMI_SYSFS_CLASS_DIRNAMES:
+                qmiDevPaths += [os.path.join(devRoot, curQmiName) for curQmiName in listChildNames(os.path.join(curIfacePath, curChildName))]
+            # usb serial ttys (qcserial) are directly under the interface, acm ones are in a tty class directory
+            elif curChildName.startswith('ttyUSB'):
+                ttyDevPaths[curIfaceNumber] = os.path.join(devRoot, curChildName)
+            elif curChildName == 'tty':
+                for curTtyName in listChildNames(os.path.join(curIfacePath, curChildName)):
+                    ttyDevPaths[curIfaceNumber] = os.path.join(devRoot, curTtyName)
+
+    ttyDevPathsByType = {}
+    for curIfaceNumber, curTtyDevPath in ttyDevPaths.items():
+        curPortType = interfacePortTypes.get(curIfaceNumber)
+        if curPortType is not None:
+            ttyDevPathsByType[curPortType] = curTtyDevPath
+
+    return ModemPorts(
+        usbDevice=usbDevice,
+        qmiDevPaths=tuple(qmiDevPaths),
+        atDevPath=ttyDevPathsByType.get(MODEM_PORT_TYPE_AT),
+        gpsDevPath=ttyDevPathsByType.get(MODEM_PORT_TYPE_GPS),
+        qcdmDevPath=ttyDevPathsByType.get(MODEM_PORT_TYPE_QCDM),
+        ttyDevPaths=ttyDevPaths)
+
+
+def findModemPorts(vidPid, sysfsRoot=None, devRoot=None) -> list:
+    '''
+    Discover the ports of every modem matching the given device spec
+    '''
+    return [discoverModemPorts(curUsbDevice, devRoot=devRoot) for curUsbDevice in findUsbDevices(vidPid, sysfsRoot=sysfsRoot)]
+
+
+class InvalidDeviceSpecError(RuntimeError):
+    ...
+
+
+class DeviceMatcher:
+    '''
+    Matches USB devices against a device spec.  A spec can be any of:
+        * a vid:pid pair (ie. 1199:9071); either half can be a * wildcard (ie. 1199:*)
+        * a usb port path (ie. 1-1.2 or port:1-1.2)
+        * a device serial number (ie. serial:0123456789)
+        * a compiled regex; this is matched against the vid:pid
+        * several of the above joined with | or in a list (ie. 1199:9071|1199:9079|413C:81B6); any of them can match
+
+    The spec is parsed once into sets so matching is cheap.  Instances never change after creation, so they are safe to
+    share between threads; use getDeviceMatcher() to get a cached one
+    '''
+    def __init__(self, specList):
+        self.specList = tuple(specList)
+
+        vidPidSet = set()
+        vidSet = set()
+        pidSet = set()
+        portPathSet = set()
+        serialSet = set()
+        patternList = []
+        matchAll = False
+        for curSpec in self.specList:
+            if isinstance(curSpec, re.Pattern):
+                patternList.append(curSpec)
+                continue
+
+            if curSpec.startswith(DEVICE_SPEC_SERIAL_PREFIX):
+                serialSet.add(curSpec[len(DEVICE_SPEC_SERIAL_PREFIX):])
+                continue
+
+            curPortPath = curSpec[len(DEVICE_SPEC_PORT_PREFIX):] if curSpec.startswith(DEVICE_SPEC_PORT_PREFIX) else curSpec
+            if PORT_PATH_SPEC_REGEX.match(curPortPath):
+                portPathSet.add(curPortPath)
+                continue
+
+            curMatch = VID_PID_SPEC_REGEX.match(curSpec)
+            if curMatch is None:
+                raise InvalidDeviceSpecError(f'Invalid device spec {curSpec!r}; expected vid:pid, port path or serial')
+            curVid = curMatch.group('vid').lower()
+            curPid = curMatch.group('pid').lower()
+            if curVid == DEVICE_SPEC_WILDCARD and curPid == DEVICE_SPEC_WILDCARD:
+                matchAll = True
+            elif curPid == DEVICE_SPEC_WILDCARD:
+                vidSet.add(curVid)
+            elif curVid == DEVICE_SPEC_WILDCARD:
+                pidSet.add(curPid)
+            else:
+                vidPidSet.add(f'{curVid}:{curPid}')
+
+        self.vidPidSet = frozenset(vidPidSet)
+        self.vidSet = frozenset(vidSet)
+        self.pidSet = frozenset(pidSet)
+        self.portPathSet = frozenset(portPathSet)
+        self.serialSet = frozenset(serialSet)
+        self.patternList = tuple(patternList)
+        self.matchAll = matchAll
+
+    def matchesVidPid(self, vid:str, pid:str) -> bool:
+        if self.matchAll or vid in self.vidSet or pid in self.pidSet or f'{vid}:{pid}' in self.vidPidSet:
+            return True
+        return any(curPattern.search(f'{vid}:{pid}') for curPattern in self.patternList)
+
+    def matches(self, usbDevice:UsbDevice) -> bool:
+        return (self.matchesVidPid(usbDevice.vid, usbDevice.pid)
+                or usbDevice.portPath in self.portPathSet
+                or (usbDevice.serial is not None and usbDevice.serial in self.serialSet))
+
+    def matchesUevent(self, ueventDict:dict) -> bool:
+        '''
+        Check if a uevent could be for a matching device.  Only usb events say which device they are for, so anything
+        else (and anything this can not rule out, like a serial number spec) counts as a match
+        '''
+        if ueventDict.get('SUBSYSTEM') != 'usb' or len(self.serialSet) > 0:
+            return True
+
+        if 'PRODUCT' in ueventDict:
+            try:
+                eventVid, eventPid = [f'{int(curId, 16):04x}' for curId in ueventDict['PRODUCT'].split('/')[0:2]]
+            except ValueError:
+                return True
+            if self.matchesVidPid(eventVid, eventPid):
+                return True
+        elif self.matchAll or len(self.vidPidSet | self.vidSet | self.pidSet) > 0 or len(self.patternList) > 0:
+            return True
+
+        if len(self.portPathSet) > 0:
+            # Note: for interfaces the last DEVPATH part is <port path>:<config>.<interface>
+            if 'DEVPATH' not in ueventDict:
+                return True
+            if os.path.basename(ueventDict['DEVPATH']).split(':')[0] in self.portPathSet:
+                return True
+
+        return False
+
+    def __str__(self) -> str:
+        return DEVICE_SPEC_SEPARATOR.join(
+            curSpec.pattern if isinstance(curSpec, re.Pattern) else curSpec for curSpec in self.specList)
+
+
+def splitDeviceSpec(deviceSpec) -> tuple:
+    if isinstance(deviceSpec, DeviceMatcher):
+        return deviceSpec.specList
+    if isinstance(deviceSpec, re.Pattern):
+        return (deviceSpec,)
+    if isinstance(deviceSpec, str):
+        return tuple(curSpec.strip() for curSpec in deviceSpec.split(DEVICE_SPEC_SEPARATOR) if curSpec.strip() != '')
+
+    specList = []
+    for curDeviceSpec in deviceSpec:
+        specList += splitDeviceSpec(curDeviceSpec)
+    return tuple(specList)
+
+
+deviceMatcherCache = {}
+deviceMatcherCacheLock = threading.Lock()
+
+def getDeviceMatcher(deviceSpec) -> DeviceMatcher:
+    '''
+    Get the (cached) DeviceMatcher for a device spec; see DeviceMatcher for the spec formats
+    '''
+    if isinstance(deviceSpec, DeviceMatcher):
+        return deviceSpec
+
+    specList = splitDeviceSpec(deviceSpec)
+
+    with deviceMatcherCacheLock:
+        deviceMatcher = deviceMatcherCache.get(specList)
+        if deviceMatcher is None:
+            deviceMatcher = DeviceMatcher(specList)
+            deviceMatcherCache[specList] = deviceMatcher
+
+    return deviceMatcher
+
+
+def parseUevent(ueventBytes:bytes) -> dict:
+    '''
+    Parse a kernel or udevd uevent netlink message into a dictionary of its properties (ACTION, DEVPATH, SUBSYSTEM, ...)
+    '''
+    if ueventBytes.startswith(LIBUDEV_MESSAGE_PREFIX):
+        _, _, _, propertiesOffset, propertiesLength = struct.unpack_from(LIBUDEV_MESSAGE_HEADER_FORMAT, ueventBytes)
+        propertyList = ueventBytes[propertiesOffset:propertiesOffset + propertiesLength].split(b'\0')
+    else:
+        # kernel format is "action@devpath\0KEY=value\0..."; the summary line is repeated in the properties
+        propertyList = ueventBytes.split(b'\0')[1:]
+
+    ueventDict = {}
+    for curProperty in propertyList:
+        curKey, sep, curValue = curProperty.decode('utf-8', errors='replace').partition('=')
+        if sep:
+            ueventDict[curKey] = curValue
+
+    return ueventDict
+
+
+class NetlinkUeventSource:
+    '''
+    Source of uevents read from a NETLINK_KOBJECT_UEVENT socket.  Anything with the same receive()/close() methods can
+    be used in its place (ie. to feed synthetic events); fileno() is optional and lets asyncio wait on the source
+    '''
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UEVENT_RECEIVE_BUFFER_SIZE)
+            # Note: port id 0 lets the kernel pick one for us
+            self.sock.bind((0, UEVENT_GROUP_KERNEL | UEVENT_GROUP_UDEV))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def receive(self, timeout:float) -> dict:
+        '''
+        Wait up to timeout seconds for the next uevent.  Returns None if nothing arrived
+        '''
+        readyList, _, _ = select.select([self.sock], [], [], max(timeout, 0))
+        if len(readyList) < 1:
+            return None
+
+        try:
+            ueventBytes = self.sock.recv(UEVENT_MAX_MESSAGE_SIZE)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # we missed events; return an empty one so the caller re-checks everything
+            logger.debug('uevent socket overflowed; some events were dropped')
+            return {}
+
+        return parseUevent(ueventBytes)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def ioctlResetUsbDevice(devNodePath) -> None:
+    # This part works with ANY usb device
+    with open(devNodePath, "wb") as fd:
+        ioctl(fd, USBDEVFS_RESET, 0)
+
+
+# what resetUsbDevice() resets the usb device node with; can be swapped out (ie. for a simulated modem)
+usbResetMethod:Callable = ioctlResetUsbDevice
+
+def resetUsbDevice(devNodePath) -> None:
+    '''
+    Reset the usb device at the given device node (ie. /dev/bus/usb/001/002) using usbResetMethod
+    '''
+    usbResetMethod(devNodePath)
+
+
+ueventSourceFactory:Callable = NetlinkUeventSource
+
+def openUeventSource():
+    '''
+    Open a new uevent source using ueventSourceFactory.  Returns None if uevents are not available here (ie. no netlink
+    support or not allowed to bind), in which case callers should fall back to polling
+    '''
+    if ueventSourceFactory is None:
+        return None
+
+    try:
+        return ueventSourceFactory()
+    except (OSError, AttributeError) as e:
+        logger.debug(f'uevents unavailable, falling back to polling: {e}')
+        return None
+
+
+def closeUeventSource(eventSource) -> None:
+    if eventSource is not None:
+        eventSource.close()
+
+
+def ueventMatches(ueventDict:dict, vidPid=None) -> bool:
+    '''
+    Check if a uevent could be a change to the device(s) matching the given device spec
+    '''
+    # an empty event means events were dropped; assume it may be ours
+    if len(ueventDict) < 1:
+        return True
+
+    if ueventDict.get('ACTION') not in UEVENT_ACTIONS or ueventDict.get('SUBSYSTEM') not in UEVENT_SUBSYSTEMS:
+        return False
+
+    if vidPid is None:
+        return True
+
+    return getDeviceMatcher(vidPid).matchesUevent(ueventDict)
+
+
+def getWaitDeadline(timeout:float=None, deadline:float=None) -> float:
+    '''
+    :param timeout: Seconds from now
+    :param deadline: Absolute time.monotonic() to stop at; wins over timeout if both are set
+    :return: The absolute deadline (time.monotonic()) for a wait
+    '''
+    if deadline is not None:
+        return deadline
+    if timeout is None:
+        timeout = DEFAULT_WAIT_TIMEOUT
+    return time.monotonic() + timeout
+
+
+def getNextWaitInterval(curInterval:float, maxInterval:float) -> float:
+    '''
+    :return: The next re-check interval of a wait: exponentially longer, capped at maxInterval, with some jitter so a
+             bunch of waiters don't all poke sysfs at the same moment
+    '''
+    nextInterval = min(curInterval * WAIT_BACKOFF_FACTOR, maxInterval)
+    return nextInterval * random.uniform(1 - WAIT_JITTER, 1)
+
+
+def waitForUsbCondition(conditionFn:Callable[[], Any], timeout:float=None, pollInterval:float=None, vidPid=None, eventSource=None, deadline:float=None) -> Any:
+    '''
+    Call conditionFn until it returns something other than None and return that value.  Between checks this blocks on
+    uevents for the matching device(s), so it returns as soon as the device shows up or goes away.  The time between
+    re-checks starts at WAIT_INITIAL_INTERVAL and backs off exponentially (with jitter) up to pollInterval; a matching
+    uevent starts it over.  If uevents are not available, this just sleeps between checks.
+
+    :param conditionFn: Method to check for the condition; returns None if the condition is not met yet
+    :param timeout: How long to wait, in seconds; if 0, the condition is checked exactly once
+    :param pollInterval: Longest time between checks; defaults to WAIT_MAX_INTERVAL
+    :param vidPid: Only wake up for usb events of devices matching this spec (tty/usbmisc events always wake this up)
+    :param eventSource: uevent source to use; if not set, one is opened (and closed) by this method.  Pass one in if it
+                        has to be listening before the call (ie. to see a device go away right after a reset)
+    :param deadline: Absolute time.monotonic() to give up at, instead of timeout; lets several waits share one budget
+    :return: The value from conditionFn, or None if the deadline was reached
+    '''
+    if pollInterval is None:
+        pollInterval = WAIT_MAX_INTERVAL
+
+    startTime = time.monotonic()
+    deadline = getWaitDeadline(timeout, deadline)
+
+    ownsEventSource = eventSource is None
+    if ownsEventSource and deadline > startTime:
+        eventSource = openUeventSource()
+
+    # the span of whatever is waiting (ie. waitForModem) gets how many times the condition was checked and how long
+    # the wait took
+    waitSpan = currentSpan()
+    try:
+        curInterval = min(WAIT_INITIAL_INTERVAL, pollInterval)
+        while True:
+            conditionValue = conditionFn()
+            waitSpan.count('checks')
+            if conditionValue is not None:
+                return conditionValue
+
+            remainingTime = deadline - time.monotonic()
+            if remainingTime <= 0:
+                return None
+
+            if eventSource is None:
+                time.sleep(min(curInterval, remainingTime))
+                curInterval = getNextWaitInterval(curInterval, pollInterval)
+                continue
+
+            # wait for an event that could be ours (or for the re-check interval to pass)
+            recheckTime = time.monotonic() + min(curInterval, remainingTime)
+            curInterval = getNextWaitInterval(curInterval, pollInterval)
+            while True:
+                curUevent = eventSource.receive(recheckTime - time.monotonic())
+                if curUevent is None:
+                    break
+                if ueventMatches(curUevent, vidPid):
+                    # things are happening; look closely again
+                    curInterval = min(WAIT_INITIAL_INTERVAL, pollInterval)
+                    break
+    finally:
+        waitSeconds = time.monotonic() - startTime
+        waitSpan.set('waitSeconds', round(waitSeconds, 3))
+        logger.debug(f'Waited {waitSeconds:.2f} s for {getattr(conditionFn, "__name__", "condition")}')
+        if ownsEventSource:
+            closeUeventSource(eventSource)